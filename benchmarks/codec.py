@@ -0,0 +1,167 @@
+"""Microbenchmarks for the DMAP codec, response builders and trackpad decoding.
+
+    python -m benchmarks.codec [-o results.json] [--filter parse] [--repeat 7]
+
+Each benchmark is timed with timeit: the number of calls per run is picked so a
+run takes at least --min-time seconds, then the run is repeated and the
+per-call times of all runs are reported. Results are written as JSON (to
+stdout unless -o is given) so runs from different releases can be compared.
+Nothing here touches the network.
+"""
+
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import timeit
+from typing import Callable, Optional
+
+import dmap_parser
+import tag_definitions
+import tags
+import combined
+
+
+@dataclass
+class Result:
+    name: str
+    calls: int    # per run
+    runs: int
+    min_ns: float  # per call
+    median_ns: float
+    mean_ns: float
+    stdev_ns: float
+
+
+def build_flat_payload(count: int = 1000) -> bytes:
+    writer = tags.DmapWriter()
+    with writer.container("mlcl"):
+        for i in range(count):
+            writer.uint32("miid", i)
+    return writer.getvalue()
+
+
+def build_large_payload(count: int = 1000) -> bytes:
+    writer = tags.DmapWriter()
+    with writer.container("mlcl"):
+        for i in range(count):
+            with writer.container("mlit"):
+                writer.uint32("miid", i)
+                writer.string("minm", f"Track {i} – Some Artist")
+                writer.uint8("caps", 4)
+                writer.uint64("mper", 0x0123456789ABCDEF + i)
+    return writer.getvalue()
+
+
+def build_deep_payload(depth: int = 500) -> bytes:
+    writer = tags.DmapWriter()
+
+    def nest(level):
+        if level == depth:
+            writer.uint32("miid", level)
+            return
+        with writer.container("mlcl" if level % 2 else "mlit"):
+            nest(level + 1)
+
+    nest(0)
+    return writer.getvalue()
+
+
+def build_trackpad_packet(key: int, length: int = 32) -> bytes:
+    words = [length, 1, 0, 0, 0, 0, 0, 10486038][:length // 4]
+    words += [0] * (length // 4 - len(words))
+    return b"".join((key ^ word).to_bytes(4, "big") for word in words)
+
+
+def benchmarks() -> dict[str, Callable[[], object]]:
+    lookup = tag_definitions.lookup_tag
+    small = combined.build_server_info()
+    flat = build_flat_payload()
+    large = build_large_payload()
+    deep = build_deep_payload()
+    prompt_template = combined.dmap_template.DmapTemplate(
+        combined.build_control_prompt_update(0, "34567", "0000000000000001"), miid=("cmcp", "miid"))
+    trackpad_key = 0x5A17C3E9
+    packet = build_trackpad_packet(trackpad_key)
+
+    return {
+        "parse.small": lambda: dmap_parser.parse(small, lookup),
+        "parse.flat_1000": lambda: dmap_parser.parse(flat, lookup),
+        "parse.large_1000": lambda: dmap_parser.parse(large, lookup),
+        "parse.deep_500": lambda: dmap_parser.parse(deep, lookup),
+        "lookup_tag.known": lambda: lookup(b"mstt"),
+        "lookup_tag.known_str": lambda: lookup("mstt"),
+        "lookup_tag.unknown": lambda: lookup(b"zzzz"),
+        "encode.uint8_tag": lambda: tags.uint8_tag("caps", 4),
+        "encode.uint32_tag": lambda: tags.uint32_tag("mstt", 200),
+        "encode.uint64_tag": lambda: tags.uint64_tag("mper", 0x0123456789ABCDEF),
+        "encode.bool_tag": lambda: tags.bool_tag("mslr", True),
+        "encode.string_tag": lambda: tags.string_tag("minm", "NotUxPlay"),
+        "encode.container_tag": lambda: tags.container_tag("mlit", b"\x00" * 64),
+        "build.server_info": lambda: combined.build_server_info(1700000000),
+        "build.server_info_template": lambda: combined.SERVER_INFO_TEMPLATE.render(mstc=int(time.time())),
+        "build.ctrl_int": combined.build_ctrl_int,
+        "build.control_prompt_update": lambda: combined.build_control_prompt_update(10, "34567", "0000000000000001"),
+        "build.control_prompt_update_template": lambda: prompt_template.render(miid=10),
+        "trackpad.decrypt": lambda: combined.decrypt_trackpad_frame(trackpad_key, packet, 0, 32),
+    }
+
+
+def run(name: str, func: Callable[[], object], repeat: int, min_time: float) -> Result:
+    timer = timeit.Timer(func)
+    calls = 1
+    while True:
+        if timer.timeit(calls) >= min_time:
+            break
+        calls *= 2
+    per_call = [total / calls * 1e9 for total in timer.repeat(repeat, calls)]
+    return Result(
+        name=name,
+        calls=calls,
+        runs=repeat,
+        min_ns=min(per_call),
+        median_ns=statistics.median(per_call),
+        mean_ns=statistics.fmean(per_call),
+        stdev_ns=statistics.stdev(per_call) if repeat > 1 else 0.0,
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per run")
+    args = parser.parse_args(argv)
+    # server-info carries tags tag_definitions doesn't know, don't time writing a warning for each of them
+    logging.getLogger(tag_definitions.__name__).setLevel(logging.ERROR)
+
+    started_at = time.time()
+    results = []
+    for name, func in benchmarks().items():
+        if args.filter in name:
+            result = run(name, func, args.repeat, args.min_time)
+            print(f"{name:40} {result.median_ns:12.0f} ns", file=sys.stderr)
+            results.append(asdict(result))
+
+    report = json.dumps({
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "started_at": started_at,
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""End-to-end latency of forwarding remote input to a DACP target.
+
+    python -m benchmarks.dacp [--iterations 50] [--targets 3 --slow 1.0] [--mdns --host 192.168.1.35] [-o dacp.json]
+
+Starts the app from combined.make_app and one or more FakeDacpTargets, writes
+each target's credentials to its own temporary uxplay dacp file, logs a
+simulated remote in and measures the time from input to the command arriving
+at each target:
+
+  trackpad          an encrypted arrow frame on the arrows port
+  cmbe              a controlpromptentry with a cmbe command
+  credential_reload the target's Active-Remote is rotated and the file
+                    rewritten right before an arrow frame, so the command
+                    usually goes out with stale credentials first and only
+                    arrives after the 403, the reload and the retry
+
+With --slow the last target takes that long to answer every command, which
+should not show up in the other targets' numbers. By default the targets'
+records are put straight into the mDNS registry; with --mdns they are
+advertised and discovered over mDNS like real devices instead.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from aiohttp import ClientSession, web
+
+import combined
+import tags
+from benchmarks.fake_dacp import FakeDacpTarget
+from benchmarks.load import Recorder, Remote, summarize, trackpad_frame
+
+COMMAND_TIMEOUT = 5.0  # seconds to wait for a command to arrive before counting it as lost
+DISCOVERY_TIMEOUT = 10.0
+PAUSE = 0.05  # seconds between iterations, so queued commands are never merged
+
+
+async def measure(targets: list[FakeDacpTarget], command: str, send) -> list[Optional[float]]:
+    """Time from send() to the command arriving at each target, None where it never arrived."""
+    starts = [len(target.received) for target in targets]
+    sent_at = time.perf_counter()
+    await send()
+
+    async def arrival(target, start):
+        try:
+            received = await target.wait_for(command, start, COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        return received.received_at - sent_at
+
+    return await asyncio.gather(*(arrival(target, start) for target, start in zip(targets, starts)))
+
+
+async def run_scenarios(app: web.Application, targets: list[FakeDacpTarget], credentials_files: list[str],
+                        base: str, host: str, iterations: int) -> dict:
+    right = next(code for code, arrow in combined.TRACKPAD_ARROW_CODES.items() if arrow == "right")
+    arrow_command = combined.ARROWS_TO_DACP_COMMAND["right"]
+    cmbe, cmbe_command = next((cmbe, command) for cmbe, command in combined.CMBE_COMMAND_TO_DACP_COMMAND.items()
+                              if command is not None)
+    guid = format(int.from_bytes(os.urandom(8)), "016X")
+    await app[combined.creds].add(guid, "dacp benchmark", "benchmark")
+
+    results = {}
+    async with ClientSession() as client:
+        remote = Remote(client, base, host, guid, Recorder())
+        port, key = await remote.handshake()
+        reader, writer = await asyncio.open_connection(host, port)
+        frame = trackpad_frame(key, right)
+
+        async def send_arrow():
+            writer.write(frame)
+            await reader.readexactly(len(frame))
+
+        async def send_cmbe():
+            entry = tags.DmapWriter()
+            entry.string("cmbe", cmbe)
+            await remote.request("controlpromptentry", "POST", "/ctrl-int/1/controlpromptentry",
+                                 params={"session-id": str(remote.session_id)}, data=entry.getvalue())
+
+        async def reload_and_send_arrow():
+            for target, path in zip(targets, credentials_files):
+                target.rotate_credentials(path)
+            await send_arrow()
+
+        try:
+            for name, command, send in (
+                ("trackpad", arrow_command, send_arrow),
+                ("cmbe", cmbe_command, send_cmbe),
+                ("credential_reload", arrow_command, reload_and_send_arrow),
+            ):
+                latencies: list[list[float]] = [[] for _ in targets]
+                lost = [0] * len(targets)
+                starts = [len(target.received) for target in targets]
+                for _ in range(iterations):
+                    for index, latency in enumerate(await measure(targets, command, send)):
+                        if latency is None:
+                            lost[index] += 1
+                        else:
+                            latencies[index].append(latency)
+                    await asyncio.sleep(PAUSE)
+                results[name] = []
+                for index, target in enumerate(targets):
+                    rejected = sum(not received.accepted for received in target.received[starts[index]:])
+                    results[name].append({"target": index, "delay": target.delay, "command": command,
+                                          "lost": lost[index], "rejected": rejected, **summarize(latencies[index])})
+                    logging.info("%s, target %d: p50 %.2f ms, p99 %.2f ms, %d lost, %d rejected", name, index,
+                                 results[name][-1].get("p50", 0), results[name][-1].get("p99", 0), lost[index], rejected)
+        finally:
+            writer.close()
+            await remote.logout()
+    return results
+
+
+async def run_benchmark(iterations: int, host: str, mdns: bool, target_count: int = 1, slow: float = 0.0) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        credentials_files = [os.path.join(directory, f"uxplay{index}.dacp") for index in range(target_count)]
+        targets = [FakeDacpTarget(host, delay=slow if index == target_count - 1 else 0.0) for index in range(target_count)]
+        for target, path in zip(targets, credentials_files):
+            await target.start()
+            target.write_credentials(path)
+        app = combined.make_app(
+            pairing_store_file=os.path.join(directory, "pairings.jsonl"),
+            uxplay_dacp_files=credentials_files,
+            address=host,
+            port=0,
+            advertise=mdns,
+        )
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, host, 0)
+            await site.start()
+            if mdns:
+                for target in targets:
+                    await target.advertise()
+                deadline = time.monotonic() + DISCOVERY_TIMEOUT
+                while any(app[combined.mdns_entries].by_dacp_id(target.dacp_id) is None for target in targets):
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("fake dacp targets were not discovered over mdns")
+                    await asyncio.sleep(0.1)
+            else:
+                for target in targets:
+                    app[combined.mdns_entries].add(target.record())
+                combined.wake_dacp_warmup()
+            return await run_scenarios(app, targets, credentials_files,
+                                       f"http://{host}:{runner.addresses[0][1]}", host, iterations)
+        finally:
+            await runner.cleanup()
+            for target in targets:
+                await target.stop()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50, help="commands sent per scenario")
+    parser.add_argument("--host", default="127.0.0.1", help="address for the app and the fake target")
+    parser.add_argument("--mdns", action="store_true", help="discover the fake targets over mdns (needs a LAN --host)")
+    parser.add_argument("--targets", type=int, default=1, help="fake targets, each behind its own uxplay dacp file")
+    parser.add_argument("--slow", type=float, default=0.0, help="seconds the last target takes to answer each command")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    for name in combined.LOG_LEVELS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    for module in (combined.dacp_queue, combined.uxplay_credentials):
+        logging.getLogger(module.__name__).setLevel(logging.ERROR)
+
+    started_at = time.time()
+    results = asyncio.run(run_benchmark(args.iterations, args.host, args.mdns, args.targets, args.slow))
+    report = json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": started_at,
+        "iterations": args.iterations,
+        "mdns": args.mdns,
+        "targets": args.targets,
+        "slow": args.slow,
+        "scenarios": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""A local stand-in for the iDevice mirroring to UxPlay.
+
+FakeDacpTarget serves /ctrl-int/1/<command> like a DACP target: requests with
+the expected Active-Remote header are answered 204 and every request is
+recorded with its arrival time, so tests and benchmarks can check what was
+forwarded and how long it took without a real device. It writes the matching
+.uxplay.dacp file, can rotate its credentials the way a reconnecting UxPlay
+client does, and can advertise itself as _dacp._tcp.local. over mDNS.
+"""
+
+import asyncio
+from dataclasses import dataclass
+import os
+import random
+import socket
+import time
+from typing import Optional
+
+from aiohttp import web
+from zeroconf import IPVersion
+from zeroconf.asyncio import AsyncServiceInfo, AsyncZeroconf
+
+from mdns_registry import DACP_SERVICE_PREFIX, ClientRemoteControlRecord
+from play_status import PLAY_STATUS_STOPPED, PlayState, encode_play_status
+
+PLAY_STATUS_HOLD = 5.0  # seconds a playstatusupdate long poll is held before answering 204
+PLAY_STATUS_REVISION = 2
+
+
+@dataclass(frozen=True)
+class ReceivedCommand:
+    command: str
+    active_remote: Optional[str]
+    accepted: bool
+    received_at: float  # time.perf_counter()
+
+
+class FakeDacpTarget:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, dacp_id: Optional[str] = None,
+                 active_remote: Optional[str] = None, delay: float = 0.0) -> None:
+        self.host = host
+        self.port = port
+        self.delay = delay  # seconds before answering a command, to stand in for a slow device
+        self.dacp_id = dacp_id or format(random.getrandbits(64), "016X")
+        self.active_remote = active_remote or str(random.getrandbits(32))
+        self.received: list[ReceivedCommand] = []
+        self._arrived = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+        self._zeroconf: Optional[AsyncZeroconf] = None
+        self._service_info: Optional[AsyncServiceInfo] = None
+
+    @property
+    def fqn(self) -> str:
+        return f"{DACP_SERVICE_PREFIX}{self.dacp_id}._dacp._tcp.local."
+
+    def record(self) -> ClientRemoteControlRecord:
+        """The record AsyncRunner would build after resolving this target."""
+        return ClientRemoteControlRecord(self.fqn, self.port, [(self.host, self.port)], self.dacp_id)
+
+    def write_credentials(self, path: str) -> None:
+        """Write the uxplay dacp file, replacing it in one step like a new file from UxPlay."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(f"{self.dacp_id}\n{self.active_remote}\n")
+        os.replace(tmp_path, path)
+
+    def rotate_credentials(self, path: Optional[str] = None) -> None:
+        """Start expecting a new Active-Remote, as after the iDevice reconnects to UxPlay."""
+        self.active_remote = str(random.getrandbits(32))
+        if path is not None:
+            self.write_credentials(path)
+
+    async def wait_for(self, command: str, start: int = 0, timeout: Optional[float] = None) -> ReceivedCommand:
+        """First accepted command with this name received at or after index start."""
+        async def wait():
+            index = start
+            while True:
+                for received in self.received[index:]:
+                    if received.accepted and received.command == command:
+                        return received
+                index = len(self.received)
+                self._arrived.clear()
+                await self._arrived.wait()
+
+        return await asyncio.wait_for(wait(), timeout)
+
+    async def _ctrl_int(self, request: web.Request) -> web.Response:
+        command = request.match_info["command"]
+        active_remote = request.headers.get("Active-Remote")
+        accepted = active_remote == self.active_remote
+        self.received.append(ReceivedCommand(command, active_remote, accepted, time.perf_counter()))
+        self._arrived.set()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.Response(status=204 if accepted else 403)
+
+    async def _play_status_update(self, request: web.Request) -> web.Response:
+        if request.headers.get("Active-Remote") != self.active_remote:
+            return web.Response(status=403)
+        if request.query.get("revision-number") != str(PLAY_STATUS_REVISION):
+            return web.Response(body=encode_play_status(PLAY_STATUS_REVISION, PlayState(caps=PLAY_STATUS_STOPPED)),
+                                content_type="application/x-dmap-tagged")
+        # nothing ever changes, hold the long poll like a real target and let it be reopened
+        await asyncio.sleep(PLAY_STATUS_HOLD)
+        return web.Response(status=204)
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.add_routes([
+            web.get("/ctrl-int/1/playstatusupdate", self._play_status_update),
+            web.get("/ctrl-int/1/{command}", self._ctrl_int),
+        ])
+        # a held playstatusupdate must not keep shutdown waiting
+        self._runner = web.AppRunner(app, access_log=None, shutdown_timeout=1.0)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def advertise(self) -> None:
+        """Register the target over mDNS, host must be an address reachable on the LAN."""
+        self._zeroconf = AsyncZeroconf(ip_version=IPVersion.V4Only)
+        self._service_info = AsyncServiceInfo(
+            "_dacp._tcp.local.",
+            self.fqn,
+            addresses=[socket.inet_aton(self.host)],
+            port=self.port,
+            properties={"txtvers": "1", "Ver": "131075", "DbId": self.dacp_id, "OSsi": "0x1F5"},
+            server=f"fake-dacp-{self.dacp_id.lower()}.local.",
+        )
+        await self._zeroconf.async_register_service(self._service_info)
+
+    async def stop(self) -> None:
+        if self._zeroconf is not None:
+            await self._zeroconf.async_unregister_service(self._service_info)
+            await self._zeroconf.async_close()
+            self._zeroconf = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
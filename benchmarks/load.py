@@ -0,0 +1,265 @@
+"""In-process load test: many simulated remotes against the real app.
+
+    python -m benchmarks.load --remotes 1,10,50,100 [--frames 200] [--rate 50] [-o load.json]
+
+For each remote count the app from combined.make_app is started on loopback
+(without mDNS), and every simulated remote goes through what the iOS remote
+does: /server-info, /login, /ctrl-int, the controlpromptupdate sequence
+(prompt-id 0, the DRPortInfoRequest entry, prompt-id 9 for the arrows port) and
+then a stream of trackpad frames on the arrows port, encrypted with the key
+derived from SUB_TEXT and the session's cmte, while a controlpromptupdate long
+poll stays parked in the background.
+
+The remotes run on the same event loop as the server, so the reported loop lag
+is the delay any coroutine in the process sees under that load. Trackpad
+latency is the time until a frame is echoed back. Frames carry no arrow, so
+nothing is forwarded to a DACP target (see benchmarks.dacp for that path).
+"""
+
+import argparse
+import asyncio
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+
+import combined
+import dmap_parser
+import tag_definitions
+import tags
+
+LOOP_LAG_INTERVAL = 0.01  # seconds between loop lag samples
+
+
+@dataclass
+class StepResult:
+    remotes: int
+    duration: float
+    http_requests: int = 0
+    http_requests_per_second: float = 0.0
+    frames: int = 0
+    frames_per_second: float = 0.0
+    errors: int = 0
+    latency_ms: dict = field(default_factory=dict)   # request kind -> {"p50", "p99", "max"}
+    loop_lag_ms: dict = field(default_factory=dict)
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self.http_requests = 0
+        self.frames = 0
+        self.errors = 0
+
+    def add(self, kind: str, seconds: float) -> None:
+        self.latencies.setdefault(kind, []).append(seconds)
+
+
+def summarize(values: list[float]) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def percentile(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {"count": len(ordered), "p50": percentile(0.50), "p99": percentile(0.99), "max": ordered[-1] * 1000}
+
+
+def prompt_string(body: bytes) -> Optional[str]:
+    """The kKeybMsgKey_String value of a controlpromptupdate response."""
+    for entry in dmap_parser.first(dmap_parser.parse(body, tag_definitions.lookup_tag), "cmcp") or []:
+        pair = entry.get("mdcl")
+        if pair and dmap_parser.first(pair, "cmce") == "kKeybMsgKey_String":
+            return dmap_parser.first(pair, "cmcv")
+    return None
+
+
+def trackpad_frame(key: int, arrow_code: int = 0) -> bytes:
+    # length word then a touch, word 7 carries the arrow code (0: none)
+    return b"".join((key ^ word).to_bytes(4, "big") for word in (32, 1, 0, 0, 0, 0, 0, arrow_code))
+
+
+class Remote:
+    def __init__(self, client: ClientSession, base: str, host: str, pairing_guid: str, recorder: Recorder) -> None:
+        self.client = client
+        self.base = base
+        self.host = host
+        self.pairing_guid = pairing_guid
+        self.recorder = recorder
+        self.session_id: Optional[int] = None
+
+    async def request(self, kind: str, method: str, path: str, params=None, data=None) -> bytes:
+        started = time.perf_counter()
+        async with self.client.request(method, self.base + path, params=params, data=data) as resp:
+            body = await resp.read()
+            if resp.status >= 400:
+                raise RuntimeError(f"{kind} answered {resp.status}")
+        self.recorder.add(kind, time.perf_counter() - started)
+        self.recorder.http_requests += 1
+        return body
+
+    def prompt_params(self, prompt_id) -> dict:
+        return {"prompt-id": str(prompt_id), "session-id": str(self.session_id), "pairing-guid": self.pairing_guid}
+
+    async def park_prompt_updates(self, prompt_id: int) -> None:
+        # what the remote keeps open while it is idle, answered whenever the prompt changes or the server gives up
+        while True:
+            async with self.client.get(self.base + "/controlpromptupdate", params=self.prompt_params(prompt_id)) as resp:
+                body = await resp.read()
+            miid = dmap_parser.first(dmap_parser.parse(body, tag_definitions.lookup_tag), "cmcp", "miid")
+            if miid:
+                prompt_id = miid
+
+    async def handshake(self) -> tuple[int, int]:
+        """Log in and ask for the trackpad port, returns the arrows port and trackpad key."""
+        await self.request("server-info", "GET", "/server-info")
+        body = await self.request("login", "GET", "/login", params={"pairing-guid": self.pairing_guid})
+        self.session_id = dmap_parser.first(dmap_parser.parse(body, tag_definitions.lookup_tag), "mlog", "mlid")
+        await self.request("ctrl-int", "POST", "/ctrl-int")
+        await self.request("controlpromptupdate", "GET", "/controlpromptupdate", params=self.prompt_params(0))
+
+        cmte = random.getrandbits(31)
+        entry = tags.DmapWriter()
+        entry.string("cmbe", "DRPortInfoRequest")
+        entry.string("cmte", f"{cmte},0")
+        await self.request("controlpromptentry", "POST", "/ctrl-int/1/controlpromptentry",
+                           params={"session-id": str(self.session_id)}, data=entry.getvalue())
+        body = await self.request("controlpromptupdate", "GET", "/controlpromptupdate", params=self.prompt_params(9))
+        return int(prompt_string(body)) ^ cmte, int.from_bytes((combined.SUB_TEXT ^ cmte).to_bytes(4, "little"))
+
+    async def logout(self) -> None:
+        await self.request("logout", "GET", "/logout", params={"session-id": str(self.session_id)})
+
+    async def run(self, frames: int, interval: float) -> None:
+        port, key = await self.handshake()
+        parked = asyncio.create_task(self.park_prompt_updates(10))
+        try:
+            frame = trackpad_frame(key)
+            reader, writer = await asyncio.open_connection(self.host, port)
+            try:
+                for _ in range(frames):
+                    started = time.perf_counter()
+                    writer.write(frame)
+                    await reader.readexactly(len(frame))
+                    self.recorder.add("trackpad", time.perf_counter() - started)
+                    self.recorder.frames += 1
+                    await asyncio.sleep(interval)
+            finally:
+                writer.close()
+        finally:
+            parked.cancel()
+        await self.logout()
+
+
+async def sample_loop_lag(samples: list[float]) -> None:
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        samples.append(max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+
+async def run_step(client: ClientSession, base: str, host: str, guids: list[str], remotes: int,
+                   frames: int, rate: float) -> StepResult:
+    recorder = Recorder()
+    lag: list[float] = []
+    lag_sampler = asyncio.create_task(sample_loop_lag(lag))
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(Remote(client, base, host, guid, recorder).run(frames, 1 / rate) for guid in guids[:remotes]),
+        return_exceptions=True)
+    duration = time.perf_counter() - started
+    lag_sampler.cancel()
+    for result in results:
+        if isinstance(result, BaseException):
+            recorder.errors += 1
+            logging.warning("remote failed: %r", result)
+
+    return StepResult(
+        remotes=remotes,
+        duration=duration,
+        http_requests=recorder.http_requests,
+        http_requests_per_second=recorder.http_requests / duration,
+        frames=recorder.frames,
+        frames_per_second=recorder.frames / duration,
+        errors=recorder.errors,
+        latency_ms={kind: summarize(values) for kind, values in recorder.latencies.items()},
+        loop_lag_ms=summarize(lag),
+    )
+
+
+async def run_load(steps: list[int], frames: int, rate: float, host: str) -> list[StepResult]:
+    with tempfile.TemporaryDirectory() as directory:
+        app = combined.make_app(
+            pairing_store_file=os.path.join(directory, "pairings.jsonl"),
+            uxplay_dacp_files=[os.path.join(directory, "uxplay.dacp")],
+            address=host,
+            port=0,
+            max_sessions=max(steps),
+            advertise=False,
+        )
+        guids = [format(random.getrandbits(64), "016X") for _ in range(max(steps))]
+        for guid in guids:
+            await app[combined.creds].add(guid, "load test", "benchmark")
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, 0)
+        await site.start()
+        base = f"http://{host}:{runner.addresses[0][1]}"
+        results = []
+        try:
+            async with ClientSession(connector=TCPConnector(limit=0), timeout=ClientTimeout(total=None)) as client:
+                for remotes in steps:
+                    result = await run_step(client, base, host, guids, remotes, frames, rate)
+                    logging.info("%d remotes: %.0f req/s, %.0f frames/s, trackpad p99 %.2f ms, loop lag p99 %.2f ms, %d errors",
+                                 remotes, result.http_requests_per_second, result.frames_per_second,
+                                 result.latency_ms.get("trackpad", {}).get("p99", 0),
+                                 result.loop_lag_ms.get("p99", 0), result.errors)
+                    results.append(result)
+        finally:
+            await runner.cleanup()
+        return results
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--remotes", default="1,10,50,100", help="comma separated remote counts, one step each")
+    parser.add_argument("--frames", type=int, default=200, help="trackpad frames sent by each remote")
+    parser.add_argument("--rate", type=float, default=50, help="trackpad frames per second per remote")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    for name in combined.LOG_LEVELS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    steps = [int(count) for count in args.remotes.split(",")]
+    started_at = time.time()
+    results = asyncio.run(run_load(steps, args.frames, args.rate, args.host))
+    report = json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": started_at,
+        "frames_per_remote": args.frames,
+        "rate": args.rate,
+        "steps": [asdict(result) for result in results],
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,9 @@
 import asyncio
 from aiohttp import web
-from aiohttp import ClientSession
+from aiohttp import ClientConnectionError, ClientError, ClientSession, ClientTimeout, TCPConnector
 import logging
 from typing import Any, Optional, cast
 from socket import inet_aton, inet_ntoa
-from dataclasses import dataclass
 from zeroconf import IPVersion, ServiceStateChange, Zeroconf
 from zeroconf.asyncio import (
     AsyncServiceBrowser,
@@ -12,16 +11,20 @@ from zeroconf.asyncio import (
     AsyncZeroconf,
     AsyncZeroconfServiceTypes,
 )
-import aiofiles
 from json import loads, dumps
 from io import StringIO
 from hashlib import md5
 from yarl import URL
-import tags, dmap_parser, tag_definitions
+import tags, dmap_parser, tag_definitions, dmap_template, uxplay_credentials, dacp_queue, metrics, log_setup
+from play_status import PlayStatusStore, read_play_status
+from sessions import SessionStore
+from pairing_store import PairingStore
+from mdns_registry import ClientRemotePairingRecord, ClientRemoteControlRecord, MdnsRegistry
+from mdns_resolver import ServiceResolver, remaining_ttl
+from happy_eyeballs import AddressSelector
 import binascii
 import time
-import random
-from textwrap import wrap
+import struct
 
 # update these
 SERVER_NAME = "NotUxPlay"
@@ -30,7 +33,10 @@ SERVER_ADDRESSES = [inet_aton(ADDRESS),]
 SERVER_PORT = 33689
 ARROWS_PORT = 34999
 
-UXPLAY_DACP_FILE = "./.uxplay.dacp"
+PAIRING_STORE_FILE = "./.pairings.jsonl" # remotes paired through /pair, one json object per line
+
+UXPLAY_DACP_FILES = ["./.uxplay.dacp"] # one per UxPlay receiver, commands are sent to all of them
+UXPLAY_DACP_POLL_INTERVAL = 1.0 # seconds between checks of the file for changes
 # format:
 # line 1: dacp_id (hex, uppercase)
 # line 2: active remote (integer)
@@ -53,31 +59,84 @@ ARROWS_TO_DACP_COMMAND = {
     "up": "volumeup",
 }
 
-# // todo: error handling
+# outgoing http (dacp commands to the uxplay client, pairing requests to remotes)
+HTTP_CONNECTION_LIMIT = 32          # total open connections
+HTTP_CONNECTIONS_PER_HOST = 4       # a remote/iDevice only ever needs a few
+HTTP_KEEPALIVE_TIMEOUT = 60         # seconds an idle connection is kept for reuse
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_REQUEST_TIMEOUT = 10
+PAIRING_REQUEST_TIMEOUT = 30
+HAPPY_EYEBALLS_DELAY = 0.25        # seconds before the next of a device's addresses is tried while the others are still connecting
+
+MAX_SESSIONS = 64                # logged in remotes, the least recently used is logged out beyond this
+SESSION_IDLE_TIMEOUT = 1800      # seconds without requests/trackpad packets before a session expires (matches mstm)
+SESSION_EXPIRY_INTERVAL = 60     # seconds between checks for expired sessions
+
+PROMPT_UPDATE_MIN_TIMEOUT = 10  # seconds an idle controlpromptupdate is parked, doubled while nothing happens
+PROMPT_UPDATE_MAX_TIMEOUT = 60
+
+PLAY_STATUS_TIMEOUT = 60 # seconds a playstatusupdate long poll is held before answering 406
+NOW_PLAYING_POLL_TIMEOUT = 300  # seconds without data before the upstream long poll is reopened
+NOW_PLAYING_RETRY_INTERVAL = 5  # seconds between attempts while the uxplay client is unknown/unreachable
+NOW_PLAYING_BACKOFF = 1         # seconds between polls the target answers at once without news, doubled up to NOW_PLAYING_RETRY_INTERVAL
+
+LOG_LEVEL = logging.INFO
+LOG_LEVELS = {            # per subsystem, e.g. set "daap.arrows" to logging.DEBUG to see every trackpad frame
+    "daap.arrows": logging.INFO,
+    "daap.mdns": logging.INFO,
+    "daap.http": logging.INFO,
+    "daap.dacp": logging.INFO,
+    "daap.pairing": logging.INFO,
+    "aiohttp.access": logging.WARNING,
+}
+
+# forwarded commands wait in a per-target queue
+DACP_COMMAND_TIMEOUT = 3     # seconds a single target gets to answer a command, the others don't wait for it
+DACP_QUEUE_MAX_SIZE = 16    # pending commands per target before the oldest is dropped
+DACP_QUEUE_MAX_AGE = 2.0    # seconds a command may wait before it is considered stale
+DACP_QUEUE_MAX_REPEAT = 5   # repeated volume steps merged into one pending entry
+DACP_WARMUP_INTERVAL = 45   # seconds between keep-alive checks of the dacp target, below HTTP_KEEPALIVE_TIMEOUT so the pooled connection stays open
+
+_LOGGER_ARROWS = logging.getLogger("daap.arrows")
+_LOGGER_MDNS = logging.getLogger("daap.mdns")
+_LOGGER_HTTP = logging.getLogger("daap.http")
+_LOGGER_DACP = logging.getLogger("daap.dacp")
+_LOGGER_PAIRING = logging.getLogger("daap.pairing")
+
+HTTP_METRIC_METHODS = frozenset(("GET", "POST", "HEAD", "OPTIONS"))  # any other method is counted as "other", clients pick the token
+HTTP_REQUESTS = metrics.Counter("daap_http_requests_total", "HTTP requests handled", ("route", "method", "status"))
+HTTP_LATENCY = metrics.Histogram("daap_http_request_duration_seconds", "Time spent handling HTTP requests (long polls included)", ("route", "method"))
+TRACKPAD_FRAMES = metrics.Counter("daap_trackpad_frames_total", "Trackpad frames decoded on the arrows port")
+DACP_FORWARDS = metrics.Counter("daap_dacp_forwards_total", "DACP commands forwarded to uxplay clients, by outcome (http status, error or reason it wasn't sent)", ("target", "command", "outcome"))
+DACP_WARMUPS = metrics.Counter("daap_dacp_warmups_total", "Checks of the dacp targets made ahead of commands, by outcome", ("target", "outcome"))
+DACP_FORWARD_LATENCY = metrics.Histogram("daap_dacp_forward_duration_seconds", "Round trip time of forwarded DACP commands", ("target", "command"))
+metrics.Gauge("daap_sessions", "Logged in remotes", lambda: len(app[session]))
+metrics.Gauge("daap_dacp_queue_depth", "DACP commands waiting to be sent", lambda: {(target.path,): depth for target, depth in app[dacp_queues].depths().items()}, ("target",))
+metrics.Gauge("daap_uxplay_credentials_staleness_seconds", "Time since the uxplay dacp file was last checked", lambda: {(watcher.path,): watcher.staleness() or 0 for watcher in app[uxplay]}, ("target",))
 
+# word 7 of a decrypted trackpad frame
+TRACKPAD_ARROW_CODES = {
+    10486038: "down",
+    10485938: "up",
+    7209188: "left",
+    13762788: "right",
+}
+TRACKPAD_MIN_FRAME_SIZE = 32
+TRACKPAD_MAX_FRAME_SIZE = 1024
+
+MDNS_MAX_ENTRIES = 256 # remotes/dacp targets remembered at once, least recently used are dropped first
+MDNS_RESOLVE_TIMEOUT = 3.0 # seconds to wait for a service lookup, at most one is in flight per service
 
-@dataclass
-class ClientRemotePairingRecord:
-    fqn: str
-    port: int
-    pairing_guid: str
-    addresses: list[str]
-    name: str
+MAX_DMAP_BODY_SIZE = 64 * 1024 # larger request/response bodies are rejected before being read
+
+# // todo: error handling
 
-@dataclass
-class ClientRemoteControlRecord:
-    fqn: str
-    port: int
-    addresses: list[str]
-    name: str
 
 class AsyncRunner:
     def __init__(self, app) -> None:
         self.aiobrowser: Optional[AsyncServiceBrowser] = None
         self.aiozc: Optional[AsyncZeroconf] = None
         self.app: web.Application = app
-        self.app[remote_pairing_mdns_entries] = {}
-        self.app[remote_control_mdns_entries] = {}
 
     async def async_run(self) -> None:
         self.aiozc = AsyncZeroconf(ip_version=IPVersion.All)
@@ -100,6 +159,7 @@ class AsyncRunner:
         )
 
         self.services = ["_touch-remote._tcp.local.", "_dacp._tcp.local."]
+        self.resolver = ServiceResolver(self.aiozc.zeroconf, self.service_resolved, MDNS_RESOLVE_TIMEOUT, MDNS_MAX_ENTRIES)
 
         self.aiobrowser = AsyncServiceBrowser(
             self.aiozc.zeroconf, self.services, handlers=[self.async_on_service_state_change]
@@ -116,72 +176,53 @@ class AsyncRunner:
         assert self.aiobrowser is not None
         await self.aiozc.async_unregister_service(self.service_info)
         await self.aiobrowser.async_cancel()
+        await self.resolver.close()
         await self.aiozc.async_close()
 
     def delete_entry(self, name, service_type):
-        if service_type == "_touch-remote._tcp.local.":
-            if name in self.app[remote_pairing_mdns_entries]:
-                del self.app[remote_pairing_mdns_entries][name]
-        elif service_type == "_dacp._tcp.local.":
-            if name in self.app[remote_control_mdns_entries]:
-                del self.app[remote_control_mdns_entries][name]
+        self.app[mdns_entries].remove(name)
+        if service_type == "_dacp._tcp.local.":
+            wake_dacp_warmup()
 
     def async_on_service_state_change(self,
         zeroconf: Zeroconf, service_type: str, name: str, state_change: ServiceStateChange
     ) -> None:
-        print(f"Service {name} of type {service_type} state changed: {state_change}")
+        _LOGGER_MDNS.debug("service %s of type %s state changed: %s", name, service_type, state_change)
         if service_type not in self.services: # guard
             return
         if state_change == ServiceStateChange.Removed:
-            self.delete_entry(name, service_type)    
-        else:
-            asyncio.ensure_future(self.async_display_service_info(zeroconf, service_type, name, state_change))
-
+            self.delete_entry(name, service_type)
+        self.resolver.update(service_type, name, state_change)
 
-    async def async_display_service_info(self, zeroconf: Zeroconf, service_type: str, name: str, state_change: ServiceStateChange) -> None:
-        info = AsyncServiceInfo(service_type, name)
-        await info.async_request(zeroconf, 3000)
-        print("Info from zeroconf.get_service_info: %r" % (info))
-        if not info:
-            print("  No info")
-            return
+    def service_resolved(self, service_type: str, name: str, info: AsyncServiceInfo) -> None:
         addresses = [(addr, cast(int, info.port)) for addr in info.parsed_scoped_addresses()]
-        
-        print("  Name: %s" % name)
-        # print("  Addresses: %s" % ", ".join(addresses))
-
-        print(f"  Server: {info.server}")
-        if info.properties:
-            print("  Properties are:")
-            for key, value in info.properties.items():
-                print(f"    {key!r}: {value!r}")
-        else:
-            print("  No properties")
-        
+        ttl = remaining_ttl(self.aiozc.zeroconf, info) # the entry goes when its SRV, TXT or address records do
+        _LOGGER_MDNS.debug("resolved %s on %s for %.0f seconds: %r", name, info.server, ttl, info.properties)
+
         if not info.properties:
-            print("No properties, bad record")
+            _LOGGER_MDNS.info("no properties for %s, bad record", name)
             self.delete_entry(name, service_type)
             return
         if service_type == "_touch-remote._tcp.local.":
             if b'Pair' not in info.properties:
-                print("No Pair key in properites, bad record")
+                _LOGGER_MDNS.info("no Pair key in properties for %s, bad record", name)
                 self.delete_entry(name, service_type)
                 return
             pairing_guid = info.properties[b'Pair'].decode("utf-8")
             pretty_name = info.properties[b'DvNm'].decode("utf-8") if b'DvNm' in info.properties else name.replace("._touch-able._tcp.local.", "")
             record = ClientRemotePairingRecord(name, info.port, pairing_guid, addresses, pretty_name)
-            self.app[remote_pairing_mdns_entries][name] = record
+            self.app[mdns_entries].add(record, ttl)
         elif service_type == "_dacp._tcp.local.":
             pretty_name = name.replace("._dacp._tcp.local.", "")
             record = ClientRemoteControlRecord(name, info.port, addresses, pretty_name)
-            self.app[remote_control_mdns_entries][name] = record
-            print(record)
-
-        print('\n')
+            changed = self.app[mdns_entries].get(name) != record # the resolver also comes back with renewed TTLs
+            self.app[mdns_entries].add(record, ttl)
+            if changed:
+                _LOGGER_MDNS.info("dacp target %s", record)
+                wake_dacp_warmup()
 
 async def mdns_task(app):
     runner = AsyncRunner(app)
-    logging.info("test")
     app[mdns_manager] = asyncio.create_task(runner.async_run())
 
     yield
@@ -189,69 +230,142 @@ async def mdns_task(app):
     app[mdns_manager].cancel()
     await runner.async_close()
 
-class ArrowServerProtocol(asyncio.Protocol):
+_TRACKPAD_WORD = struct.Struct(">I")
+_TRACKPAD_FRAME_STRUCTS: dict[int, struct.Struct] = {}
+
+def decrypt_trackpad_frame(key, data, offset=0, length=32):
+    # a frame is a run of big endian uint32 words, each xored with the session's trackpad key
+    frame_struct = _TRACKPAD_FRAME_STRUCTS.get(length)
+    if frame_struct is None:
+        frame_struct = _TRACKPAD_FRAME_STRUCTS[length] = struct.Struct(f">{length // 4}I")
+    return [key ^ word for word in frame_struct.unpack_from(data, offset)]
+
+class ArrowServerProtocol(asyncio.BufferedProtocol):
     def __init__(self, app):
         super()
         self.app = app
+        self.session = None # bound on the first packet that matches a session, later packets skip the lookup
+        self._buffer = bytearray(TRACKPAD_MAX_FRAME_SIZE * 4)
+        self._view = memoryview(self._buffer)
+        self._filled = 0
 
     def connection_made(self, transport):
         peername = transport.get_extra_info('peername')
-        print('Connection from {}'.format(peername))
+        _LOGGER_ARROWS.info("connection from %s", peername)
         self.transport = transport
 
-    def data_received(self, data):
-        message = binascii.hexlify(data)
-        print('Data received: {!r}'.format(message))
-        start_bytes = data[0:4]
-        using_session = None
-        for session_id, _session in app[session].items():
-            print(f"start_bytes for {session_id}", _session['trackpad_expected_start_bytes'], start_bytes)
-            if start_bytes == _session['trackpad_expected_start_bytes']:
-                print(f"using session {_session}")
-                using_session = _session
+    def get_buffer(self, sizehint):
+        return self._view[self._filled:]
+
+    def buffer_updated(self, nbytes):
+        self._filled += nbytes
+        pos = 0
+        # the first word of every frame decrypts to the frame's length in bytes (32 for the packets we know about)
+        while self._filled - pos >= 4:
+            using_session = self.session
+            if using_session is None or using_session.closed:
+                using_session = self.session = self.app[session].by_start_bytes(bytes(self._view[pos:pos + 4]))
+                if using_session is None:
+                    _LOGGER_ARROWS.debug("trackpad frame matches no session, ignoring")
+                    pos = self._filled
+                    break
+                _LOGGER_ARROWS.debug("using session %s", using_session)
+            key = using_session.trackpad_key
+            length = key ^ _TRACKPAD_WORD.unpack_from(self._buffer, pos)[0]
+            if length < TRACKPAD_MIN_FRAME_SIZE or length > TRACKPAD_MAX_FRAME_SIZE or length % 4:
+                _LOGGER_ARROWS.warning("bad trackpad frame length %d, dropping connection", length)
+                self.transport.close()
+                self._filled = 0
+                return
+            if self._filled - pos < length:
                 break
-        if using_session is None:
-            print("could not find session")
+            self.app[session].touch(using_session)
+            TRACKPAD_FRAMES.inc()
+            self.frame_received(using_session, decrypt_trackpad_frame(key, self._buffer, pos, length))
+            self.transport.write(bytes(self._view[pos:pos + length])) # echo, not needed, could cause issues maybe
+            pos += length
+        if pos:
+            remaining = self._filled - pos
+            self._buffer[:remaining] = self._view[pos:self._filled]
+            self._filled = remaining
+
+    def frame_received(self, using_session, decrypted_message):
+        _LOGGER_ARROWS.debug("decrypted frame %s", decrypted_message)
+        arrow = TRACKPAD_ARROW_CODES.get(decrypted_message[7])
+        if arrow is None:
             return
-        decrypted_message = [using_session['trackpad_key'] ^ int.from_bytes(int(x,16).to_bytes(4, 'big')) for x in wrap(message.decode("utf-8"),8)]
-        print("Decrypted Message: ", decrypted_message)
-        if decrypted_message[7] == 10486038:
-            if "down" in ARROWS_TO_DACP_COMMAND and ARROWS_TO_DACP_COMMAND["down"] is not None:
-                asyncio.ensure_future(make_request_to_uxplay_client(using_session, command=ARROWS_TO_DACP_COMMAND["down"]), loop=self.app.loop)
-            print("ARROW DOWN")
-        elif decrypted_message[7] == 10485938:
-            if "up" in ARROWS_TO_DACP_COMMAND and ARROWS_TO_DACP_COMMAND["up"] is not None:
-                asyncio.ensure_future(make_request_to_uxplay_client(using_session, command=ARROWS_TO_DACP_COMMAND["up"]), loop=self.app.loop)
-            print("ARROW UP")
-        elif decrypted_message[7] == 7209188:
-            if "left" in ARROWS_TO_DACP_COMMAND and ARROWS_TO_DACP_COMMAND["left"] is not None:
-                asyncio.ensure_future(make_request_to_uxplay_client(using_session, command=ARROWS_TO_DACP_COMMAND["left"]), loop=self.app.loop)
-            print("ARROW LEFT")
-        elif decrypted_message[7] == 13762788:
-            if "right" in ARROWS_TO_DACP_COMMAND and ARROWS_TO_DACP_COMMAND["right"] is not None:
-                asyncio.ensure_future(make_request_to_uxplay_client(using_session, command=ARROWS_TO_DACP_COMMAND["right"]), loop=self.app.loop)
-            print("ARROW RIGHT")
-
-
-
-        print('Send: {!r}'.format(message)) # not needed, could cause issues maybe
-        self.transport.write(data)
+        if arrow in ARROWS_TO_DACP_COMMAND and ARROWS_TO_DACP_COMMAND[arrow] is not None:
+            queue_dacp_command(ARROWS_TO_DACP_COMMAND[arrow])
+        _LOGGER_ARROWS.debug("arrow %s", arrow)
 
 async def directonal_controller_task(app):
-    server = await app.loop.create_server(
+    server = await asyncio.get_running_loop().create_server(
         lambda: ArrowServerProtocol(app),
-        ADDRESS, ARROWS_PORT)
+        app[arrows_address], app[arrows_port])
     # server.sockets[0].setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    app[arrows_port] = server.sockets[0].getsockname()[1]
     app[arrow_manager] = asyncio.create_task(server.serve_forever())
 
     yield
     
     
     app[arrow_manager].cancel()
-    await server.close()
+    server.close()
+    await server.wait_closed()
+
+async def session_task(app):
+    app[session_expiry] = asyncio.create_task(app[session].run(SESSION_EXPIRY_INTERVAL))
+
+    yield
+
+    app[session_expiry].cancel()
+
+async def http_client_task(app):
+    connector = TCPConnector(
+        limit=HTTP_CONNECTION_LIMIT,
+        limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+    )
+    app[http_client] = ClientSession(
+        connector=connector,
+        timeout=ClientTimeout(total=HTTP_REQUEST_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+    yield
+
+    await app[http_client].close()
+
+async def device_host(record):
+    # the address of a remote/dacp target that accepts connections: its addresses are raced once and the winner is
+    # reused until a request to it fails (forget) or it is no longer among the record's addresses
+    return await app[address_selector].pick(record.fqn, [address for address, _ in record.addresses], record.port)
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    method = request.method if request.method in HTTP_METRIC_METHODS else "other"
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_LATENCY.labels(route, method).observe(time.perf_counter() - started)
+        HTTP_REQUESTS.labels(route, method, str(status)).inc()
+
+async def get_metrics(request):
+    return web.Response(text=metrics.REGISTRY.render(), content_type="text/plain", charset="utf-8", headers={
+        "X-Content-Type-Options": "nosniff",
+    })
 
 async def get_pairable_remotes(request):
-    return web.Response(body=str(app[remote_pairing_mdns_entries]), status=200)
+    return web.Response(body=str(app[mdns_entries].records(ClientRemotePairingRecord)), status=200)
 
 async def pair_to_remote(request):
     def get_pairing_code(pin_code, pairing_guid):
@@ -270,97 +384,84 @@ async def pair_to_remote(request):
     if 'pin' not in query:
         return web.Response(body="Must include ?pin=", status=400)
     pin_code = query['pin']
-    if fqn not in app[remote_pairing_mdns_entries]:
+    record = app[mdns_entries].get(fqn)
+    if not isinstance(record, ClientRemotePairingRecord):
         return web.Response(body="remote not found", status=404)
-    record = app[remote_pairing_mdns_entries][fqn]
     pairing_code = get_pairing_code(pin_code, record.pairing_guid)
-    logging.info(f"Attempting to pair to {query['fqn']} with pin {pin_code} and pairing guid {record.pairing_guid} -> {pairing_code=}")
+    _LOGGER_PAIRING.info("attempting to pair to %s with pin %s and pairing guid %s -> pairing code %s", fqn, pin_code, record.pairing_guid, pairing_code)
+    host = await device_host(record)
+    if host is None:
+        return web.Response(body="remote unreachable", status=504)
     url = URL("http://127.0.0.1") / "pair" % {'pairingcode': pairing_code, 'servicename': DAAP_SERVER_ID}
-    url = url.with_port(record.port).with_host(record.addresses[0][0])
-    print(url)
-    async with ClientSession() as session:
-        async with session.get(url) as resp:
-            print(resp.status)
-            if resp.status != 200:
-                print(f"Pair request failed with status code {resp.status}")
-                return web.Response(body="Pair request failed with status code {resp.status}", status=403)
-            print("Pair request recieved a response")
-            try:
-                daap_resp = dmap_parser.parse(await resp.read(), tag_definitions.lookup_tag)
-                guid_resp = dmap_parser.first(daap_resp, 'cmpa', 'cmpg')
-                name = dmap_parser.first(daap_resp, 'cmpa', 'cmnm')
-                device = dmap_parser.first(daap_resp, 'cmpa', 'cmty')
-                app[creds][hex(guid_resp)[2:].upper()] = {
-                    'cred': hex(guid_resp)[2:].upper(),
-                    'pin': pin_code,
-                    'record': record,
-                    'name': name,
-                    'device': device,
-                }
-                print("Pair success")
-                print(app[creds][hex(guid_resp)[2:].upper()])
-                return web.Response(body=hex(guid_resp)[2:].upper(), status=200)
-            except:
-                return web.Response(body="Failed to pair", status=500)
+    url = url.with_port(record.port).with_host(host)
+    _LOGGER_PAIRING.debug("pair request %s", url)
+    try:
+        resp = await app[http_client].get(url, timeout=ClientTimeout(total=PAIRING_REQUEST_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+    except (ClientConnectionError, asyncio.TimeoutError) as e:
+        _LOGGER_PAIRING.warning("pair request to %s failed: %r", fqn, e)
+        app[address_selector].forget(record.fqn)
+        return web.Response(body="remote unreachable", status=504)
+    async with resp:
+        if resp.status != 200:
+            _LOGGER_PAIRING.warning("pair request failed with status code %d", resp.status)
+            return web.Response(body="Pair request failed with status code {resp.status}", status=403)
+        try:
+            daap_resp = await dmap_parser.stream_extract(resp.content, tag_definitions.lookup_tag,
+                [('cmpa', 'cmpg'), ('cmpa', 'cmnm'), ('cmpa', 'cmty')], max_size=MAX_DMAP_BODY_SIZE)
+            guid_resp = daap_resp[('cmpa', 'cmpg')]
+            name = daap_resp.get(('cmpa', 'cmnm'))
+            device = daap_resp.get(('cmpa', 'cmty'))
+            pairing = await app[creds].add(guid_resp, name, device, record.fqn)
+            _LOGGER_PAIRING.info("paired with %s", pairing)
+            return web.Response(body=pairing.guid, status=200)
+        except:
+            return web.Response(body="Failed to pair", status=500)
+
+def build_status_response(container, status=200, **uint32_fields):
+    writer = tags.DmapWriter()
+    with writer.container(container):
+        writer.uint32('mstt', status)
+        for name, value in uint32_fields.items():
+            writer.uint32(name, value)
+    return writer.getvalue()
+
+def build_server_info(utc_time=0):
+    writer = tags.DmapWriter()
+    with writer.container('msrv'):
+        writer.uint32("mstt",200)
+        writer.uint32("mpro",231082)
+        writer.string("minm",f"{SERVER_NAME}\x00") # is \x00 needed to signify that string is over??
+        writer.uint32("apro",196620)
+        writer.uint32("aeSV",196618)
+        writer.uint32("mstm",1800)
+        writer.uint32("msdc",1)
+        writer.uint8("aeFP",2)
+        writer.uint8("arFR",100)
+        writer.bool("mslr",True)
+        writer.bool("msal",True)
+        writer.uint32("mstc",utc_time)
+        writer.uint32("msto",4294938496) # possibly some sort of check to mstc?
+        writer.uint32("atSV",65541)
+        writer.uint16("ated",True)
+        writer.uint16("asgr",3)
+        writer.uint32("asse",7341056)
+        writer.uint32("aeSX", 3)
+        writer.uint16('msed', True)
+        writer.uint16('msup', True)
+        writer.uint16('mspi', True)
+        writer.uint16('msex', True)
+        writer.uint16('msbr', True)
+        writer.uint16('msqy', True)
+        writer.uint16('msix', True)
+        writer.uint32('mscu', 101)
+        # msml = 8 byte integer, macaddress?
+    return writer.getvalue()
+
+SERVER_INFO_TEMPLATE = dmap_template.DmapTemplate(build_server_info(), mstc=("msrv", "mstc"))
 
 async def get_server_info(request):
-    print(request.url)
-    mstt = tags.uint32_tag("mstt",200)
-    mpro = tags.uint32_tag("mpro",231082)
-    minm = tags.string_tag("minm",f"{SERVER_NAME}\x00") # is \x00 needed to signify that string is over??
-    apro = tags.uint32_tag("apro",196620)
-    aeSV = tags.uint32_tag("aeSV",196618)
-    mstm = tags.uint32_tag("mstm",1800)
-    msdc = tags.uint32_tag("msdc",1)
-    aeFP = tags.uint8_tag("aeFP",2)
-    arFR = tags.uint8_tag("arFR",100)
-    mslr = tags.bool_tag("mslr",True)
-    msal = tags.bool_tag("msal",True)
-    mstc = tags.uint32_tag("mstc",int(time.time()))
-    msto = tags.uint32_tag("msto",4294938496) # possibly some sort of check to mstc?
-    atSV = tags.uint32_tag("atSV",65541)
-    ated = tags.uint16_tag("ated",True)
-    asgr = tags.uint16_tag("asgr",3)
-    asse = tags.uint32_tag("asse",7341056)
-    aeSX = tags.uint32_tag("aeSX", 3)
-    msed = tags.uint16_tag('msed', True)
-    msup = tags.uint16_tag('msup', True)
-    mspi = tags.uint16_tag('mspi', True)
-    msex = tags.uint16_tag('msex', True)
-    msbr = tags.uint16_tag('msbr', True)
-    msqy = tags.uint16_tag('msqy', True)
-    msix = tags.uint16_tag('msix', True)
-    mscu = tags.uint32_tag('mscu', 101)
-    # msml = 8 byte integer, macaddress?
-
-    msrv = tags.container_tag('msrv', 
-        mstt +
-        mpro +
-        minm +
-        apro +
-        aeSV +
-        mstm +
-        msdc +
-        aeFP +
-        arFR +
-        mslr +
-        msal +
-        mstc +
-        msto +
-        atSV +
-        ated +
-        asgr +
-        asse +
-        aeSX +
-        msed +
-        msup +
-        mspi +
-        msex +
-        msbr +
-        msqy +
-        msix +
-        mscu)
-    return web.Response(body=msrv, status=200, headers={
+    _LOGGER_HTTP.debug("%s", request.url)
+    return web.Response(body=SERVER_INFO_TEMPLATE.render(mstc=int(time.time())), status=200, headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
         "Server": "Darwin",
@@ -368,56 +469,61 @@ async def get_server_info(request):
     
 async def login(request):
     url = request.url
-    print(url)
+    _LOGGER_HTTP.debug("%s", url)
     if 'pairing-guid' not in url.query:
-        return web.Response(body=tags.container_tag('mlog',
-            tags.uint32_tag('mstt', 503)
-        ), status=503, headers={
+        return web.Response(body=build_status_response('mlog', 503), status=503, headers={
+            "Content-Type": "application/x-dmap-tagged",
+            "DAAP-Server": "iTunes/11.1b37 (OS X)",
+            "Server": "Darwin",
+        })
+    pairing_guid = url.query["pairing-guid"]
+    if pairing_guid not in app[creds]:
+        _LOGGER_HTTP.warning("login with unknown pairing guid %s", pairing_guid)
+        return web.Response(body=build_status_response('mlog', 503), status=503, headers={
             "Content-Type": "application/x-dmap-tagged",
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
             "Server": "Darwin",
         })
-    pairing_guid = url.query["pairing-guid"] # // todo: actually check this
-
-    session_id = int.from_bytes(random.randbytes(3),"little")
-    app[session][str(session_id)] = {}
-    print(app[session])
-    return web.Response(body=tags.container_tag('mlog',
-        tags.uint32_tag('mstt', 200) + 
-        tags.uint32_tag('mlid', session_id)
-    ), status="200", headers={
+
+    current_session = app[session].create(pairing_guid)
+    _LOGGER_HTTP.info("login %s", current_session)
+    return web.Response(body=build_status_response('mlog', mlid=current_session.session_id), status="200", headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
         "Server": "Darwin",
     })
 
+def build_ctrl_int():
+    writer = tags.DmapWriter()
+    with writer.container('caci'):
+        writer.uint32('mstt', 200)
+        writer.uint32('mtco', 1)
+        writer.uint32('mrco', 1)
+        with writer.container('mlcl'), writer.container('mlit'):
+            writer.uint32('miid', 1)
+            writer.uint32('cmik', 1)
+            writer.uint32('cmpr', 131074)
+            writer.uint32('capr', 131077)
+            writer.uint32('atCV', 65539)
+            writer.uint32('cmsp', 1)
+            writer.uint32('cmsb', 1)
+            writer.uint32('aeFR', 100)
+            writer.uint32('cmsv', 0)
+            writer.uint32('cmsc', 1)
+            writer.uint32('cass', 0)
+            writer.uint32('caov', 0)
+            writer.uint32('casu', 0)
+            writer.uint32('ceSG', 0)
+            writer.uint32('ceDR', 1)
+            writer.uint32('cmrl', 1)
+            writer.uint32('ceSX', 0b1011)
+    return writer.getvalue()
+
+CTRL_INT_RESPONSE = build_ctrl_int()
+
 async def ctrl_int(request):    
-    print(request.url)
-    daap_resp = tags.container_tag('caci', 
-        tags.uint32_tag('mstt', 200) +
-        tags.uint32_tag('mtco', 1) + 
-        tags.uint32_tag('mrco', 1) + 
-        tags.container_tag('mlcl', tags.container_tag('mlit',
-            tags.uint32_tag('miid', 1) + 
-            tags.uint32_tag('cmik', 1) + 
-            tags.uint32_tag('cmpr', 131074) + 
-            tags.uint32_tag('capr', 131077) + 
-            tags.uint32_tag('atCV', 65539) + 
-            tags.uint32_tag('cmsp', 1) + 
-            tags.uint32_tag('cmsb', 1) +
-            tags.uint32_tag('aeFR', 100) + 
-            tags.uint32_tag('cmsv', 0) + 
-            tags.uint32_tag('cmsc', 1) + 
-            tags.uint32_tag('cass', 0) + 
-            tags.uint32_tag('caov', 0) + 
-            tags.uint32_tag('casu', 0) + 
-            tags.uint32_tag('ceSG', 0) +
-            tags.uint32_tag('ceDR', 1) +
-            tags.uint32_tag('cmrl', 1) +
-            tags.uint32_tag('ceSX', 0b1011)
-        ))  
-    )
-    return web.Response(body=daap_resp, status="200", headers={
+    _LOGGER_HTTP.debug("%s", request.url)
+    return web.Response(body=CTRL_INT_RESPONSE, status="200", headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
         "Server": "Darwin",
@@ -425,24 +531,83 @@ async def ctrl_int(request):
 
 async def play_status_update(request):
     query = request.url.query
-    if 'revision-number' in query and query['revision-number'] == "2":
-        await asyncio.sleep(60) # wait for a while?
-        return web.Response(body=None, status=406, headers={
-            "Content-Type": "application/x-dmap-tagged",
-            "DAAP-Server": "iTunes/11.1b37 (OS X)",
-            "Server": "Darwin",
-        })
-    daap_resp = tags.container_tag('cmst', tags.uint32_tag('mstt', 200) + tags.uint32_tag('cmsr', 2))
-    return web.Response(body=daap_resp, status="200", headers={
+    store = app[play_status]
+    if 'revision-number' in query and query['revision-number'].isdigit():
+        # long poll, answered as soon as the play state moves on from what the remote already has
+        if not await store.wait_for_change(int(query['revision-number']), PLAY_STATUS_TIMEOUT):
+            return web.Response(body=None, status=406, headers={
+                "Content-Type": "application/x-dmap-tagged",
+                "DAAP-Server": "iTunes/11.1b37 (OS X)",
+                "Server": "Darwin",
+            })
+    return web.Response(body=store.response(), status="200", headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
         "Server": "Darwin",
     })
 
+def build_control_prompt_update(miid, prompt_string, title=None):
+    # title is only sent once the trackpad port is known (message type 5), the initial prompt (type 3) carries the certificate instead
+    entries = [
+        ('kKeybMsgKey_SubText', str(SUB_TEXT)),
+        ('kKeybMsgKey_Version', "0"),
+        ('kKeybMsgKey_MaxCharacters', "0"),
+        ('kKeybMsgKey_MinCharacters', "0"),
+        ('kKeybMsgKey_SecureText', "0"),
+        ('kKeybMsgKey_KeyboardType', "0"),
+        ('kKeybMsgKey_String', prompt_string),
+        ('kKeybMsgKey_TextInputType', "0"),
+    ]
+    if title is not None:
+        entries.append(('kKeybMsgKey_Title', title))
+    entries.append(('kKeybMsgKey_MessageType', "3" if title is None else "5"))
+    entries.append(('kKeybMsgKey_SessionID', "9"))
+
+    writer = tags.DmapWriter()
+    with writer.container('cmcp'):
+        writer.uint32('mstt', 200)
+        writer.uint32('miid', miid) #client bumps ?prompt-id to this on next req
+        for key, value in entries:
+            with writer.container('mdcl'):
+                writer.string('cmce', key)
+                writer.string('cmcv', value)
+    return writer.getvalue()
+
+TRACKPAD_CERTIFICATE = """
+            308202C33082022CA003020102020D3333AF080604AF0001AF000001300D06092A864886F70D0101050500307B3\
+            10B300906035504061302555331133011060355040A130A4170706C6520496E632E31263024060355040B131D417\
+            0706C652043657274696669636174696F6E20417574686F72697479312F302D060355040313264170706C6520466\
+            16972506C61792043657274696669636174696F6E20417574686F72697479301E170D30383036303432313330303\
+            15A170D3133303630333231333030315A3066310B300906035504061302555331133011060355040A130A4170706\
+            C6520496E632E31173015060355040B130E4170706C652046616972506C61793129302706035504031320526F736\
+            9652E333333334146303830363034414630303031414630303030303130819F300D06092A864886F70D010101050\
+            003818D0030818902818100DCB60285A26C6B4DE502C49C842A527176C0185B082DCE6C646B55A2640706A6967DE\
+            D8F23C8542E284107A9A22709E1056E934BC3C4F01798BD54391829490665205F296E9BE2595E0419AEDEDA77D44\
+            560CC7AF1E3A72F37EFE9AED51263ED0807FED2CCB723F51D08CD8DFB41F675770671E03C29E29E39C5316105745\
+            3BD0203010001A360305E300E0603551D0F0101FF0404030203B8300C0603551D130101FF04023000301D0603551\
+            D0E041604148F4E4787070D6D84FD1F307932107EBC04CEAC55301F0603551D23041830168014FA0DD411911BE6B\
+            24E1E06499411DD6362075964300D06092A864886F70D010105050003818100153F2F1572D279E5DB1E1776CCA60\
+            3131D7788B598BD1EFC7C1703A40A06C905C762CE1665440912A1BCA88F766861C436543A1A9AB536DEB479BF280\
+            3F383E92A75B7360B47B8197387A6BB4EB82554C6762C06C4E236A890139396F56138C1B69395FCFED8CB74BF94D\
+            91E0E98F6F8276A2B49172847498A5843847ED00FC8""" # magic number?
+
+CONTROL_PROMPT_INITIAL_RESPONSE = build_control_prompt_update(9, TRACKPAD_CERTIFICATE)
+CONTROL_PROMPT_IDLE_RESPONSE = build_status_response('cmcp', miid=0)
+
+def session_prompt_template(current_session, pairing_guid):
+    # compiled once per session (and again only if cmte or the pairing guid change), miid is patched per request
+    key = (current_session.cmte, pairing_guid)
+    cached = current_session.prompt_template
+    if cached is None or cached[0] != key:
+        port_string = str(app[arrows_port] ^ int(current_session.cmte.split(",")[0]))
+        template = dmap_template.DmapTemplate(build_control_prompt_update(0, port_string, pairing_guid), miid=('cmcp', 'miid'))
+        cached = current_session.prompt_template = (key, template)
+    return cached[1]
+
 async def control_prompt_update(request):
     query = request.url.query
     if 'pairing-guid' not in query:
-        logging.warning("pairing guid not given")
+        _LOGGER_HTTP.warning("pairing guid not given")
         return web.Response(body=None, status=503, headers={
             "Content-Type": "application/x-dmap-tagged",
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
@@ -450,109 +615,62 @@ async def control_prompt_update(request):
         })
     pairing_guid = query['pairing-guid']
     if 'session-id' not in query:
-        logging.warning("session id not given")
+        _LOGGER_HTTP.warning("session id not given")
         return web.Response(body=None, status=503, headers={
             "Content-Type": "application/x-dmap-tagged",
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
             "Server": "Darwin",
         })
-    session_id = query['session-id']
-    if session_id not in app[session]:
-        logging.warning("session invalid")
+    current_session = app[session].get(query['session-id'])
+    if current_session is None:
+        _LOGGER_HTTP.warning("session invalid")
         return web.Response(body=None, status=503, headers={
             "Content-Type": "application/x-dmap-tagged",
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
             "Server": "Darwin",
         })
-    current_session = app[session][session_id]
     prompt_id_0 = 'prompt-id' in query and query['prompt-id'] == "0"
     prompt_id = query['prompt-id']
-    if prompt_id_0:
-        logging.info("cont. prpt update w/ prompt-id 0 (initial)")
-    else:
-        logging.info(f"cont. prpt update w/ prompt-id {prompt_id} (cmte is: {current_session['cmte']} -> {ARROWS_PORT ^ int(current_session["cmte"].split(",")[0])})")
-    if (prompt_id_0 is False) and ('cmte' not in current_session):
+    if (prompt_id_0 is False) and (current_session.cmte is None):
         return web.Response(body=None, status=400, headers={
             "Content-Type": "application/x-dmap-tagged",
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
             "Server": "Darwin",
         })
-    logging.info(f'new prompt = {("9" if prompt_id_0 else (str(int(prompt_id) + 1) if prompt_id == "9" else prompt_id))}')
+    _LOGGER_HTTP.debug("cont. prpt update w/ prompt-id %s (cmte is: %s)", prompt_id, current_session.cmte)
     if (int(prompt_id) > 9):
-        logging.info("waiting 10 seconds due to prompt id")
-        await asyncio.sleep(10)
-        return web.Response(body=tags.container_tag('cmcp',
-            tags.uint32_tag('mstt', 200) + tags.uint32_tag('miid', 0)
-        ), status=200, headers={
+        # park until control_prompt_entry has something new for this session, the wait grows while the session stays idle
+        timeout = current_session.prompt_idle_timeout or PROMPT_UPDATE_MIN_TIMEOUT
+        prompt_changed = current_session.prompt_changed
+        _LOGGER_HTTP.debug("waiting up to %s seconds for a new prompt", timeout)
+        try:
+            await asyncio.wait_for(prompt_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            current_session.prompt_idle_timeout = min(timeout * 2, PROMPT_UPDATE_MAX_TIMEOUT)
+            return web.Response(body=CONTROL_PROMPT_IDLE_RESPONSE, status=200, headers={
+                "Content-Type": "application/x-dmap-tagged",
+                "DAAP-Server": "iTunes/11.1b37 (OS X)",
+                "Server": "Darwin",
+            })
+        if current_session.closed:
+            # woken by the session store: logged out, evicted or expired while parked
+            return web.Response(body=None, status=503, headers={
+                "Content-Type": "application/x-dmap-tagged",
+                "DAAP-Server": "iTunes/11.1b37 (OS X)",
+                "Server": "Darwin",
+            })
+        prompt_changed.clear()
+        current_session.prompt_idle_timeout = PROMPT_UPDATE_MIN_TIMEOUT
+        return web.Response(body=session_prompt_template(current_session, pairing_guid).render(miid=int(prompt_id) + 1), status=200, headers={
             "Content-Type": "application/x-dmap-tagged",
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
             "Server": "Darwin",
         })
-    daap_resp = tags.container_tag('cmcp',
-        tags.uint32_tag('mstt', 200) +
-        tags.uint32_tag('miid', (9 if prompt_id_0 else (int(prompt_id) + 1 if prompt_id == "9" else int(prompt_id)))) + #client bumps ?prompt-id to this on next req
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_SubText') +
-            tags.string_tag('cmcv',  str(SUB_TEXT))
-        ) + 
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_Version') +
-            tags.string_tag('cmcv', "0")
-        ) +
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_MaxCharacters') +
-            tags.string_tag('cmcv', "0")
-        ) + 
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_MinCharacters') +
-            tags.string_tag('cmcv', "0")
-        ) + 
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_SecureText') +
-            tags.string_tag('cmcv', "0")
-        ) + 
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_KeyboardType') +
-            tags.string_tag('cmcv', "0")
-        ) + 
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_String') +
-            tags.string_tag('cmcv', """
-            308202C33082022CA003020102020D3333AF080604AF0001AF000001300D06092A864886F70D0101050500307B3\
-            10B300906035504061302555331133011060355040A130A4170706C6520496E632E31263024060355040B131D417\
-            0706C652043657274696669636174696F6E20417574686F72697479312F302D060355040313264170706C6520466\
-            16972506C61792043657274696669636174696F6E20417574686F72697479301E170D30383036303432313330303\
-            15A170D3133303630333231333030315A3066310B300906035504061302555331133011060355040A130A4170706\
-            C6520496E632E31173015060355040B130E4170706C652046616972506C61793129302706035504031320526F736\
-            9652E333333334146303830363034414630303031414630303030303130819F300D06092A864886F70D010101050\
-            003818D0030818902818100DCB60285A26C6B4DE502C49C842A527176C0185B082DCE6C646B55A2640706A6967DE\
-            D8F23C8542E284107A9A22709E1056E934BC3C4F01798BD54391829490665205F296E9BE2595E0419AEDEDA77D44\
-            560CC7AF1E3A72F37EFE9AED51263ED0807FED2CCB723F51D08CD8DFB41F675770671E03C29E29E39C5316105745\
-            3BD0203010001A360305E300E0603551D0F0101FF0404030203B8300C0603551D130101FF04023000301D0603551\
-            D0E041604148F4E4787070D6D84FD1F307932107EBC04CEAC55301F0603551D23041830168014FA0DD411911BE6B\
-            24E1E06499411DD6362075964300D06092A864886F70D010105050003818100153F2F1572D279E5DB1E1776CCA60\
-            3131D7788B598BD1EFC7C1703A40A06C905C762CE1665440912A1BCA88F766861C436543A1A9AB536DEB479BF280\
-            3F383E92A75B7360B47B8197387A6BB4EB82554C6762C06C4E236A890139396F56138C1B69395FCFED8CB74BF94D\
-            91E0E98F6F8276A2B49172847498A5843847ED00FC8""" # magic number?
-            if prompt_id_0 else str(ARROWS_PORT ^ int(current_session["cmte"].split(",")[0])))
-        ) +
-                tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_TextInputType') +
-            tags.string_tag('cmcv', "0")
-        ) + 
-        (b'' if prompt_id_0 else tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_Title') +
-            tags.string_tag('cmcv', pairing_guid)
-        )) +
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_MessageType') +
-            tags.string_tag('cmcv', "3" if prompt_id_0 else "5")
-        ) + 
-        tags.container_tag('mdcl', 
-            tags.string_tag('cmce', 'kKeybMsgKey_SessionID') +
-            tags.string_tag('cmcv', "9"
-        ))
-    )
+    if prompt_id_0:
+        daap_resp = CONTROL_PROMPT_INITIAL_RESPONSE
+    else:
+        current_session.prompt_changed.clear() # the remote has this prompt now, a parked request must not hand it out again
+        daap_resp = session_prompt_template(current_session, pairing_guid).render(miid=(int(prompt_id) + 1 if prompt_id == "9" else int(prompt_id)))
     return web.Response(body=daap_resp, status="200", headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
@@ -560,81 +678,229 @@ async def control_prompt_update(request):
     })
 
 async def logout(request):
-    print(request.url)
+    _LOGGER_HTTP.debug("%s", request.url)
     query = request.url.query
     if 'session-id' in query:
-        if query['session-id'] in app[session]:
-            del app[session][query['session-id']]
+        app[session].remove(query['session-id'])
     return web.Response(body=None, status="204", headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
         "Server": "Darwin",
     })
 
+PLAYQUEUE_CONTENTS_RESPONSE = binascii.unhexlify("636551520000000c6d73747400000004000000c8")
+
 async def get_playqueue_contents(request):
-    print(request.url)
+    _LOGGER_HTTP.debug("%s", request.url)
     await request.read()
-    daap_resp = binascii.unhexlify("636551520000000c6d73747400000004000000c8")
-    return web.Response(body=daap_resp, status="200", headers={
+    return web.Response(body=PLAYQUEUE_CONTENTS_RESPONSE, status="200", headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
         "Server": "Darwin",
     })
 
-async def update_uxplay_dacp_data():
-    try:
-        async with aiofiles.open("./.uxplay.dacp", "r") as file:
-            lines = await file.readlines()
-            lines = [line.strip() for line in lines]
-            if len(lines) != 2:
-                raise Exception("uxplay dacp had bad data!")
-            uxplay_data = {
-                'dacp_id': lines[0],
-                'active_remote': lines[1],
-            }
-            app[uxplay] = uxplay_data
-
-            
-    except Exception as e:
-        app[uxplay] = None
-        print("Error in reading uxplay file: ", e)
-async def make_request_to_uxplay_client(current_session, command, retry=True):
-    # find client record]
-    uxplay_data = app[uxplay]
+async def watch_uxplay_credentials(watchers):
+    await asyncio.gather(*(watcher.run() for watcher in watchers))
+
+async def uxplay_credentials_task(app):
+    watchers = app[uxplay]
+    await asyncio.gather(*(watcher.refresh() for watcher in watchers))
+    app[uxplay_watcher] = asyncio.create_task(watch_uxplay_credentials(watchers))
+
+    yield
+
+    app[uxplay_watcher].cancel()
+
+async def make_request_to_uxplay_client(watcher, command, retry=True):
+    # send one command to the uxplay client behind one dacp file, returns True if the target accepted it
+    uxplay_data = watcher.snapshot
     if (uxplay_data is None):
-        if (retry is True):
-            print("no data for dacp client, loading file!")
-            await update_uxplay_dacp_data()
-            await make_request_to_uxplay_client(current_session, command, retry=False)
-        else:
-            print("could not get dacp client data!")
-        return
-    current_record: Optional[ClientRemoteControlRecord] = None
-    for name, record in app[remote_control_mdns_entries].items():
-        print(record, uxplay_data["dacp_id"])
-        if uxplay_data["dacp_id"] in record.fqn:
-            current_record = record
+        if (retry is True) and await watcher.refresh():
+            _LOGGER_DACP.info("%s changed, retrying", watcher.path)
+            return await make_request_to_uxplay_client(watcher, command, retry=False)
+        _LOGGER_DACP.warning("no dacp credentials in %s, dropping %s", watcher.path, command)
+        DACP_FORWARDS.labels(watcher.path, command, "no_credentials").inc()
+        return False
+    current_record = app[mdns_entries].by_dacp_id(uxplay_data.dacp_id)
     if current_record is None:
-        print("could not find dacp client")
-        if retry is True:
-            print("reloading uxplay file!")
-            await update_uxplay_dacp_data()
-            await make_request_to_uxplay_client(current_session, command, retry=False)
-        return
-    print("Using record", current_record)
+        if (retry is True) and await watcher.refresh():
+            _LOGGER_DACP.info("%s changed, retrying", watcher.path)
+            return await make_request_to_uxplay_client(watcher, command, retry=False)
+        _LOGGER_DACP.warning("no dacp target for %s, dropping %s", uxplay_data.dacp_id, command)
+        DACP_FORWARDS.labels(watcher.path, command, "no_target").inc()
+        return False
+    host = await device_host(current_record)
+    if host is None:
+        _LOGGER_DACP.warning("%s is unreachable, dropping %s", current_record.fqn, command)
+        DACP_FORWARDS.labels(watcher.path, command, "unreachable").inc()
+        return False
     url = URL("http://127.0.0.1") / "ctrl-int" / "1" / command
-    url = url.with_port(current_record.port).with_host(record.addresses[0][0])
-    print(url)
-    async with ClientSession() as session:
-        async with session.get(url, headers={
-            "Active-Remote": uxplay_data["active_remote"]
+    url = url.with_port(current_record.port).with_host(host)
+    _LOGGER_DACP.debug("sending %s to %s", url, current_record.fqn)
+    started = time.perf_counter()
+    try:
+        async with app[http_client].get(url, headers={
+            "Active-Remote": uxplay_data.active_remote
+        }, timeout=ClientTimeout(total=DACP_COMMAND_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)) as resp:
+            await resp.read() # drain so the connection goes back to the pool
+            _LOGGER_DACP.debug("%s -> %d", command, resp.status)
+    except (ClientError, asyncio.TimeoutError) as e:
+        DACP_FORWARD_LATENCY.labels(watcher.path, command).observe(time.perf_counter() - started)
+        DACP_FORWARDS.labels(watcher.path, command, type(e).__name__).inc()
+        _LOGGER_DACP.warning("sending %s to %s failed: %r", command, current_record.fqn, e)
+        if isinstance(e, (ClientConnectionError, asyncio.TimeoutError)):
+            app[address_selector].forget(current_record.fqn) # race the addresses again next time
+        return False
+    DACP_FORWARD_LATENCY.labels(watcher.path, command).observe(time.perf_counter() - started)
+    DACP_FORWARDS.labels(watcher.path, command, str(resp.status)).inc()
+    if resp.status in (200, 204):
+        return True
+    if retry is True:
+        # some issue with credentials, only worth retrying if uxplay has written new ones
+        if await watcher.refresh():
+            _LOGGER_DACP.info("%s changed (bad credentials?), retrying", watcher.path)
+            return await make_request_to_uxplay_client(watcher, command, retry=False)
+    _LOGGER_DACP.warning("%s refused %s with status code %d", current_record.fqn, command, resp.status)
+    return False
+
+def wake_dacp_warmup(*_):
+    app[dacp_warmup_wakeup].set()
+
+async def check_dacp_target(app, watcher, credentials, record):
+    # a harmless request that fails with bad credentials, answered right away as revision 1 is never current
+    host = await device_host(record)
+    if host is None:
+        DACP_WARMUPS.labels(watcher.path, "unreachable").inc()
+        return False
+    url = URL("http://127.0.0.1") / "ctrl-int" / "1" / "playstatusupdate" % {'revision-number': 1}
+    url = url.with_port(record.port).with_host(host)
+    try:
+        async with app[http_client].get(url, headers={
+            "Active-Remote": credentials.active_remote
         }) as resp:
-            print(resp)
-            if (resp.status != 200) and (retry is True):
-                # some issue with credentials, reload
-                print("reloading uxplay file! (for bad credentials?)")
-                await update_uxplay_dacp_data()
-                await make_request_to_uxplay_client(current_session, command, retry=False)
+            await resp.read() # drain so the connection stays open in the pool
+    except (ClientError, asyncio.TimeoutError) as e:
+        _LOGGER_DACP.warning("could not reach dacp target %s: %r", record.fqn, e)
+        DACP_WARMUPS.labels(watcher.path, type(e).__name__).inc()
+        if isinstance(e, (ClientConnectionError, asyncio.TimeoutError)):
+            app[address_selector].forget(record.fqn)
+        return False
+    DACP_WARMUPS.labels(watcher.path, str(resp.status)).inc()
+    if resp.status not in (200, 204):
+        _LOGGER_DACP.warning("dacp target %s refused the uxplay credentials (status %d)", record.fqn, resp.status)
+        await watcher.refresh() # wakes us up again if uxplay has written new ones
+        return False
+    return True
+
+async def warm_dacp_target(app, watcher, warmed):
+    credentials = watcher.snapshot
+    record = None if credentials is None else app[mdns_entries].by_dacp_id(credentials.dacp_id)
+    target = None if record is None else (credentials, tuple(record.addresses), record.port)
+    if target is not None and target != warmed.get(watcher):
+        _LOGGER_DACP.info("warming up dacp target %s", record.fqn)
+    warmed[watcher] = target if target is not None and await check_dacp_target(app, watcher, credentials, record) else None
+    return target is not None
+
+async def warm_dacp_targets(app):
+    # resolve the targets and open a verified connection to each whenever credentials or records change, and keep
+    # those connections alive, so the first command after startup or a reconnect goes out over a warm path
+    wakeup = app[dacp_warmup_wakeup]
+    warmed = {}
+    while True:
+        wakeup.clear()
+        found = await asyncio.gather(*(warm_dacp_target(app, watcher, warmed) for watcher in app[uxplay]))
+        try:
+            await asyncio.wait_for(wakeup.wait(), DACP_WARMUP_INTERVAL if any(found) else None)
+        except asyncio.TimeoutError:
+            pass
+
+async def dacp_warmup_task(app):
+    app[dacp_warmer] = asyncio.create_task(warm_dacp_targets(app))
+
+    yield
+
+    app[dacp_warmer].cancel()
+
+async def poll_now_playing(app):
+    # one long poll against the (first) uxplay client's playstatusupdate, its state is fanned out to every remote through app[play_status]
+    revision = 1
+    target = None
+    backoff = NOW_PLAYING_BACKOFF
+    while True:
+        credentials = app[uxplay][0].snapshot if app[uxplay] else None
+        record = None if credentials is None else app[mdns_entries].by_dacp_id(credentials.dacp_id)
+        if record is None:
+            await asyncio.sleep(NOW_PLAYING_RETRY_INTERVAL)
+            continue
+        if target != (credentials, record.fqn):
+            target = (credentials, record.fqn)
+            revision = 1
+        host = await device_host(record)
+        if host is None:
+            await asyncio.sleep(NOW_PLAYING_RETRY_INTERVAL)
+            continue
+        url = URL("http://127.0.0.1") / "ctrl-int" / "1" / "playstatusupdate" % {'revision-number': revision}
+        url = url.with_port(record.port).with_host(host)
+        started = time.monotonic()
+        try:
+            async with app[http_client].get(url, headers={
+                "Active-Remote": credentials.active_remote
+            }, timeout=ClientTimeout(total=None, connect=HTTP_CONNECT_TIMEOUT, sock_read=NOW_PLAYING_POLL_TIMEOUT)) as resp:
+                if resp.status == 200:
+                    new_revision, changes = await read_play_status(resp.content, MAX_DMAP_BODY_SIZE)
+                else:
+                    await resp.read()
+                    if resp.status != 204: # 204: nothing changed before the target gave up waiting
+                        _LOGGER_DACP.warning("now playing poll failed with status code %d", resp.status)
+                        await asyncio.sleep(NOW_PLAYING_RETRY_INTERVAL)
+                        continue
+                    new_revision, changes = None, None
+        except (ClientError, asyncio.TimeoutError, ValueError) as e:
+            _LOGGER_DACP.warning("now playing poll failed: %r", e)
+            if isinstance(e, ClientConnectionError):
+                app[address_selector].forget(record.fqn)
+            await asyncio.sleep(NOW_PLAYING_RETRY_INTERVAL)
+            continue
+        if changes is not None:
+            app[play_status].update(**changes)
+        if new_revision is not None and new_revision != revision:
+            revision = new_revision
+            backoff = NOW_PLAYING_BACKOFF
+            continue
+        # no new revision: fine after a held long poll, but a target answering at once (or without cmsr) must not
+        # have us polling it in a tight loop
+        wait = backoff - (time.monotonic() - started)
+        if wait > 0:
+            _LOGGER_DACP.debug("now playing poll answered without news, next one in %.1f seconds", wait)
+            await asyncio.sleep(wait)
+            backoff = min(backoff * 2, NOW_PLAYING_RETRY_INTERVAL)
+        else:
+            backoff = NOW_PLAYING_BACKOFF
+
+async def now_playing_task(app):
+    app[now_playing_poller] = asyncio.create_task(poll_now_playing(app))
+
+    yield
+
+    app[now_playing_poller].cancel()
+
+def queue_dacp_command(command, targets=None):
+    # fans out to every uxplay client (or the given watchers): each has its own queue and worker sending in order, so
+    # targets receive the command concurrently and a slow or unreachable one only holds up its own queue
+    for watcher in (app[uxplay] if targets is None else targets):
+        app[dacp_queues].put(watcher, command)
+
+async def dacp_queue_task(app):
+    app[dacp_queues] = dacp_queue.CommandQueues(
+        make_request_to_uxplay_client,
+        max_size=DACP_QUEUE_MAX_SIZE,
+        max_age=DACP_QUEUE_MAX_AGE,
+        max_repeat=DACP_QUEUE_MAX_REPEAT,
+    )
+
+    yield
+
+    await app[dacp_queues].close()
 
 async def control_prompt_entry(request):
     query = request.url.query
@@ -644,56 +910,100 @@ async def control_prompt_entry(request):
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
             "Server": "Darwin",
         })
-    session_id = query['session-id']
-    if session_id not in app[session]:
+    current_session = app[session].get(query['session-id'])
+    if current_session is None:
         return web.Response(body=None, status=503, headers={
             "Content-Type": "application/x-dmap-tagged",
             "DAAP-Server": "iTunes/11.1b37 (OS X)",
             "Server": "Darwin",
         })
-    current_session = app[session][session_id]
-    daap_resp = dmap_parser.parse(await request.read(), tag_definitions.lookup_tag)
-    cmbe_resp = dmap_parser.first(daap_resp, 'cmbe')
-    print(f"Control Prompt Entry cmbe {cmbe_resp}")
+    if request.content_length is not None and request.content_length > MAX_DMAP_BODY_SIZE:
+        return web.Response(body=None, status=413, headers={
+            "Content-Type": "application/x-dmap-tagged",
+            "DAAP-Server": "iTunes/11.1b37 (OS X)",
+            "Server": "Darwin",
+        })
+    try:
+        daap_resp = await dmap_parser.stream_extract(request.content, tag_definitions.lookup_tag,
+            [('cmbe',), ('cmte',)], max_size=MAX_DMAP_BODY_SIZE)
+    except ValueError as e:
+        _LOGGER_HTTP.warning("bad control prompt entry body: %s", e)
+        return web.Response(body=None, status=400, headers={
+            "Content-Type": "application/x-dmap-tagged",
+            "DAAP-Server": "iTunes/11.1b37 (OS X)",
+            "Server": "Darwin",
+        })
+    cmbe_resp = daap_resp.get(('cmbe',))
+    _LOGGER_HTTP.debug("control prompt entry cmbe %s", cmbe_resp)
     if cmbe_resp == "DRPortInfoRequest":
-        cmte_resp = dmap_parser.first(daap_resp, 'cmte')
-        current_session["cmte"] = cmte_resp
-        current_session["trackpad_key"] = int.from_bytes((SUB_TEXT ^ int(cmte_resp.split(",")[0])).to_bytes(4, 'little'))
-        current_session["trackpad_expected_start_bytes"] = (32 ^ current_session["trackpad_key"]).to_bytes(4)
-        print(current_session)
-        print(f"DRPortInfoRequest cmte {cmte_resp}")
+        cmte_resp = daap_resp.get(('cmte',))
+        try:
+            trackpad_key = int.from_bytes((SUB_TEXT ^ int(cmte_resp.split(",")[0])).to_bytes(4, 'little'))
+        except (AttributeError, ValueError, OverflowError):
+            _LOGGER_HTTP.warning("bad DRPortInfoRequest cmte %r", cmte_resp)
+            return web.Response(body=None, status=400, headers={
+                "Content-Type": "application/x-dmap-tagged",
+                "DAAP-Server": "iTunes/11.1b37 (OS X)",
+                "Server": "Darwin",
+            })
+        app[session].set_trackpad(current_session, cmte_resp, trackpad_key, (32 ^ trackpad_key).to_bytes(4))
+        current_session.prompt_changed.set()
+        _LOGGER_HTTP.info("DRPortInfoRequest cmte %s for %s", cmte_resp, current_session)
     elif cmbe_resp in CMBE_COMMAND_TO_DACP_COMMAND and CMBE_COMMAND_TO_DACP_COMMAND[cmbe_resp] is not None:
-        await make_request_to_uxplay_client(current_session, command=CMBE_COMMAND_TO_DACP_COMMAND[cmbe_resp])
+        queue_dacp_command(CMBE_COMMAND_TO_DACP_COMMAND[cmbe_resp])
         
 
-    return web.Response(body=tags.container_tag('ceQE', tags.uint32_tag('mstt', 200)), status=204, headers={
+    return web.Response(body=build_status_response('ceQE'), status=204, headers={
         "Content-Type": "application/x-dmap-tagged",
         "DAAP-Server": "iTunes/11.1b37 (OS X)",
         "Server": "Darwin",
     })
 
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
-    
-    app = web.Application()
-    mdns_manager = web.AppKey('mdns_manager', asyncio.Task[None])
-    remote_pairing_mdns_entries = web.AppKey('remote_pairing_mdns_entries', dict[str, ClientRemotePairingRecord])
-    remote_control_mdns_entries = web.AppKey('remote_control_entries', dict[str, ClientRemoteControlRecord])
-    
+mdns_manager = web.AppKey('mdns_manager', asyncio.Task[None])
+mdns_entries = web.AppKey('mdns_entries', MdnsRegistry)
+creds = web.AppKey('creds', PairingStore)
+session = web.AppKey('session', SessionStore)
+session_expiry = web.AppKey('session_expiry', asyncio.Task[None])
+arrow_manager = web.AppKey('arrow_manager', asyncio.Task[None])
+arrows_address = web.AppKey('arrows_address', str)
+arrows_port = web.AppKey('arrows_port', int)
+uxplay = web.AppKey('uxplay', list[uxplay_credentials.CredentialWatcher])
+uxplay_watcher = web.AppKey('uxplay_watcher', asyncio.Task[None])
+http_client = web.AppKey('http_client', ClientSession)
+dacp_queues = web.AppKey('dacp_queues', dacp_queue.CommandQueues)
+dacp_warmup_wakeup = web.AppKey('dacp_warmup_wakeup', asyncio.Event)
+dacp_warmer = web.AppKey('dacp_warmer', asyncio.Task[None])
+play_status = web.AppKey('play_status', PlayStatusStore)
+now_playing_poller = web.AppKey('now_playing_poller', asyncio.Task[None])
+address_selector = web.AppKey('address_selector', AddressSelector)
+
+app: Optional[web.Application] = None
 
-    creds = web.AppKey('creds', dict)
-    session = web.AppKey('session', dict)
-    arrow_manager = web.AppKey('arrow_manager', asyncio.Task[None])
-    uxplay = web.AppKey('uxplay', dict)
-
-    app[creds] = {}
-    app[session] = {}
-    # app[uxplay] = {
-    #     "active_remote": None,
-    #     "dacp_id": None,
-    # }
-    app[uxplay] = None
-    app.cleanup_ctx.append(mdns_task)
+def make_app(pairing_store_file=PAIRING_STORE_FILE, uxplay_dacp_files=UXPLAY_DACP_FILES,
+             address=ADDRESS, port=ARROWS_PORT, max_sessions=MAX_SESSIONS, advertise=True):
+    # handlers reach the app through this global, so there is one app per process.
+    # port may be 0 to let the OS pick the arrows port, app[arrows_port] holds the real one once started
+    global app
+    app = web.Application(middlewares=[metrics_middleware])
+    app[arrows_address] = address
+    app[arrows_port] = port
+    app[mdns_entries] = MdnsRegistry(MDNS_MAX_ENTRIES)
+    app[address_selector] = AddressSelector(HAPPY_EYEBALLS_DELAY, HTTP_CONNECT_TIMEOUT, MDNS_MAX_ENTRIES)
+    app[creds] = PairingStore(pairing_store_file)
+    app[creds].load()
+    app[session] = SessionStore(max_sessions, SESSION_IDLE_TIMEOUT, on_remove=lambda removed: removed.prompt_changed.set())
+    app[play_status] = PlayStatusStore()
+    app[dacp_warmup_wakeup] = asyncio.Event()
+    app[uxplay] = [uxplay_credentials.CredentialWatcher(path, UXPLAY_DACP_POLL_INTERVAL, on_change=wake_dacp_warmup)
+                   for path in uxplay_dacp_files]
+    app.cleanup_ctx.append(session_task)
+    app.cleanup_ctx.append(http_client_task)
+    app.cleanup_ctx.append(uxplay_credentials_task)
+    app.cleanup_ctx.append(dacp_queue_task)
+    app.cleanup_ctx.append(dacp_warmup_task)
+    app.cleanup_ctx.append(now_playing_task)
+    if advertise:
+        app.cleanup_ctx.append(mdns_task)
     app.cleanup_ctx.append(directonal_controller_task)
     app.add_routes([
         web.get('/remotes', get_pairable_remotes),
@@ -706,6 +1016,13 @@ if __name__ == '__main__':
         web.get('/controlpromptupdate', control_prompt_update),
         web.get('/logout', logout),
         web.post('/playqueue-contents', get_playqueue_contents),
+        web.get('/metrics', get_metrics),
     ])
-    web.run_app(app, port=SERVER_PORT)
+    return app
 
+if __name__ == '__main__':
+    log_listener = log_setup.setup_logging(LOG_LEVEL, LOG_LEVELS)
+    try:
+        web.run_app(make_app(), port=SERVER_PORT)
+    finally:
+        log_listener.stop()
@@ -0,0 +1,137 @@
+"""Ordered, bounded queues of DACP commands, one worker per target.
+
+Commands for a target are sent one at a time in the order they were queued.
+While they wait, repeated volume steps are merged into a single entry (and
+opposite steps cancel out), two pending toggles of the same kind cancel each
+other, and when the queue is full or a command has waited too long the oldest
+commands are dropped, so a held or mashed button can't pile up requests against
+a slow device.
+"""
+
+import asyncio
+from collections import deque
+import logging
+import time
+from typing import Awaitable, Callable, Hashable, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+# step commands that can be merged, and the step that undoes each of them
+STEP_COMMANDS = {
+    "volumeup": "volumedown",
+    "volumedown": "volumeup",
+}
+# commands where sending two in a row is the same as sending none
+TOGGLE_COMMANDS = {"playpause", "mutetoggle"}
+
+
+class _Entry:
+    __slots__ = ("command", "count", "queued_at")
+
+    def __init__(self, command: str, queued_at: float) -> None:
+        self.command = command
+        self.count = 1
+        self.queued_at = queued_at
+
+
+class CommandQueue:
+    """Commands for one target.
+
+    send returning False (or raising) counts the command as failed, anything
+    else as sent.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable[Optional[bool]]], max_size: int = 16,
+                 max_age: float = 2.0, max_repeat: int = 5) -> None:
+        self.send = send
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_repeat = max_repeat
+        self.sent = 0
+        self.failed = 0
+        self.merged = 0
+        self.dropped = 0
+        self._pending: deque[_Entry] = deque()
+        self._wakeup = asyncio.Event()
+
+    @property
+    def depth(self) -> int:
+        """Number of commands waiting to be sent."""
+        return sum(entry.count for entry in self._pending)
+
+    def put(self, command: str) -> None:
+        last = self._pending[-1] if self._pending else None
+        if last is not None:
+            if last.command == command and command in STEP_COMMANDS:
+                if last.count < self.max_repeat:
+                    last.count += 1
+                    self.merged += 1
+                else:
+                    self.dropped += 1
+                return
+            if STEP_COMMANDS.get(last.command) == command or (last.command == command and command in TOGGLE_COMMANDS):
+                last.count -= 1
+                if last.count == 0:
+                    self._pending.pop()
+                self.merged += 2
+                return
+        if len(self._pending) >= self.max_size:
+            stale = self._pending.popleft()
+            self.dropped += stale.count
+            _LOGGER.warning("dacp queue full, dropping %s x%d", stale.command, stale.count)
+        self._pending.append(_Entry(command, time.monotonic()))
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        """Send queued commands in order until cancelled."""
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            entry = self._pending.popleft()
+            if time.monotonic() - entry.queued_at > self.max_age:
+                self.dropped += entry.count
+                _LOGGER.warning("dropping stale dacp command %s x%d", entry.command, entry.count)
+                continue
+            for _ in range(entry.count):
+                try:
+                    sent = await self.send(entry.command)
+                except Exception:
+                    _LOGGER.exception("sending dacp command %s failed", entry.command)
+                    sent = False
+                if sent is False:
+                    self.failed += 1
+                else:
+                    self.sent += 1
+
+
+class CommandQueues:
+    """A CommandQueue and worker task per target, created on first use."""
+
+    def __init__(self, send: Callable[[Hashable, str], Awaitable[Optional[bool]]], **queue_options) -> None:
+        self.send = send
+        self.queue_options = queue_options
+        self._queues: dict[Hashable, CommandQueue] = {}
+        self._workers: dict[Hashable, asyncio.Task] = {}
+
+    def get(self, target: Hashable) -> CommandQueue:
+        queue = self._queues.get(target)
+        if queue is None:
+            queue = self._queues[target] = CommandQueue(
+                lambda command: self.send(target, command), **self.queue_options)
+            self._workers[target] = asyncio.create_task(queue.run())
+        return queue
+
+    def put(self, target: Hashable, command: str) -> None:
+        self.get(target).put(command)
+
+    def depths(self) -> dict[Hashable, int]:
+        return {target: queue.depth for target, queue in self._queues.items()}
+
+    async def close(self) -> None:
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._queues.clear()
+        self._workers.clear()
@@ -19,10 +19,12 @@ a four byte big endian unsigned int as length and the data as data. So:
   +---------------+------------------+--------------------+
 """
 
+import asyncio
 from collections import namedtuple
+import struct
 
 
-from tags import read_bplist, read_str, read_uint
+from tags import read_bplist
 
 
 class DmapTag(namedtuple("DmapTag", ["type", "name"])):
@@ -39,40 +41,162 @@ class DmapTag(namedtuple("DmapTag", ["type", "name"])):
         return f"[{type_name}, {self.name}]"
 
 
-def _parse(data, data_len, tag_lookup, pos, ctx=None):
-    if ctx is None:
-        ctx = []
-    if pos >= data_len:
-        return ctx
+_HEADER = struct.Struct(">4sI")
+_HEADER_SIZE = _HEADER.size
+_SKIP_CHUNK_SIZE = 65536
 
-    f_name = read_str(data, pos, 4)
-    f_len = read_uint(data, pos + 4, 4)
-    pos += 8
+# Decoded tag names, keyed on their raw code. Bounded so that bodies full of
+# garbage tags cannot grow it without limit.
+_NAME_CACHE = {}
+_NAME_CACHE_SIZE = 1024
 
-    tag = tag_lookup(f_name)
-    if tag.type == "container":
-        ctx.append({f_name: _parse(data, pos + f_len, tag_lookup, pos, ctx=[])})
-    else:
-        ctx.append({f_name: tag.type(data, pos, f_len)})
 
-    return _parse(data, data_len, tag_lookup, pos + f_len, ctx)
+def _decode_name(code):
+    name = code.decode("utf-8")
+    if len(_NAME_CACHE) < _NAME_CACHE_SIZE:
+        _NAME_CACHE[code] = name
+    return name
 
 
 def parse(data, tag_lookup):
-    """Parse raw DAAP data and returns it as a python object."""
-    return _parse(data, len(data), tag_lookup, 0, [])
+    """Parse raw DAAP data and returns it as a python object.
+
+    tag_lookup is called with the raw 4 byte tag code and must return a DmapTag.
+
+    Parsing is done iteratively over a memoryview of the data, so flat lists of
+    any size and deeply nested containers are handled without recursion and
+    without copying the payload for each tag.
+    """
+    view = memoryview(data)
+    unpack_header = _HEADER.unpack_from
+    _names = _NAME_CACHE
+
+    root = []
+    ctx = root
+    end = len(view)
+    stack = []
+    pos = 0
+    while True:
+        while pos >= end:
+            if not stack:
+                return root
+            ctx, end = stack.pop()
+
+        if pos + _HEADER_SIZE > end:
+            raise ValueError(f"truncated DMAP header at offset {pos}")
+        f_code, f_len = unpack_header(view, pos)
+        pos += _HEADER_SIZE
+        if pos + f_len > end:
+            raise ValueError(
+                f"DMAP tag {f_code!r} at offset {pos - _HEADER_SIZE} overruns its parent"
+            )
+
+        tag = tag_lookup(f_code)
+        f_name = _names.get(f_code)
+        if f_name is None:
+            f_name = _decode_name(f_code)
+        if tag.type == "container":
+            children = []
+            ctx.append({f_name: children})
+            stack.append((ctx, end))
+            ctx = children
+            end = pos + f_len
+        else:
+            ctx.append({f_name: tag.type(view, pos, f_len)})
+            pos += f_len
+
+
+async def _read_payload(reader, length):
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError as ex:
+        raise ValueError("truncated DMAP payload") from ex
+
+
+async def _skip(reader, length):
+    while length > 0:
+        chunk = min(length, _SKIP_CHUNK_SIZE)
+        await _read_payload(reader, chunk)
+        length -= chunk
+
+
+async def stream_extract(reader, tag_lookup, paths, max_size=None):
+    """Extract selected values from DMAP data read incrementally from a stream.
+
+    reader must provide an async readexactly() (e.g. aiohttp's StreamReader) and
+    paths is an iterable of tag paths such as ("cmpa", "cmpg"). Only containers
+    that lead to a wanted path are descended into, everything else is skipped
+    without being kept. Reading stops once every path has been found.
+
+    Returns a dict mapping each path that was found to its first value. If
+    max_size is given, ValueError is raised as soon as a tag would take the
+    total amount of data past it, before that tag's payload is read.
+    """
+    wanted = {}
+    prefixes = set()
+    for path in paths:
+        path = tuple(path)
+        codes = tuple(name.encode("utf-8") for name in path)
+        wanted[codes] = path
+        prefixes.update(codes[:i] for i in range(1, len(codes)))
+
+    found = {}
+    current = ()
+    end = None
+    stack = []
+    pos = 0
+    while len(found) < len(wanted):
+        while end is not None and pos >= end:
+            current, end = stack.pop()
+
+        try:
+            header = await reader.readexactly(_HEADER_SIZE)
+        except asyncio.IncompleteReadError as ex:
+            if ex.partial or stack:
+                raise ValueError(f"truncated DMAP header at offset {pos}") from ex
+            break
+        f_code, f_len = _HEADER.unpack(header)
+        pos += _HEADER_SIZE
+        if end is not None and pos + f_len > end:
+            raise ValueError(
+                f"DMAP tag {f_code!r} at offset {pos - _HEADER_SIZE} overruns its parent"
+            )
+        if max_size is not None and pos + f_len > max_size:
+            raise ValueError(f"DMAP data exceeds maximum size of {max_size} bytes")
+
+        tag_path = current + (f_code,)
+        tag = tag_lookup(f_code)
+        if tag_path in wanted and wanted[tag_path] not in found:
+            data = await _read_payload(reader, f_len)
+            if tag.type == "container":
+                found[wanted[tag_path]] = parse(data, tag_lookup)
+            else:
+                found[wanted[tag_path]] = tag.type(data, 0, f_len)
+            pos += f_len
+        elif tag_path in prefixes and tag.type == "container":
+            stack.append((current, end))
+            current = tag_path
+            end = pos + f_len
+        else:
+            await _skip(reader, f_len)
+            pos += f_len
+
+    return found
 
 
 def first(dmap_data, *path):
     """Look up a value given a path in some parsed DMAP data."""
-    if not (path and isinstance(dmap_data, list)):
-        return dmap_data
-
-    for key in dmap_data:
-        if path[0] in key:
-            return first(key[path[0]], *path[1:])
+    for name in path:
+        if not isinstance(dmap_data, list):
+            break
+        for key in dmap_data:
+            if name in key:
+                dmap_data = key[name]
+                break
+        else:
+            return None
 
-    return None
+    return dmap_data
 
 
 def pprint(data, tag_lookup, indent=0):
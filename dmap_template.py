@@ -0,0 +1,74 @@
+"""Precompiled DMAP responses with fixed width fields patched in place.
+
+Most responses sent to remotes are identical between requests except for one or
+two integers (a timestamp, an item id, ...). A DmapTemplate is built once from
+the complete encoded response and remembers where those integers live, so each
+request only has to overwrite a few bytes instead of encoding everything again.
+"""
+
+import struct
+
+_HEADER = struct.Struct(">4sI")
+
+
+def _locate(data, path):
+    """Find the payload offset and length of the first tag at path."""
+    start, end = 0, len(data)
+    for depth, name in enumerate(path):
+        code = name.encode("utf-8")
+        pos = start
+        while pos + _HEADER.size <= end:
+            f_code, f_len = _HEADER.unpack_from(data, pos)
+            pos += _HEADER.size
+            if f_code == code:
+                break
+            pos += f_len
+        else:
+            raise KeyError(f"tag path {'/'.join(path[: depth + 1])} not in template")
+        start, end = pos, pos + f_len
+    return start, end - start
+
+
+class DmapTemplate:
+    """Encoded DMAP data with named uint fields that can be patched.
+
+    Fields are given as keyword arguments mapping a field name to the tag path of
+    a uint tag in data, e.g. DmapTemplate(data, mstc=("msrv", "mstc")).
+    """
+
+    __slots__ = ("_buffer", "_fields", "_values", "_frozen")
+
+    def __init__(self, data, **fields):
+        self._buffer = bytearray(data)
+        self._fields = {}
+        self._values = {}
+        for name, path in fields.items():
+            offset, length = _locate(self._buffer, path)
+            self._fields[name] = (offset, length)
+            self._values[name] = int.from_bytes(
+                self._buffer[offset : offset + length], byteorder="big"
+            )
+        self._frozen = bytes(self._buffer)
+
+    def render(self, **values):
+        """Return the encoded data with the given fields set.
+
+        Fields not given keep the value they were last rendered with. When
+        nothing changed, the previously rendered bytes object is returned as is.
+        A value that doesn't fit its field raises OverflowError and leaves the
+        template untouched.
+        """
+        patches = []
+        for name, value in values.items():
+            if self._values[name] == value:
+                continue
+            offset, length = self._fields[name]
+            encoded = value.to_bytes(length, byteorder="big")
+            patches.append((name, value, offset, encoded))
+        if not patches:
+            return self._frozen
+        for name, value, offset, encoded in patches:
+            self._buffer[offset : offset + len(encoded)] = encoded
+            self._values[name] = value
+        self._frozen = bytes(self._buffer)
+        return self._frozen
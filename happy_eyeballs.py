@@ -0,0 +1,106 @@
+"""Picking a reachable address for a device, Happy Eyeballs style (RFC 8305).
+
+mDNS often resolves a device to several addresses, some of which can't be
+reached from here (an IPv6 link-local address on the wrong interface, a stale
+IPv4 address). AddressSelector races plain TCP connects to all of them,
+starting the next attempt every `delay` seconds or as soon as the previous one
+fails, alternating between IPv6 and IPv4. The first address to connect wins and
+is remembered for the device, so later requests go straight to it without
+racing again; the probe connections themselves are closed right away, only
+connects are raced, never the requests sent afterwards.
+"""
+
+import asyncio
+from collections import OrderedDict
+from itertools import zip_longest
+import logging
+from typing import Hashable, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def interleave(addresses: list[str]) -> list[str]:
+    """Order addresses IPv6 first, alternating address families."""
+    v6 = [address for address in addresses if ":" in address]
+    v4 = [address for address in addresses if ":" not in address]
+    return [address for pair in zip_longest(v6, v4) for address in pair if address is not None]
+
+
+class AddressSelector:
+    def __init__(self, delay: float = 0.25, connect_timeout: float = 3.0, max_entries: int = 256) -> None:
+        self.delay = delay
+        self.connect_timeout = connect_timeout
+        self.max_entries = max_entries
+        self.races = 0
+        self._winners: OrderedDict[Hashable, str] = OrderedDict()
+        self._racing: dict[Hashable, asyncio.Task] = {}
+
+    def cached(self, device: Hashable, addresses: list[str]) -> Optional[str]:
+        """The remembered address for a device, if it is still one of its addresses."""
+        winner = self._winners.get(device)
+        if winner is None or winner not in addresses:
+            return None
+        self._winners.move_to_end(device)
+        return winner
+
+    async def pick(self, device: Hashable, addresses: list[str], port: int) -> Optional[str]:
+        """An address of the device that accepts connections on port, None if none does."""
+        if len(addresses) <= 1:
+            return addresses[0] if addresses else None
+        winner = self.cached(device, addresses)
+        if winner is not None:
+            return winner
+        race = self._racing.get(device)
+        if race is None:
+            race = self._racing[device] = asyncio.create_task(self._race(device, addresses, port))
+        return await asyncio.shield(race)
+
+    def forget(self, device: Hashable) -> None:
+        """Drop the remembered address, e.g. after a connection to it failed."""
+        self._winners.pop(device, None)
+
+    async def _race(self, device: Hashable, addresses: list[str], port: int) -> Optional[str]:
+        self.races += 1
+        try:
+            winner = await self.race(addresses, port)
+        finally:
+            del self._racing[device]
+        if winner is None:
+            _LOGGER.warning("none of %s accepted a connection on port %d", addresses, port)
+            return None
+        _LOGGER.info("using %s for %s", winner, device)
+        self._winners[device] = winner
+        self._winners.move_to_end(device)
+        while len(self._winners) > self.max_entries:
+            self._winners.popitem(last=False)
+        return winner
+
+    async def race(self, addresses: list[str], port: int) -> Optional[str]:
+        """Staggered connects to all addresses, returns the first one to connect."""
+        remaining = interleave(addresses)
+        pending: set[asyncio.Task] = set()
+        try:
+            while remaining or pending:
+                if remaining:
+                    pending.add(asyncio.create_task(self._connect(remaining.pop(0), port)))
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.delay if remaining else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    _LOGGER.debug("connect attempt failed: %r", task.exception())
+                # nothing connected yet: start the next attempt now (after a failure) or because the delay passed
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _connect(self, address: str, port: int) -> str:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), self.connect_timeout)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return address
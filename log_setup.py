@@ -0,0 +1,39 @@
+"""Logging configuration with output written off the event loop.
+
+Records are put on an unbounded queue by a QueueHandler on the root logger,
+which costs no I/O on the caller's side; a QueueListener thread formats them
+and writes them to stderr. Each subsystem logs under its own logger name so
+its level can be set independently, and messages use %-style arguments so
+nothing is formatted for records below the configured level.
+"""
+
+import logging
+import logging.handlers
+import queue
+from typing import Mapping, Optional
+
+DEFAULT_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+
+def setup_logging(level: int = logging.INFO, levels: Optional[Mapping[str, int]] = None,
+                  fmt: str = DEFAULT_FORMAT) -> logging.handlers.QueueListener:
+    """Route all logging through a queue, returns the started listener.
+
+    levels maps logger names (e.g. "daap.arrows") to their own levels. Call
+    stop() on the listener at shutdown to flush the remaining records.
+    """
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(fmt))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,105 @@
+"""Registry of remotes and DACP targets discovered over mDNS.
+
+Records are indexed by fqn, by DACP id (for _dacp._tcp targets) and by pairing
+guid (for _touch-remote._tcp remotes) so lookups never scan. Every record
+expires after its mDNS TTL; expired records are dropped lazily when they are
+looked up, and the least recently used record is evicted once the registry is
+full.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import time
+from typing import Optional, Union
+
+DACP_SERVICE_PREFIX = "iTunes_Ctrl_"
+DEFAULT_TTL = 4500  # seconds a record added without a ttl is kept
+
+
+@dataclass
+class ClientRemotePairingRecord:
+    fqn: str
+    port: int
+    pairing_guid: str
+    addresses: list[str]
+    name: str
+
+@dataclass
+class ClientRemoteControlRecord:
+    fqn: str
+    port: int
+    addresses: list[str]
+    name: str
+
+Record = Union[ClientRemotePairingRecord, ClientRemoteControlRecord]
+
+
+def dacp_id_from_fqn(fqn: str) -> str:
+    """Extract the DACP id from a name like iTunes_Ctrl_<id>._dacp._tcp.local."""
+    instance = fqn.split(".", 1)[0]
+    if instance.startswith(DACP_SERVICE_PREFIX):
+        instance = instance[len(DACP_SERVICE_PREFIX):]
+    return instance.upper()
+
+
+class MdnsRegistry:
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[Record, float]] = OrderedDict()
+        self._by_dacp_id: dict[str, str] = {}
+        self._by_pairing_guid: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, record: Record, ttl: Optional[float] = None) -> None:
+        """Add or replace a record, valid for ttl seconds."""
+        self.remove(record.fqn)
+        expires_at = time.monotonic() + (DEFAULT_TTL if ttl is None else ttl)
+        self._entries[record.fqn] = (record, expires_at)
+        if isinstance(record, ClientRemoteControlRecord):
+            self._by_dacp_id[dacp_id_from_fqn(record.fqn)] = record.fqn
+        else:
+            self._by_pairing_guid[record.pairing_guid.upper()] = record.fqn
+        while len(self._entries) > self.max_entries:
+            self.remove(next(iter(self._entries)))
+
+    def remove(self, fqn: str) -> Optional[Record]:
+        entry = self._entries.pop(fqn, None)
+        if entry is None:
+            return None
+        record = entry[0]
+        if isinstance(record, ClientRemoteControlRecord):
+            index, key = self._by_dacp_id, dacp_id_from_fqn(fqn)
+        else:
+            index, key = self._by_pairing_guid, record.pairing_guid.upper()
+        if index.get(key) == fqn:
+            del index[key]
+        return record
+
+    def get(self, fqn: str) -> Optional[Record]:
+        """Return the record for fqn, or None if unknown or expired."""
+        entry = self._entries.get(fqn)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            self.remove(fqn)
+            return None
+        self._entries.move_to_end(fqn)
+        return entry[0]
+
+    def by_dacp_id(self, dacp_id: str) -> Optional[ClientRemoteControlRecord]:
+        fqn = self._by_dacp_id.get(dacp_id.upper())
+        return None if fqn is None else self.get(fqn)
+
+    def by_pairing_guid(self, pairing_guid: str) -> Optional[ClientRemotePairingRecord]:
+        fqn = self._by_pairing_guid.get(pairing_guid.upper())
+        return None if fqn is None else self.get(fqn)
+
+    def records(self, record_type: type) -> dict[str, Record]:
+        """Return all live records of a type, keyed by fqn."""
+        now = time.monotonic()
+        expired = [fqn for fqn, (_, expires_at) in self._entries.items() if expires_at < now]
+        for fqn in expired:
+            self.remove(fqn)
+        return {fqn: record for fqn, (record, _) in self._entries.items() if isinstance(record, record_type)}
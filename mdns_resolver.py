@@ -0,0 +1,161 @@
+"""Deduplicated, cached resolution of services found by the mDNS browser.
+
+On a busy network zeroconf's browser reports Added and Updated for the same
+service over and over. ServiceResolver keeps at most one lookup in flight per
+service name (later events join it), remembers each resolved service until its
+SRV, TXT or address records expire, and answers Updated events for a resolved
+service (typically a changed TXT record, which zeroconf has already put in its
+cache) by reloading the service from that cache instead of querying the network
+again. Added always resolves again, so the addresses are never older than
+zeroconf's cache.
+
+Zeroconf renews the records of a live device when it refreshes the browser's
+PTR record, but tells no one when the data didn't change. So at 80% of the TTL
+the resolver checks the cache again: renewed records are passed on to the
+listeners with their new TTL, expired ones are looked up on the network.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+from zeroconf import DNSAddress, DNSService, DNSText, ServiceStateChange, Zeroconf, current_time_millis
+from zeroconf.asyncio import AsyncServiceInfo
+
+_LOGGER = logging.getLogger(__name__)
+
+REFRESH_AT = 0.8  # fraction of the remaining TTL after which the cache is checked again
+MIN_REFRESH_INTERVAL = 1.0  # seconds, below this the check waits for the records to expire
+
+
+def remaining_ttl(zeroconf: Zeroconf, info: AsyncServiceInfo) -> float:
+    """Seconds until the service's SRV or TXT record, or the last of its address records, expires in zeroconf's cache."""
+    now = current_time_millis()
+    cache = zeroconf.cache
+
+    def longest(records, record_type) -> float:
+        return max((record.get_remaining_ttl(now) for record in records if isinstance(record, record_type)), default=0)
+
+    records = cache.async_entries_with_name(info.name)
+    addresses = cache.async_entries_with_name(info.server) if info.server else []
+    return min(longest(records, DNSService), longest(records, DNSText), longest(addresses, DNSAddress))
+
+
+def _fingerprint(info: AsyncServiceInfo) -> tuple:
+    return (info.port, info.server, tuple(info.parsed_scoped_addresses()), tuple(sorted((info.properties or {}).items())))
+
+
+class ServiceResolver:
+    def __init__(self, zeroconf: Zeroconf, on_resolved: Callable[[str, str, AsyncServiceInfo], None],
+                 timeout: float = 3.0, max_entries: int = 256) -> None:
+        self.zeroconf = zeroconf
+        self.on_resolved = on_resolved
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.lookups = 0   # lookups started, answered from zeroconf's cache when it has the records
+        self.joined = 0    # events that joined a lookup already in flight
+        self.cached = 0    # events answered without a lookup
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._resolved: dict[str, tuple[AsyncServiceInfo, tuple, float]] = {}  # name -> info, fingerprint, expires_at
+        self._refreshes: dict[str, asyncio.TimerHandle] = {}
+
+    def update(self, service_type: str, name: str, state_change: ServiceStateChange) -> None:
+        """Handle a browser event for a service."""
+        if state_change == ServiceStateChange.Removed:
+            self.forget(name)
+            return
+        if name in self._inflight:
+            self.joined += 1
+            return
+        cached = self._resolved.get(name)
+        if state_change == ServiceStateChange.Updated and cached is not None and cached[2] > time.monotonic():
+            if self._reload(service_type, name, cached[0], cached[1]):
+                self.cached += 1
+                return
+        # Added: the device may have come back on other addresses, a fresh lookup takes them from zeroconf's cache
+        # (or the network, if they aren't cached) instead of the info we resolved before
+        self._start_lookup(service_type, name)
+
+    def _start_lookup(self, service_type: str, name: str) -> None:
+        self._inflight[name] = asyncio.create_task(self._resolve(service_type, name))
+
+    def _reload(self, service_type: str, name: str, info: AsyncServiceInfo, fingerprint: tuple) -> bool:
+        """Refresh a resolved service from zeroconf's cache, False if the cache can't complete it."""
+        if not info.load_from_cache(self.zeroconf):
+            return False
+        new_fingerprint = _fingerprint(info)
+        if new_fingerprint != fingerprint:
+            _LOGGER.debug("%s changed, reloaded from cache", name)
+            self._store(service_type, name, info, new_fingerprint)
+        return True
+
+    async def _resolve(self, service_type: str, name: str) -> None:
+        self.lookups += 1
+        info = AsyncServiceInfo(service_type, name)
+        try:
+            found = await info.async_request(self.zeroconf, self.timeout * 1000)
+        except Exception:
+            _LOGGER.exception("resolving %s failed", name)
+            return
+        finally:
+            if self._inflight.get(name) is asyncio.current_task():
+                del self._inflight[name]
+        if not found:
+            _LOGGER.debug("could not resolve %s", name)
+            self._drop(name)
+            return
+        self._store(service_type, name, info, _fingerprint(info))
+
+    def _store(self, service_type: str, name: str, info: AsyncServiceInfo, fingerprint: tuple) -> None:
+        ttl = remaining_ttl(self.zeroconf, info)
+        self._drop(name)
+        if ttl <= 0:
+            _LOGGER.debug("records of %s expired before they were used", name)
+            return
+        if len(self._resolved) >= self.max_entries:
+            self._drop(next(iter(self._resolved)))
+        self._resolved[name] = (info, fingerprint, time.monotonic() + ttl)
+        delay = ttl * REFRESH_AT if ttl > MIN_REFRESH_INTERVAL else ttl
+        self._refreshes[name] = asyncio.get_running_loop().call_later(delay, self._refresh, service_type, name)
+        self.on_resolved(service_type, name, info)
+
+    def _refresh(self, service_type: str, name: str) -> None:
+        """Pass on renewed records with their new TTL, or look the service up again once they expired."""
+        self._refreshes.pop(name, None)
+        cached = self._resolved.get(name)
+        if cached is None or name in self._inflight:
+            return
+        info = cached[0]
+        if info.load_from_cache(self.zeroconf) and remaining_ttl(self.zeroconf, info) > 0:
+            self._store(service_type, name, info, _fingerprint(info))
+        else:
+            self._start_lookup(service_type, name)
+
+    def _drop(self, name: str) -> None:
+        self._resolved.pop(name, None)
+        refresh = self._refreshes.pop(name, None)
+        if refresh is not None:
+            refresh.cancel()
+
+    def get(self, name: str) -> Optional[AsyncServiceInfo]:
+        cached = self._resolved.get(name)
+        if cached is None or cached[2] <= time.monotonic():
+            return None
+        return cached[0]
+
+    def forget(self, name: str) -> None:
+        task = self._inflight.pop(name, None)
+        if task is not None:
+            task.cancel()
+        self._drop(name)
+
+    async def close(self) -> None:
+        tasks = list(self._inflight.values())
+        self._inflight.clear()
+        for refresh in self._refreshes.values():
+            refresh.cancel()
+        self._refreshes.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
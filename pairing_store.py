@@ -0,0 +1,99 @@
+"""Durable store of paired remotes.
+
+Pairings are kept in an append-only file with one JSON object per line and
+indexed in memory by pairing guid, so /login can check a guid with a single
+dict lookup. The file is read once at startup (and compacted if it has
+accumulated duplicates); new pairings are appended through aiofiles so the
+event loop never blocks on disk.
+"""
+
+import asyncio
+from dataclasses import asdict, dataclass
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import aiofiles
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def normalize_guid(value) -> Optional[int]:
+    """Turn a pairing guid (int, hex string, with or without 0x) into an int."""
+    if isinstance(value, int):
+        return value
+    try:
+        return int(str(value), 16)
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True)
+class Pairing:
+    guid: str  # uppercase hex, no 0x
+    name: Optional[str]
+    device: Optional[str]
+    fqn: Optional[str]
+    paired_at: float
+
+
+class PairingStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._pairings: dict[int, Pairing] = {}
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pairings)
+
+    def __contains__(self, guid) -> bool:
+        return self.get(guid) is not None
+
+    def get(self, guid) -> Optional[Pairing]:
+        key = normalize_guid(guid)
+        return None if key is None else self._pairings.get(key)
+
+    def pairings(self) -> list[Pairing]:
+        return list(self._pairings.values())
+
+    def load(self) -> None:
+        """Read the log into memory, called once before serving."""
+        lines = 0
+        try:
+            with open(self.path, "r") as file:
+                for line in file:
+                    lines += 1
+                    try:
+                        pairing = Pairing(**json.loads(line))
+                    except (TypeError, ValueError):
+                        _LOGGER.warning("skipping bad line %d in %s", lines, self.path)
+                        continue
+                    key = normalize_guid(pairing.guid)
+                    if key is not None:
+                        self._pairings[key] = pairing
+        except FileNotFoundError:
+            return
+        if lines > 2 * len(self._pairings) + 16:
+            self._compact()
+
+    def _compact(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            for pairing in self._pairings.values():
+                file.write(json.dumps(asdict(pairing)) + "\n")
+        os.replace(tmp_path, self.path)
+
+    async def add(self, guid, name: Optional[str] = None, device: Optional[str] = None,
+                  fqn: Optional[str] = None) -> Pairing:
+        key = normalize_guid(guid)
+        if key is None:
+            raise ValueError(f"invalid pairing guid: {guid!r}")
+        pairing = Pairing(format(key, "X"), name, device, fqn, time.time())
+        async with self._lock:
+            async with aiofiles.open(self.path, "a") as file:
+                await file.write(json.dumps(asdict(pairing)) + "\n")
+            # only once it is on disk, so a failed write doesn't leave a pairing that is gone after a restart
+            self._pairings[key] = pairing
+        return pairing
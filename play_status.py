@@ -0,0 +1,106 @@
+"""Revision numbered play state served to remotes via playstatusupdate.
+
+Remotes long-poll /ctrl-int/1/playstatusupdate with the revision they last saw.
+PlayStatusStore bumps its revision whenever the state changes and wakes every
+waiting request at once through a single shared event. The encoded cmst
+response is built once per revision and shared by all requests.
+
+read_play_status decodes the same kind of response when it comes from a DACP
+target (the iDevice mirroring to UxPlay), so its state can be mirrored here.
+"""
+
+import asyncio
+from dataclasses import dataclass, fields, replace
+from typing import Optional
+
+import dmap_parser
+import tag_definitions
+import tags
+
+# caps values
+PLAY_STATUS_STOPPED = 2
+PLAY_STATUS_PAUSED = 3
+PLAY_STATUS_PLAYING = 4
+
+
+@dataclass(frozen=True)
+class PlayState:
+    caps: Optional[int] = None  # play status
+    cann: Optional[str] = None  # track
+    cana: Optional[str] = None  # artist
+    canl: Optional[str] = None  # album
+    cang: Optional[str] = None  # genre
+    cant: Optional[int] = None  # remaining time (ms)
+    cast: Optional[int] = None  # track length (ms)
+
+
+class PlayStatusStore:
+    def __init__(self, revision: int = 2) -> None:
+        self.revision = revision
+        self.state = PlayState()
+        self._changed = asyncio.Event()
+        self._response: Optional[tuple[int, bytes]] = None
+
+    def update(self, **changes) -> bool:
+        """Apply changes to the state, returns True if it changed."""
+        state = replace(self.state, **changes)
+        if state == self.state:
+            return False
+        self.state = state
+        self.revision += 1
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+        return True
+
+    async def wait_for_change(self, revision: int, timeout: Optional[float]) -> bool:
+        """Wait until the revision differs from the given one, False on timeout.
+
+        A client that is ahead (e.g. after a restart) is answered right away too.
+        """
+        if self.revision != revision:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def response(self) -> bytes:
+        """Encoded cmst response for the current revision."""
+        if self._response is None or self._response[0] != self.revision:
+            self._response = (self.revision, encode_play_status(self.revision, self.state))
+        return self._response[1]
+
+
+def encode_play_status(revision: int, state: PlayState) -> bytes:
+    writer = tags.DmapWriter()
+    with writer.container("cmst"):
+        writer.uint32("mstt", 200)
+        writer.uint32("cmsr", revision)
+        for field in fields(state):
+            value = getattr(state, field.name)
+            if value is None:
+                continue
+            if isinstance(value, str):
+                writer.string(field.name, value)
+            elif field.name == "caps":
+                writer.uint8(field.name, value)
+            else:
+                writer.uint32(field.name, value)
+    return writer.getvalue()
+
+
+_STATE_FIELDS = tuple(field.name for field in fields(PlayState))
+_UPSTREAM_PATHS = [("cmst", "cmsr")] + [("cmst", name) for name in _STATE_FIELDS]
+
+
+async def read_play_status(reader, max_size: Optional[int] = None) -> tuple[Optional[int], dict]:
+    """Decode a cmst response read from a stream.
+
+    Returns the upstream revision (None if missing) and a complete set of
+    PlayState fields, with None for anything the response didn't include.
+    """
+    found = await dmap_parser.stream_extract(
+        reader, tag_definitions.lookup_tag, _UPSTREAM_PATHS, max_size=max_size)
+    changes = {name: found.get(("cmst", name)) for name in _STATE_FIELDS}
+    return found.get(("cmst", "cmsr")), changes
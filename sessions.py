@@ -0,0 +1,153 @@
+"""Sessions of logged in remotes.
+
+Each /login creates a Session, identified by the mlid handed back to the
+remote. Sessions expire after sitting idle for a while: every session has an
+entry in a heap ordered by expiry time, so finding the expired ones only looks
+at the head of the heap. The store also has a maximum size, beyond which the
+least recently used session is evicted. Sessions are indexed by the start bytes
+of their trackpad packets for the arrows server.
+"""
+
+import asyncio
+from collections import OrderedDict
+import heapq
+import secrets
+import time
+from typing import Callable, Optional
+
+SESSION_ID_BITS = 31  # some remotes mishandle mlid values above 2^31
+
+
+class Session:
+    __slots__ = (
+        "session_id",
+        "pairing_guid",
+        "cmte",
+        "trackpad_key",
+        "trackpad_expected_start_bytes",
+        "prompt_changed",  # set by control_prompt_entry, wakes parked controlpromptupdate requests
+        "prompt_idle_timeout",
+        "prompt_template",
+        "expires_at",
+        "closed",
+    )
+
+    def __init__(self, session_id: int, pairing_guid: Optional[str], expires_at: float) -> None:
+        self.session_id = session_id
+        self.pairing_guid = pairing_guid
+        self.cmte: Optional[str] = None
+        self.trackpad_key: Optional[int] = None
+        self.trackpad_expected_start_bytes: Optional[bytes] = None
+        self.prompt_changed = asyncio.Event()
+        self.prompt_idle_timeout: Optional[float] = None
+        self.prompt_template = None
+        self.expires_at = expires_at
+        self.closed = False
+
+    def __repr__(self) -> str:
+        return f"Session(session_id={self.session_id}, pairing_guid={self.pairing_guid!r}, cmte={self.cmte!r}, closed={self.closed})"
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = 64, idle_timeout: float = 1800,
+                 on_remove: Optional[Callable[[Session], None]] = None) -> None:
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.on_remove = on_remove
+        self._sessions: OrderedDict[int, Session] = OrderedDict()  # least recently used first
+        self._expiry: list[tuple[float, int]] = []
+        self._by_start_bytes: dict[bytes, Session] = {}
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _new_id(self) -> int:
+        # random, as the id is all /ctrl-int, controlpromptupdate and the arrows port check, and never one still in use
+        while True:
+            session_id = secrets.randbits(SESSION_ID_BITS)
+            if session_id and session_id not in self._sessions:
+                return session_id
+
+    def create(self, pairing_guid: Optional[str] = None) -> Session:
+        self.expire()
+        while len(self._sessions) >= self.max_sessions:
+            self.remove(next(iter(self._sessions)))
+        current = Session(self._new_id(), pairing_guid, time.monotonic() + self.idle_timeout)
+        self._sessions[current.session_id] = current
+        if len(self._expiry) > 2 * self.max_sessions:
+            # drop entries left behind by sessions that were evicted or logged out
+            self._expiry = [(live.expires_at, live.session_id) for live in self._sessions.values()]
+            heapq.heapify(self._expiry)
+        else:
+            heapq.heappush(self._expiry, (current.expires_at, current.session_id))
+        return current
+
+    def get(self, session_id) -> Optional[Session]:
+        """Look up a live session by id (int or the str from a query string)."""
+        try:
+            current = self._sessions.get(int(session_id))
+        except (TypeError, ValueError):
+            return None
+        if current is None:
+            return None
+        if current.expires_at <= time.monotonic():
+            self.remove(current.session_id)
+            return None
+        self.touch(current)
+        return current
+
+    def touch(self, current: Session) -> None:
+        """Mark a session as used, pushing back its expiry."""
+        current.expires_at = time.monotonic() + self.idle_timeout
+        self._sessions.move_to_end(current.session_id)
+
+    def remove(self, session_id) -> Optional[Session]:
+        try:
+            current = self._sessions.pop(int(session_id), None)
+        except (TypeError, ValueError):
+            return None
+        if current is None:
+            return None
+        current.closed = True
+        self._unindex(current)
+        if self.on_remove is not None:
+            self.on_remove(current)
+        return current
+
+    def set_trackpad(self, current: Session, cmte: str, trackpad_key: int, start_bytes: bytes) -> None:
+        self._unindex(current)
+        current.cmte = cmte
+        current.trackpad_key = trackpad_key
+        current.trackpad_expected_start_bytes = start_bytes
+        self._by_start_bytes[start_bytes] = current
+
+    def by_start_bytes(self, start_bytes: bytes) -> Optional[Session]:
+        return self._by_start_bytes.get(start_bytes)
+
+    def _unindex(self, current: Session) -> None:
+        start_bytes = current.trackpad_expected_start_bytes
+        if start_bytes is not None and self._by_start_bytes.get(start_bytes) is current:
+            del self._by_start_bytes[start_bytes]
+
+    def expire(self) -> int:
+        """Remove sessions that have been idle for too long, returns how many."""
+        now = time.monotonic()
+        expired = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            _, session_id = heapq.heappop(self._expiry)
+            current = self._sessions.get(session_id)
+            if current is None:
+                continue
+            if current.expires_at > now:
+                # touched since this entry was pushed, check again later
+                heapq.heappush(self._expiry, (current.expires_at, session_id))
+                continue
+            self.remove(session_id)
+            expired += 1
+        return expired
+
+    async def run(self, interval: float = 60) -> None:
+        """Expire idle sessions periodically until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
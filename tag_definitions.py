@@ -28,7 +28,7 @@ _LOGGER = logging.getLogger(__name__)
 
 # Internal version that works like read_ignore, but also logs
 def _read_unknown(data, start, length):
-    _LOGGER.warning("Unknown data: %s", str(data[start - 8 : start + length + 8]))
+    _LOGGER.warning("Unknown data: %s", bytes(data[start - 8 : start + length + 8]))
 
 
 # These are the tags that we know about so far
@@ -140,9 +140,33 @@ _TAGS = {
 }
 
 
-def lookup_tag(name):
-    """Look up a tag based on its key. Returns a DmapTag."""
-    return next(
-        (tag for tag_name, tag in _TAGS.items() if tag_name == name),
-        DmapTag(_read_unknown, "unknown tag"),
-    )
+# Shared fallback for every tag not in the registry
+_UNKNOWN_TAG = DmapTag(_read_unknown, "unknown tag")
+
+# Registry used for lookups, keyed on both the raw 4 byte code (as seen by the
+# parser) and the decoded name (as used by pprint and callers)
+_REGISTRY = {}
+
+
+def register_tag(name, tag):
+    """Register (or replace) the definition of a tag.
+
+    The name may be given either as a str or as the raw 4 byte code.
+    """
+    if isinstance(name, str):
+        code = name.encode("utf-8")
+    else:
+        code = bytes(name)
+        name = code.decode("utf-8")
+    _TAGS[name] = tag
+    _REGISTRY[name] = tag
+    _REGISTRY[code] = tag
+
+
+for _name, _tag in list(_TAGS.items()):
+    register_tag(_name, _tag)
+
+
+def lookup_tag(name, _get=_REGISTRY.get, _unknown=_UNKNOWN_TAG):
+    """Look up a tag based on its key (str or raw bytes). Returns a DmapTag."""
+    return _get(name, _unknown)
@@ -12,17 +12,29 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 """Util functions for extracting and constructing DMAP data."""
 
 import binascii
+from contextlib import contextmanager
 import plistlib
+import struct
+
+# Precompiled decoders for the common fixed size integers
+_UINT_UNPACKERS = {
+    1: struct.Struct(">B").unpack_from,
+    2: struct.Struct(">H").unpack_from,
+    4: struct.Struct(">I").unpack_from,
+    8: struct.Struct(">Q").unpack_from,
+}
 
 
 def read_str(data, start, length):
     """Extract a string from a position in a sequence."""
-    return data[start : start + length].decode("utf-8")
+    return str(data[start : start + length], "utf-8")
 
 
 def read_uint(data, start, length):
     """Extract a uint from a position in a sequence."""
-    # print(binascii.hexlify(data[start : start + length]), length, int.from_bytes(data[start : start + length], byteorder="big"))
+    unpack = _UINT_UNPACKERS.get(length)
+    if unpack is not None:
+        return unpack(data, start)[0]
     return int.from_bytes(data[start : start + length], byteorder="big")
 
 
@@ -35,7 +47,7 @@ def read_bplist(data, start, length):
     """Extract a binary plist from a position in a sequence."""
     # TODO: pylint doesn't find FMT_BINARY, why?
     # pylint: disable=no-member
-    return plistlib.loads(data[start : start + length], fmt=plistlib.FMT_BINARY)
+    return plistlib.loads(bytes(data[start : start + length]), fmt=plistlib.FMT_BINARY)
 
 
 def read_bytes(data, start, length):
@@ -88,13 +100,90 @@ def raw_tag(name, value):
 
 def string_tag(name, value):
     """Create a DMAP tag with string data."""
-    return (
-        name.encode("utf-8")
-        + len(value).to_bytes(4, byteorder="big")
-        + value.encode("utf-8")
-    )
+    return raw_tag(name, value.encode("utf-8"))
 
 
 def container_tag(name, data):
     """Create a DMAP tag with string data."""
     return raw_tag(name, data)  # Same as raw
+
+
+# Encoded tag names, cached so that each name is only encoded once
+_CODES = {}
+
+_HEADER = struct.Struct(">4sI")
+_LENGTH = struct.Struct(">I")
+_UINT8_TAG = struct.Struct(">4sIB")
+_UINT16_TAG = struct.Struct(">4sIH")
+_UINT32_TAG = struct.Struct(">4sII")
+_UINT64_TAG = struct.Struct(">4sIQ")
+
+
+def _code(name):
+    code = _CODES.get(name)
+    if code is None:
+        code = _CODES[name] = name.encode("utf-8")
+    return code
+
+
+class DmapWriter:
+    """Build DMAP data by appending tags to a single growable buffer.
+
+    Containers are opened with a context manager that writes a placeholder
+    length and fills in the real one when the block exits, so nested data is
+    never copied:
+
+        writer = DmapWriter()
+        with writer.container("cmst"):
+            writer.uint32("mstt", 200)
+        data = writer.getvalue()
+    """
+
+    __slots__ = ("_buffer",)
+
+    def __init__(self):
+        """Initialize a new DmapWriter."""
+        self._buffer = bytearray()
+
+    def uint8(self, name, value):
+        """Append a tag with uint8 data."""
+        self._buffer += _UINT8_TAG.pack(_code(name), 1, value)
+
+    def uint16(self, name, value):
+        """Append a tag with uint16 data."""
+        self._buffer += _UINT16_TAG.pack(_code(name), 2, value)
+
+    def uint32(self, name, value):
+        """Append a tag with uint32 data."""
+        self._buffer += _UINT32_TAG.pack(_code(name), 4, value)
+
+    def uint64(self, name, value):
+        """Append a tag with uint64 data."""
+        self._buffer += _UINT64_TAG.pack(_code(name), 8, value)
+
+    def bool(self, name, value):
+        """Append a tag with boolean data."""
+        self._buffer += _UINT8_TAG.pack(_code(name), 1, 1 if value else 0)
+
+    def raw(self, name, value):
+        """Append a tag with raw data."""
+        self._buffer += _HEADER.pack(_code(name), len(value))
+        self._buffer += value
+
+    def string(self, name, value):
+        """Append a tag with string data."""
+        self.raw(name, value.encode("utf-8"))
+
+    @contextmanager
+    def container(self, name):
+        """Append a container tag holding whatever is written inside the block."""
+        start = len(self._buffer)
+        self._buffer += _HEADER.pack(_code(name), 0)
+        yield self
+        _LENGTH.pack_into(
+            self._buffer, start + 4, len(self._buffer) - start - _HEADER.size
+        )
+
+    def getvalue(self):
+        """Return everything written so far as bytes."""
+        return bytes(self._buffer)
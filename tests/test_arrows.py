@@ -0,0 +1,129 @@
+"""ArrowServerProtocol framing of trackpad data, fed without a socket."""
+
+import pytest
+
+import combined
+from benchmarks.load import trackpad_frame
+
+
+class FakeTransport:
+    def __init__(self) -> None:
+        self.written = []
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return None
+
+    def write(self, data: bytes) -> None:
+        self.written.append(data)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class RecordingProtocol(combined.ArrowServerProtocol):
+    def __init__(self, app) -> None:
+        super().__init__(app)
+        self.frames = []
+
+    def frame_received(self, using_session, decrypted_message):
+        self.frames.append((using_session, decrypted_message))
+
+
+@pytest.fixture
+def app(tmp_path):
+    return combined.make_app(
+        pairing_store_file=str(tmp_path / "pairings.jsonl"),
+        uxplay_dacp_files=[str(tmp_path / "uxplay.dacp")],
+        advertise=False,
+    )
+
+
+def trackpad_session(app, cmte=123456):
+    # what control_prompt_entry does for a DRPortInfoRequest
+    current = app[combined.session].create("0123456789ABCDEF")
+    key = int.from_bytes((combined.SUB_TEXT ^ cmte).to_bytes(4, "little"))
+    app[combined.session].set_trackpad(current, f"{cmte},0", key, (32 ^ key).to_bytes(4))
+    return current, key
+
+
+def connect(app) -> RecordingProtocol:
+    protocol = RecordingProtocol(app)
+    protocol.connection_made(FakeTransport())
+    return protocol
+
+
+def feed(protocol: RecordingProtocol, data: bytes) -> None:
+    buffer = protocol.get_buffer(len(data))
+    buffer[:len(data)] = data
+    protocol.buffer_updated(len(data))
+
+
+def test_single_frame(app):
+    current, key = trackpad_session(app)
+    protocol = connect(app)
+    frame = trackpad_frame(key, 3)
+    feed(protocol, frame)
+    assert protocol.frames == [(current, [32, 1, 0, 0, 0, 0, 0, 3])]
+    assert protocol.transport.written == [frame]
+
+
+def test_frame_split_across_reads(app):
+    current, key = trackpad_session(app)
+    protocol = connect(app)
+    frame = trackpad_frame(key, 3)
+    for start, end in ((0, 3), (3, 23), (23, 31)):
+        feed(protocol, frame[start:end])
+        assert protocol.frames == []
+    feed(protocol, frame[31:])
+    assert protocol.frames == [(current, [32, 1, 0, 0, 0, 0, 0, 3])]
+
+
+def test_coalesced_frames(app):
+    current, key = trackpad_session(app)
+    protocol = connect(app)
+    frames = [trackpad_frame(key, code) for code in (1, 2, 3, 4)]
+    data = b"".join(frames)
+    feed(protocol, data[:100])  # three frames and the start of the fourth
+    assert [frame[7] for _, frame in protocol.frames] == [1, 2, 3]
+    feed(protocol, data[100:])
+    assert [frame[7] for _, frame in protocol.frames] == [1, 2, 3, 4]
+    assert protocol.transport.written == frames
+
+
+def test_many_frames_fill_the_buffer_again_and_again(app):
+    _, key = trackpad_session(app)
+    protocol = connect(app)
+    data = b"".join(trackpad_frame(key, index % 8) for index in range(100))
+    for start in range(0, len(data), 45):
+        feed(protocol, data[start:start + 45])
+    assert [frame[7] for _, frame in protocol.frames] == [index % 8 for index in range(100)]
+
+
+def test_frame_for_no_session_is_ignored(app):
+    trackpad_session(app)
+    protocol = connect(app)
+    feed(protocol, trackpad_frame(0x55555555, 3))
+    assert protocol.frames == []
+    assert not protocol.transport.closed
+
+
+def test_bad_length_drops_the_connection(app):
+    _, key = trackpad_session(app)
+    protocol = connect(app)
+    feed(protocol, trackpad_frame(key, 3))
+    feed(protocol, (key ^ 6).to_bytes(4, "big") + bytes(28))
+    assert protocol.transport.closed
+    assert len(protocol.frames) == 1
+
+
+def test_session_rebound_after_logout(app):
+    current, key = trackpad_session(app)
+    protocol = connect(app)
+    feed(protocol, trackpad_frame(key, 1))
+    app[combined.session].remove(current.session_id)
+    feed(protocol, trackpad_frame(key, 2))
+    assert len(protocol.frames) == 1
+    replacement, key = trackpad_session(app, cmte=654321)
+    feed(protocol, trackpad_frame(key, 3))
+    assert protocol.frames[-1] == (replacement, [32, 1, 0, 0, 0, 0, 0, 3])
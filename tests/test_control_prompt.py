@@ -0,0 +1,108 @@
+"""controlpromptupdate parking, against the app served on loopback."""
+
+import asyncio
+import os
+import tempfile
+
+from aiohttp import ClientSession, web
+
+import combined
+import tags
+from benchmarks.load import Recorder, Remote
+
+PAIRING_GUID = "0123456789ABCDEF"
+PARKED = 0.5  # seconds after which a request that hasn't been answered counts as parked
+
+
+async def logged_in_remote(scenario) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        app = combined.make_app(
+            pairing_store_file=os.path.join(directory, "pairings.jsonl"),
+            uxplay_dacp_files=[os.path.join(directory, "uxplay.dacp")],
+            address="127.0.0.1",
+            port=0,
+            advertise=False,
+        )
+        await app[combined.creds].add(PAIRING_GUID)
+        runner = web.AppRunner(app, shutdown_timeout=1.0)  # parked requests must not hold up shutdown
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            async with ClientSession() as client:
+                remote = Remote(client, f"http://127.0.0.1:{runner.addresses[0][1]}", "127.0.0.1", PAIRING_GUID, Recorder())
+                await remote.handshake()  # ends with the prompt-id 9 request answering the DRPortInfoRequest
+                await scenario(remote)
+        finally:
+            await runner.cleanup()
+
+
+def park(remote: Remote, prompt_id: int) -> asyncio.Task:
+    return asyncio.create_task(
+        remote.request("controlpromptupdate", "GET", "/controlpromptupdate", params=remote.prompt_params(prompt_id)))
+
+
+def test_prompt_served_on_prompt_id_9_is_not_handed_out_again():
+    async def scenario(remote):
+        parked = park(remote, 10)
+        done, _ = await asyncio.wait([parked], timeout=PARKED)
+        assert not done
+        parked.cancel()
+
+    asyncio.run(logged_in_remote(scenario))
+
+
+def test_prompt_entry_wakes_the_parked_request():
+    async def scenario(remote):
+        parked = park(remote, 10)
+        await asyncio.sleep(0.1)
+        assert not parked.done()
+        entry = tags.DmapWriter()
+        entry.string("cmbe", "DRPortInfoRequest")
+        entry.string("cmte", "1234,0")
+        await remote.request("controlpromptentry", "POST", "/ctrl-int/1/controlpromptentry",
+                             params={"session-id": str(remote.session_id)}, data=entry.getvalue())
+        await asyncio.wait_for(parked, PARKED)
+        # and the next request parks again
+        parked = park(remote, 11)
+        done, _ = await asyncio.wait([parked], timeout=PARKED)
+        assert not done
+        parked.cancel()
+
+    asyncio.run(logged_in_remote(scenario))
+
+
+async def post_entry(remote: Remote, entry: tags.DmapWriter) -> int:
+    async with remote.client.post(remote.base + "/ctrl-int/1/controlpromptentry",
+                                  params={"session-id": str(remote.session_id)}, data=entry.getvalue()) as resp:
+        await resp.read()
+        return resp.status
+
+
+def test_port_info_request_without_a_usable_cmte_is_rejected():
+    async def scenario(remote):
+        current_session = combined.app[combined.session].get(remote.session_id)
+        cmte = current_session.cmte
+        for value in (None, "not a number", "-1,0", "99999999999,0"):
+            entry = tags.DmapWriter()
+            entry.string("cmbe", "DRPortInfoRequest")
+            if value is not None:
+                entry.string("cmte", value)
+            assert await post_entry(remote, entry) == 400, value
+        assert current_session.cmte == cmte
+        assert not current_session.prompt_changed.is_set()
+
+    asyncio.run(logged_in_remote(scenario))
+
+
+def test_logout_answers_the_parked_request():
+    async def scenario(remote):
+        parked = asyncio.create_task(remote.client.get(
+            remote.base + "/controlpromptupdate", params=remote.prompt_params(10)))
+        await asyncio.sleep(0.1)
+        assert not parked.done()
+        await remote.request("logout", "GET", "/logout", params={"session-id": str(remote.session_id)})
+        async with await asyncio.wait_for(parked, PARKED) as resp:
+            assert resp.status == 503
+
+    asyncio.run(logged_in_remote(scenario))
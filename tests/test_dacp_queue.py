@@ -0,0 +1,138 @@
+"""CommandQueue merge, cancel and drop rules, and sending in order."""
+
+import asyncio
+
+from dacp_queue import CommandQueue, CommandQueues
+
+
+async def never_sent(command):
+    raise AssertionError(f"{command} sent")
+
+
+def pending(queue: CommandQueue) -> list[tuple[str, int]]:
+    return [(entry.command, entry.count) for entry in queue._pending]
+
+
+def test_volume_steps_merge_up_to_max_repeat():
+    queue = CommandQueue(never_sent, max_repeat=3)
+    for _ in range(5):
+        queue.put("volumeup")
+    assert pending(queue) == [("volumeup", 3)]
+    assert queue.depth == 3
+    assert queue.merged == 2
+    assert queue.dropped == 2
+
+
+def test_opposite_steps_cancel():
+    queue = CommandQueue(never_sent)
+    queue.put("volumeup")
+    queue.put("volumeup")
+    queue.put("volumedown")
+    assert pending(queue) == [("volumeup", 1)]
+    queue.put("volumedown")
+    assert pending(queue) == []
+    assert queue.merged == 1 + 2 + 2
+
+
+def test_toggles_cancel_in_pairs():
+    queue = CommandQueue(never_sent)
+    queue.put("playpause")
+    queue.put("playpause")
+    assert pending(queue) == []
+    queue.put("playpause")
+    queue.put("playpause")
+    queue.put("playpause")
+    assert pending(queue) == [("playpause", 1)]
+
+
+def test_only_the_last_entry_merges():
+    queue = CommandQueue(never_sent)
+    for command in ("volumeup", "nextitem", "volumeup", "playpause", "nextitem", "nextitem"):
+        queue.put(command)
+    assert pending(queue) == [("volumeup", 1), ("nextitem", 1), ("volumeup", 1), ("playpause", 1),
+                              ("nextitem", 1), ("nextitem", 1)]
+
+
+def test_full_queue_drops_the_oldest():
+    queue = CommandQueue(never_sent, max_size=3)
+    queue.put("volumeup")
+    queue.put("volumeup")
+    for command in ("nextitem", "previtem", "playpause"):
+        queue.put(command)
+    assert pending(queue) == [("nextitem", 1), ("previtem", 1), ("playpause", 1)]
+    assert queue.dropped == 2
+
+
+def run_queue(queue: CommandQueue, until) -> None:
+    async def run():
+        worker = asyncio.create_task(queue.run())
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if until():
+                    break
+        finally:
+            worker.cancel()
+
+    asyncio.run(run())
+
+
+def test_sends_in_order_and_counts_failures():
+    sent = []
+
+    async def send(command):
+        sent.append(command)
+        if command == "previtem":
+            return False
+        if command == "nextitem":
+            raise RuntimeError("boom")
+        return True
+
+    queue = CommandQueue(send)
+    for command in ("volumeup", "volumeup", "previtem", "nextitem", "playpause"):
+        queue.put(command)
+    run_queue(queue, lambda: len(sent) == 5)
+    assert sent == ["volumeup", "volumeup", "previtem", "nextitem", "playpause"]
+    assert (queue.sent, queue.failed, queue.depth) == (3, 2, 0)
+
+
+def test_stale_commands_are_dropped():
+    sent = []
+
+    async def send(command):
+        sent.append(command)
+
+    queue = CommandQueue(send, max_age=0.05)
+    queue.put("volumeup")
+    queue.put("volumeup")
+    queue._pending[0].queued_at -= 1
+    queue.put("playpause")
+    run_queue(queue, lambda: sent)
+    assert sent == ["playpause"]
+    assert queue.dropped == 2
+
+
+def test_slow_target_only_holds_up_its_own_queue():
+    sent = []
+
+    async def run():
+        blocked = asyncio.Event()
+
+        async def send(target, command):
+            if target == "slow":
+                await blocked.wait()
+            sent.append((target, command))
+
+        queues = CommandQueues(send)
+        queues.put("slow", "playpause")
+        queues.put("fast", "playpause")
+        queues.put("fast", "nextitem")
+        await asyncio.sleep(0.05)
+        assert sent == [("fast", "playpause"), ("fast", "nextitem")]
+        assert queues.depths() == {"slow": 0, "fast": 0}
+        blocked.set()
+        await asyncio.sleep(0.01)
+        assert sent[-1] == ("slow", "playpause")
+        await queues.close()
+
+    asyncio.run(run())
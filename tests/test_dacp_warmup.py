@@ -0,0 +1,92 @@
+"""warm_dacp_targets against a local stand-in DACP target with one reachable and one refusing address."""
+
+import asyncio
+import os
+import tempfile
+
+from aiohttp import web
+
+import combined
+from benchmarks.fake_dacp import FakeDacpTarget
+
+TARGET_HOST = "127.0.0.2"
+REFUSED = "127.0.0.1"  # nothing listens on the target's port here
+
+
+class PeerRecordingTarget(FakeDacpTarget):
+    """Remembers the client end of the connection every request came in on."""
+
+    def __init__(self) -> None:
+        super().__init__(host=TARGET_HOST)
+        self.peers: list[tuple[str, tuple]] = []
+
+    def _record_peer(self, request: web.Request) -> None:
+        self.peers.append((request.path, request.transport.get_extra_info("peername")))
+
+    async def _ctrl_int(self, request: web.Request) -> web.Response:
+        self._record_peer(request)
+        return await super()._ctrl_int(request)
+
+    async def _play_status_update(self, request: web.Request) -> web.Response:
+        self._record_peer(request)
+        return await super()._play_status_update(request)
+
+
+def warmups(path: str) -> int:
+    child = combined.DACP_WARMUPS._children.get((path, "200"))
+    return 0 if child is None else child.value
+
+
+async def eventually(condition, timeout: float = 5.0) -> None:
+    async def wait():
+        while not condition():
+            await asyncio.sleep(0.02)
+
+    await asyncio.wait_for(wait(), timeout)
+
+
+def test_credential_change_warms_up_once_and_the_first_command_reuses_it():
+    async def run():
+        target = PeerRecordingTarget()
+        await target.start()
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                credentials_file = os.path.join(directory, "uxplay.dacp")
+                target.write_credentials(credentials_file)
+                app = combined.make_app(
+                    pairing_store_file=os.path.join(directory, "pairings.jsonl"),
+                    uxplay_dacp_files=[credentials_file],
+                    address="127.0.0.1",
+                    port=0,
+                    advertise=False,
+                )
+                record = target.record()
+                record.addresses = [(REFUSED, target.port), (TARGET_HOST, target.port)]
+                app[combined.mdns_entries].add(record)
+                app.cleanup_ctx.remove(combined.now_playing_task)  # its polls would leave connections of their own
+                runner = web.AppRunner(app, shutdown_timeout=1.0)
+                await runner.setup()
+                try:
+                    await eventually(lambda: warmups(credentials_file) == 1)
+
+                    # UxPlay writes new credentials: the watcher sees them and the warm-up checks them, once
+                    target.rotate_credentials(credentials_file)
+                    await eventually(lambda: warmups(credentials_file) == 2)
+                    await asyncio.sleep(2 * combined.UXPLAY_DACP_POLL_INTERVAL)
+                    assert warmups(credentials_file) == 2
+
+                    connections = {peer for _, peer in target.peers}
+                    combined.queue_dacp_command("playpause")
+                    received = await target.wait_for("playpause", timeout=5)
+                    assert received.active_remote == target.active_remote
+                    # sent to the address the warm-up picked, over a connection that was already open
+                    assert app[combined.address_selector].races == 1
+                    assert app[combined.address_selector].cached(record.fqn, [TARGET_HOST, REFUSED]) == TARGET_HOST
+                    command_peer = next(peer for path, peer in target.peers if path.endswith("/playpause"))
+                    assert command_peer in connections
+                finally:
+                    await runner.cleanup()
+        finally:
+            await target.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,146 @@
+"""dmap_parser.parse and stream_extract over bodies built with tags.DmapWriter."""
+
+import asyncio
+
+import pytest
+
+import dmap_parser
+import tag_definitions
+import tags
+
+
+def parse(data):
+    return dmap_parser.parse(data, tag_definitions.lookup_tag)
+
+
+def test_flat_list_of_5000_tags():
+    # the recursive parser hit RecursionError on long flat tag lists
+    writer = tags.DmapWriter()
+    for index in range(5000):
+        writer.uint32("miid", index)
+    parsed = parse(writer.getvalue())
+    assert len(parsed) == 5000
+    assert parsed[0] == {"miid": 0}
+    assert parsed[-1] == {"miid": 4999}
+
+
+def test_deeply_nested_containers():
+    data = tags.uint32_tag("miid", 7)
+    for _ in range(2000):
+        data = tags.container_tag("mlit", data)
+    parsed = parse(data)
+    for _ in range(2000):
+        parsed = dmap_parser.first(parsed, "mlit")
+    assert parsed == [{"miid": 7}]
+
+
+def test_containers_and_values():
+    writer = tags.DmapWriter()
+    with writer.container("mlcl"):
+        with writer.container("mlit"):
+            writer.uint32("miid", 1)
+            writer.string("minm", "first")
+        with writer.container("mlit"):
+            writer.uint32("miid", 2)
+    writer.uint8("caps", 4)
+    parsed = parse(writer.getvalue())
+    assert parsed == [
+        {"mlcl": [{"mlit": [{"miid": 1}, {"minm": "first"}]}, {"mlit": [{"miid": 2}]}]},
+        {"caps": 4},
+    ]
+    assert dmap_parser.first(parsed, "mlcl", "mlit", "minm") == "first"
+    assert dmap_parser.first(parsed, "caps") == 4
+    assert dmap_parser.first(parsed, "mlcl", "cmsr") is None
+
+
+def test_empty_body():
+    assert parse(b"") == []
+
+
+def test_truncated_header():
+    with pytest.raises(ValueError):
+        parse(tags.uint32_tag("miid", 1) + b"mii")
+
+
+def test_tag_overrunning_the_body():
+    with pytest.raises(ValueError):
+        parse(tags.uint32_tag("miid", 1)[:-1])
+
+
+def test_tag_overrunning_its_container():
+    child = tags.uint32_tag("miid", 1)
+    container = b"mlit" + (len(child) - 1).to_bytes(4, "big") + child
+    with pytest.raises(ValueError):
+        parse(container)
+
+
+def pairing_answer(padding=100_000):
+    writer = tags.DmapWriter()
+    with writer.container("cmpa"):
+        writer.raw("mlit", b"\0" * padding)  # skipped without being kept
+        writer.uint64("cmpg", 0x0123456789ABCDEF)
+        writer.string("cmnm", "remote")
+    return writer.getvalue()
+
+
+def extract(data, paths, chunk_size=3, max_size=None):
+    """stream_extract over data fed to a StreamReader in small chunks."""
+    async def run():
+        reader = asyncio.StreamReader()
+
+        async def feed():
+            for start in range(0, len(data), chunk_size):
+                reader.feed_data(data[start:start + chunk_size])
+                await asyncio.sleep(0)
+            reader.feed_eof()
+
+        feeder = asyncio.create_task(feed())
+        try:
+            return await dmap_parser.stream_extract(reader, tag_definitions.lookup_tag, paths, max_size=max_size)
+        finally:
+            feeder.cancel()
+
+    return asyncio.run(run())
+
+
+def test_stream_extract_from_chunks():
+    found = extract(pairing_answer(), [("cmpa", "cmpg"), ("cmpa", "cmnm"), ("cmpa", "cmty")], chunk_size=1000)
+    assert found == {("cmpa", "cmpg"): 0x0123456789ABCDEF, ("cmpa", "cmnm"): "remote"}
+
+
+def test_stream_extract_byte_by_byte():
+    # every header and payload split across reads
+    assert extract(pairing_answer(padding=10), [("cmpa", "cmnm")], chunk_size=1) == {("cmpa", "cmnm"): "remote"}
+
+
+def test_stream_extract_stops_once_everything_is_found():
+    data = pairing_answer() + b"garbage that is never read"
+    assert extract(data, [("cmpa", "cmpg")], chunk_size=4096) == {("cmpa", "cmpg"): 0x0123456789ABCDEF}
+
+
+def test_stream_extract_container():
+    data = pairing_answer()
+    found = extract(tags.container_tag("mlcl", data), [("mlcl", "cmpa")], chunk_size=4096)
+    assert dmap_parser.first(found[("mlcl", "cmpa")], "cmnm") == "remote"
+
+
+def test_stream_extract_max_size():
+    with pytest.raises(ValueError, match="maximum size"):
+        extract(pairing_answer(), [("cmpa", "cmnm")], chunk_size=4096, max_size=50_000)
+    found = extract(pairing_answer(), [("cmpa", "cmnm")], chunk_size=4096, max_size=200_000)
+    assert found == {("cmpa", "cmnm"): "remote"}
+
+
+def test_stream_extract_truncated_payload():
+    with pytest.raises(ValueError):
+        extract(pairing_answer()[:-2], [("cmpa", "cmnm")])
+
+
+def test_stream_extract_truncated_header():
+    data = pairing_answer()
+    with pytest.raises(ValueError):
+        extract(data[:data.index(b"cmnm") + 5], [("cmpa", "cmnm")])
+
+
+def test_stream_extract_empty_stream():
+    assert extract(b"", [("cmpa", "cmpg")]) == {}
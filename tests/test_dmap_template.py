@@ -0,0 +1,64 @@
+"""DmapTemplate output compared with the same responses encoded by tags.DmapWriter."""
+
+import pytest
+
+import combined
+from dmap_template import DmapTemplate
+import tags
+
+
+def prompt(miid: int, mstt: int = 200, mper: int = 7) -> bytes:
+    writer = tags.DmapWriter()
+    with writer.container("cmcp"):
+        writer.uint32("mstt", mstt)
+        writer.uint32("miid", miid)
+        with writer.container("mdcl"):
+            writer.string("cmce", "kKeybMsgKey_String")
+            writer.string("cmcv", "1234")
+        writer.uint64("mper", mper)  # found by skipping over the container before it
+    return writer.getvalue()
+
+
+def test_render_matches_the_writer():
+    template = DmapTemplate(prompt(0), miid=("cmcp", "miid"), mper=("cmcp", "mper"))
+    for miid in (0, 1, 10, 11, 255, 256, 65536, 2 ** 32 - 1, 10):
+        assert template.render(miid=miid) == prompt(miid)
+    assert template.render(miid=3, mper=2 ** 64 - 1) == prompt(3, mper=2 ** 64 - 1)
+
+
+def test_fields_keep_their_last_value():
+    template = DmapTemplate(prompt(5, mstt=200), miid=("cmcp", "miid"), mstt=("cmcp", "mstt"))
+    template.render(mstt=404)
+    assert template.render(miid=6) == prompt(6, mstt=404)
+    assert template.render() == prompt(6, mstt=404)
+
+
+def test_unchanged_values_return_the_cached_bytes():
+    template = DmapTemplate(prompt(0), miid=("cmcp", "miid"))
+    first = template.render(miid=10)
+    assert template.render(miid=10) is first
+    assert template.render() is first
+    assert template.render(miid=11) is not first
+    assert first == prompt(10)  # the earlier result is not patched afterwards
+
+
+def test_value_too_wide_for_its_field():
+    template = DmapTemplate(prompt(0), miid=("cmcp", "miid"), mstt=("cmcp", "mstt"))
+    before = template.render(miid=1)
+    with pytest.raises(OverflowError):
+        template.render(mstt=404, miid=2 ** 32)
+    with pytest.raises(OverflowError):
+        template.render(miid=-1)
+    # nothing was patched, not even the field that fit
+    assert template.render() is before
+    assert template.render(miid=2) == prompt(2)
+
+
+def test_unknown_path():
+    with pytest.raises(KeyError):
+        DmapTemplate(prompt(0), miid=("cmcp", "mdcl", "miid"))
+
+
+def test_server_info_template_matches_a_fresh_response():
+    for utc_time in (0, 1_700_000_000, 2 ** 32 - 1):
+        assert combined.SERVER_INFO_TEMPLATE.render(mstc=utc_time) == combined.build_server_info(utc_time)
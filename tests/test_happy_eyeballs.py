@@ -0,0 +1,167 @@
+"""AddressSelector races against loopback listeners and a port nothing listens on."""
+
+import asyncio
+
+from happy_eyeballs import AddressSelector, interleave
+
+REFUSED = "127.0.0.1"  # nothing listens on the test port here, connects are refused at once
+
+
+class Listeners:
+    """Listeners on one port of several loopback addresses, recording each connection until the peer closes it."""
+
+    def __init__(self) -> None:
+        self.port = 0
+        self.accepted: list[str] = []
+        self.closed_by_peer = 0
+        self._servers: list[asyncio.Server] = []
+
+    async def _handle(self, reader, writer) -> None:
+        self.accepted.append(writer.get_extra_info("sockname")[0])
+        await reader.read()
+        self.closed_by_peer += 1
+        writer.close()
+
+    async def start(self, *addresses: str) -> "Listeners":
+        for address in addresses:
+            server = await asyncio.start_server(self._handle, address, self.port)
+            self.port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        return self
+
+    async def close(self) -> None:
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+
+
+async def with_listeners(scenario, *addresses: str) -> None:
+    listeners = await Listeners().start(*addresses)
+    try:
+        await scenario(listeners)
+    finally:
+        await listeners.close()
+
+
+def test_interleave_alternates_families_ipv6_first():
+    assert interleave(["10.0.0.1", "10.0.0.2", "fe80::1", "10.0.0.3", "fe80::2"]) == [
+        "fe80::1", "10.0.0.1", "fe80::2", "10.0.0.2", "10.0.0.3"]
+    assert interleave(["10.0.0.1", "10.0.0.2"]) == ["10.0.0.1", "10.0.0.2"]
+    assert interleave(["::1"]) == ["::1"]
+    assert interleave([]) == []
+
+
+def test_first_reachable_address_wins():
+    async def scenario(listeners):
+        # the refused address is tried first and fails before the delay, the next one starts right away
+        selector = AddressSelector(delay=5)
+        winner = await asyncio.wait_for(selector.pick("device", [REFUSED, "127.0.0.2"], listeners.port), 1)
+        assert winner == "127.0.0.2"
+        assert selector.cached("device", [REFUSED, "127.0.0.2"]) == "127.0.0.2"
+
+    asyncio.run(with_listeners(scenario, "127.0.0.2"))
+
+
+def test_earlier_address_wins_and_probes_are_closed():
+    async def scenario(listeners):
+        selector = AddressSelector(delay=0)
+        assert await selector.pick("device", ["127.0.0.3", "127.0.0.2"], listeners.port) in ("127.0.0.3", "127.0.0.2")
+        selector = AddressSelector(delay=5)
+        assert await selector.pick("other", ["127.0.0.3", "127.0.0.2"], listeners.port) == "127.0.0.3"
+        await asyncio.sleep(0.05)
+        # winning and losing probe connections alike are closed, nothing is left open on the listeners
+        assert listeners.accepted
+        assert listeners.closed_by_peer == len(listeners.accepted)
+
+    asyncio.run(with_listeners(scenario, "127.0.0.2", "127.0.0.3"))
+
+
+def test_nothing_connects():
+    async def run():
+        selector = AddressSelector(delay=0.01)
+        assert await selector.pick("device", [REFUSED, "127.0.0.4", "::1"], 9) is None
+        assert selector.cached("device", [REFUSED, "127.0.0.4", "::1"]) is None
+        assert await selector.pick("device", [], 9) is None
+
+    asyncio.run(run())
+
+
+def test_slow_address_is_raced_after_the_delay():
+    async def run():
+        class Selector(AddressSelector):
+            async def _connect(self, address, port):
+                if address == "192.0.2.1":
+                    await asyncio.sleep(10)  # a blackholed address, never answers
+                return address
+
+        selector = Selector(delay=0.01)
+        assert await asyncio.wait_for(selector.pick("device", ["192.0.2.1", "192.0.2.2"], 9), 1) == "192.0.2.2"
+
+    asyncio.run(run())
+
+
+def test_concurrent_picks_share_one_race():
+    async def scenario(listeners):
+        selector = AddressSelector(delay=5)
+        addresses = [REFUSED, "127.0.0.2"]
+        winners = await asyncio.gather(*(selector.pick("device", addresses, listeners.port) for _ in range(10)))
+        assert winners == ["127.0.0.2"] * 10
+        assert selector.races == 1
+        assert len(listeners.accepted) == 1
+
+    asyncio.run(with_listeners(scenario, "127.0.0.2"))
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_race():
+    async def scenario(listeners):
+        selector = AddressSelector(delay=5)
+        addresses = [REFUSED, "127.0.0.2"]
+        first = asyncio.create_task(selector.pick("device", addresses, listeners.port))
+        second = asyncio.create_task(selector.pick("device", addresses, listeners.port))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "127.0.0.2"
+        assert selector.races == 1
+
+    asyncio.run(with_listeners(scenario, "127.0.0.2"))
+
+
+def test_forget_races_again():
+    async def scenario(listeners):
+        selector = AddressSelector(delay=5)
+        addresses = [REFUSED, "127.0.0.2"]
+        assert await selector.pick("device", addresses, listeners.port) == "127.0.0.2"
+        assert await selector.pick("device", addresses, listeners.port) == "127.0.0.2"
+        assert selector.races == 1
+        selector.forget("device")
+        assert await selector.pick("device", addresses, listeners.port) == "127.0.0.2"
+        assert selector.races == 2
+        # and so does a winner that is no longer among the device's addresses
+        assert await selector.pick("device", [REFUSED, "127.0.0.3"], listeners.port) is None
+        assert selector.races == 3
+
+    asyncio.run(with_listeners(scenario, "127.0.0.2"))
+
+
+def test_single_address_is_not_raced():
+    async def run():
+        selector = AddressSelector()
+        assert await selector.pick("device", ["192.0.2.1"], 9) == "192.0.2.1"
+        assert selector.races == 0
+
+    asyncio.run(run())
+
+
+def test_winners_are_capped():
+    async def run():
+        class Selector(AddressSelector):
+            async def _connect(self, address, port):
+                return address
+
+        selector = Selector(max_entries=2)
+        for device in ("a", "b", "c"):
+            await selector.pick(device, ["192.0.2.1", "192.0.2.2"], 9)
+        assert selector.cached("a", ["192.0.2.1", "192.0.2.2"]) is None
+        assert selector.cached("c", ["192.0.2.1", "192.0.2.2"]) == "192.0.2.1"
+
+    asyncio.run(run())
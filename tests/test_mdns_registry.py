@@ -0,0 +1,111 @@
+"""MdnsRegistry TTL expiry, the size cap and the DACP id and pairing guid indexes."""
+
+import pytest
+
+import mdns_registry
+from mdns_registry import ClientRemoteControlRecord, ClientRemotePairingRecord, MdnsRegistry, dacp_id_from_fqn
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A time.monotonic() the test moves forward by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(mdns_registry.time, "monotonic", lambda: now[0])
+    return now
+
+
+def target(dacp_id: str) -> ClientRemoteControlRecord:
+    return ClientRemoteControlRecord(f"iTunes_Ctrl_{dacp_id}._dacp._tcp.local.", 3689, ["192.0.2.1"], dacp_id)
+
+
+def remote(pairing_guid: str) -> ClientRemotePairingRecord:
+    return ClientRemotePairingRecord(f"{pairing_guid}._touch-remote._tcp.local.", 1024, pairing_guid, ["192.0.2.2"],
+                                     "iPhone")
+
+
+def assert_unindexed(registry: MdnsRegistry) -> None:
+    assert registry._by_dacp_id == {}
+    assert registry._by_pairing_guid == {}
+
+
+def test_dacp_id_from_fqn():
+    assert dacp_id_from_fqn("iTunes_Ctrl_0123456789abcdef._dacp._tcp.local.") == "0123456789ABCDEF"
+    assert dacp_id_from_fqn("iTunes_Ctrl_ABCD") == "ABCD"
+    assert dacp_id_from_fqn("other._dacp._tcp.local.") == "OTHER"
+
+
+def test_lookups_by_index_ignore_case(clock):
+    registry = MdnsRegistry()
+    registry.add(target("0123456789ABCDEF"), ttl=120)
+    registry.add(remote("FEDCBA9876543210"), ttl=120)
+    assert registry.by_dacp_id("0123456789abcdef").name == "0123456789ABCDEF"
+    assert registry.by_pairing_guid("fedcba9876543210").pairing_guid == "FEDCBA9876543210"
+    assert registry.by_dacp_id("FEDCBA9876543210") is None
+    assert registry.by_pairing_guid("0123456789ABCDEF") is None
+
+
+def test_records_expire_on_their_ttl(clock):
+    registry = MdnsRegistry()
+    registry.add(target("AAAA"), ttl=120)
+    registry.add(remote("BBBB"), ttl=10)
+    clock[0] += 10
+    assert registry.by_pairing_guid("BBBB") is not None
+    clock[0] += 1
+    assert registry.by_pairing_guid("BBBB") is None
+    assert "BBBB" not in registry._by_pairing_guid
+    assert registry.by_dacp_id("AAAA") is not None
+    clock[0] += 110
+    assert registry.by_dacp_id("AAAA") is None
+    assert len(registry) == 0
+    assert_unindexed(registry)
+
+
+def test_records_drops_expired_entries(clock):
+    registry = MdnsRegistry()
+    registry.add(target("AAAA"), ttl=10)
+    registry.add(remote("BBBB"), ttl=10)
+    registry.add(remote("CCCC"), ttl=60)
+    clock[0] += 11
+    assert list(registry.records(ClientRemotePairingRecord)) == ["CCCC._touch-remote._tcp.local."]
+    assert registry.records(ClientRemoteControlRecord) == {}
+    assert len(registry) == 1
+    assert registry._by_dacp_id == {}
+    assert list(registry._by_pairing_guid) == ["CCCC"]
+
+
+def test_default_ttl(clock):
+    registry = MdnsRegistry()
+    registry.add(target("AAAA"))
+    clock[0] += mdns_registry.DEFAULT_TTL
+    assert registry.by_dacp_id("AAAA") is not None
+    clock[0] += 1
+    assert registry.by_dacp_id("AAAA") is None
+
+
+def test_least_recently_used_record_is_evicted(clock):
+    registry = MdnsRegistry(max_entries=2)
+    registry.add(target("AAAA"), ttl=120)
+    registry.add(remote("BBBB"), ttl=120)
+    assert registry.by_dacp_id("AAAA") is not None  # now the most recently used
+    registry.add(remote("CCCC"), ttl=120)
+    assert len(registry) == 2
+    assert registry.by_pairing_guid("BBBB") is None
+    assert "BBBB" not in registry._by_pairing_guid
+    registry.add(target("DDDD"), ttl=120)
+    assert registry.by_dacp_id("AAAA") is None
+    assert "AAAA" not in registry._by_dacp_id
+    assert set(registry._by_dacp_id) == {"DDDD"}
+    assert set(registry._by_pairing_guid) == {"CCCC"}
+
+
+def test_replacing_a_record_moves_its_index(clock):
+    registry = MdnsRegistry()
+    registry.add(remote("BBBB"), ttl=120)
+    moved = remote("CCCC")
+    moved.fqn = "BBBB._touch-remote._tcp.local."  # same service, now with another pairing guid
+    registry.add(moved, ttl=120)
+    assert registry.by_pairing_guid("BBBB") is None
+    assert registry.by_pairing_guid("CCCC") is moved
+    assert registry.remove(moved.fqn) is moved
+    assert_unindexed(registry)
+    assert registry.remove(moved.fqn) is None
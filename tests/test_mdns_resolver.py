@@ -0,0 +1,233 @@
+"""ServiceResolver over a zeroconf record cache filled by hand, with lookups that answer when told to."""
+
+import asyncio
+import socket
+
+import pytest
+from zeroconf import DNSAddress, DNSCache, DNSService, DNSText, ServiceStateChange, current_time_millis
+from zeroconf.asyncio import AsyncServiceInfo
+
+import mdns_resolver
+from mdns_resolver import ServiceResolver, remaining_ttl
+
+SERVICE_TYPE = "_touch-remote._tcp.local."
+NAME = f"remote.{SERVICE_TYPE}"
+SERVER = "iphone.local."
+_CLASS_IN = 1
+_TYPE_A = 1
+_TYPE_TXT = 16
+_TYPE_SRV = 33
+
+
+class FakeZeroconf:
+    """All ServiceResolver and AsyncServiceInfo.load_from_cache need of a Zeroconf: its record cache."""
+
+    def __init__(self) -> None:
+        self.cache = DNSCache()
+
+    def answer(self, ttl: float = 120, age: float = 0, port: int = 1024, address: str = "192.0.2.1",
+               properties: bytes = b"\x07DvNm=me") -> None:
+        """Cache records as if a device had answered age seconds ago with the given TTL."""
+        created = current_time_millis() - age * 1000
+        self.cache.async_add_records([
+            DNSService(NAME, _TYPE_SRV, _CLASS_IN, ttl, 0, 0, port, SERVER, created=created),
+            DNSText(NAME, _TYPE_TXT, _CLASS_IN, ttl, properties, created=created),
+            DNSAddress(SERVER, _TYPE_A, _CLASS_IN, ttl, socket.inet_aton(address), created=created),
+        ])
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Swaps in an AsyncServiceInfo whose async_request waits for the returned event, then answers from the cache."""
+    answer = asyncio.Event()
+    requests = []
+
+    class Info(AsyncServiceInfo):
+        async def async_request(self, zc, timeout, *args, **kwargs):
+            requests.append(self.name)
+            await answer.wait()
+            return self.load_from_cache(zc)
+
+    monkeypatch.setattr(mdns_resolver, "AsyncServiceInfo", Info)
+    answer.requests = requests
+    return answer
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A time.monotonic() the test moves forward by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(mdns_resolver.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_resolver(zeroconf: FakeZeroconf) -> tuple[ServiceResolver, list]:
+    resolved = []
+    resolver = ServiceResolver(zeroconf, lambda service_type, name, info: resolved.append(info))
+    return resolver, resolved
+
+
+def fire(resolver: ServiceResolver) -> None:
+    """Run the scheduled refresh of NAME now instead of waiting for it."""
+    resolver._refreshes[NAME].cancel()
+    resolver._refresh(SERVICE_TYPE, NAME)
+
+
+async def settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_events_share_one_lookup(lookups):
+    async def run():
+        zeroconf = FakeZeroconf()
+        resolver, resolved = make_resolver(zeroconf)
+        for state_change in (ServiceStateChange.Added, ServiceStateChange.Updated, ServiceStateChange.Added):
+            resolver.update(SERVICE_TYPE, NAME, state_change)
+        await settle()
+        assert lookups.requests == [NAME]
+        assert (resolver.lookups, resolver.joined) == (1, 2)
+        zeroconf.answer()
+        lookups.set()
+        await settle()
+        assert len(resolved) == 1
+        assert resolved[0].port == 1024
+        assert resolver.get(NAME) is resolved[0]
+        await resolver.close()
+
+    asyncio.run(run())
+
+
+def test_remaining_ttl_is_the_first_record_to_expire():
+    zeroconf = FakeZeroconf()
+    zeroconf.answer(ttl=120, age=20)
+    info = AsyncServiceInfo(SERVICE_TYPE, NAME)
+    assert info.load_from_cache(zeroconf)
+    assert remaining_ttl(zeroconf, info) == pytest.approx(100, abs=1)
+    # a renewed address record alone does not extend the service's SRV and TXT records
+    zeroconf.cache.async_add_records([DNSAddress(SERVER, _TYPE_A, _CLASS_IN, 4500, socket.inet_aton("192.0.2.1"))])
+    assert remaining_ttl(zeroconf, info) == pytest.approx(100, abs=1)
+    assert remaining_ttl(FakeZeroconf(), info) == 0
+
+
+def test_entry_is_gone_once_its_records_expire(lookups, clock):
+    async def run():
+        zeroconf = FakeZeroconf()
+        zeroconf.answer(ttl=120, age=100)
+        lookups.set()
+        resolver, resolved = make_resolver(zeroconf)
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Added)
+        await settle()
+        assert resolver.get(NAME) is resolved[0]
+        clock[0] += 19
+        assert resolver.get(NAME) is resolved[0]
+        clock[0] += 2
+        assert resolver.get(NAME) is None
+        await resolver.close()
+
+    asyncio.run(run())
+
+
+def test_records_that_already_expired_are_not_kept(lookups):
+    async def run():
+        zeroconf = FakeZeroconf()
+        zeroconf.answer(ttl=120, age=121)
+        lookups.set()
+        resolver, resolved = make_resolver(zeroconf)
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Added)
+        await settle()
+        assert resolved == []
+        assert resolver.get(NAME) is None
+
+    asyncio.run(run())
+
+
+def test_refresh_is_scheduled_at_80_percent_of_the_ttl(lookups):
+    async def run():
+        zeroconf = FakeZeroconf()
+        zeroconf.answer(ttl=120, age=20)
+        lookups.set()
+        resolver, resolved = make_resolver(zeroconf)
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Added)
+        await settle()
+        refresh = resolver._refreshes[NAME]
+        assert refresh.when() - asyncio.get_running_loop().time() == pytest.approx(100 * mdns_resolver.REFRESH_AT, abs=1)
+
+        # the device renewed its records: the refresh passes them on with the new TTL, without a lookup
+        zeroconf.answer(ttl=120)
+        fire(resolver)
+        assert len(resolved) == 2
+        assert len(lookups.requests) == 1
+        renewed = resolver._refreshes[NAME]
+        assert renewed is not refresh
+        assert renewed.when() - asyncio.get_running_loop().time() == pytest.approx(120 * mdns_resolver.REFRESH_AT, abs=1)
+        await resolver.close()
+        assert resolver._refreshes == {}
+
+    asyncio.run(run())
+
+
+def test_refresh_looks_up_records_that_were_not_renewed(lookups):
+    async def run():
+        zeroconf = FakeZeroconf()
+        zeroconf.answer(ttl=120, age=20)
+        lookups.set()
+        resolver, resolved = make_resolver(zeroconf)
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Added)
+        await settle()
+        zeroconf.cache = DNSCache()  # the records expired and were purged
+        fire(resolver)
+        await settle()
+        assert len(lookups.requests) == 2
+        assert resolver.get(NAME) is None  # nobody answered, the entry is dropped
+        await resolver.close()
+
+    asyncio.run(run())
+
+
+def test_updated_reloads_from_the_cache(lookups):
+    async def run():
+        zeroconf = FakeZeroconf()
+        zeroconf.answer()
+        lookups.set()
+        resolver, resolved = make_resolver(zeroconf)
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Added)
+        await settle()
+        assert len(resolved) == 1
+
+        # a changed TXT record, already cached by zeroconf
+        zeroconf.cache.async_add_records([DNSText(NAME, _TYPE_TXT, _CLASS_IN, 120, b"\x0bDvNm=other")])
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Updated)
+        assert (resolver.lookups, resolver.cached) == (1, 1)
+        assert len(resolved) == 2
+        assert resolved[-1].properties[b"DvNm"] == b"other"
+
+        # nothing changed: answered from the cache, listeners aren't called again
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Updated)
+        assert (resolver.lookups, resolver.cached) == (1, 2)
+        assert len(resolved) == 2
+
+        # Added always looks the service up again
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Added)
+        await settle()
+        assert resolver.lookups == 2
+        await resolver.close()
+
+    asyncio.run(run())
+
+
+def test_removed_forgets_the_service(lookups):
+    async def run():
+        zeroconf = FakeZeroconf()
+        zeroconf.answer()
+        resolver, resolved = make_resolver(zeroconf)
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Added)
+        await settle()
+        resolver.update(SERVICE_TYPE, NAME, ServiceStateChange.Removed)  # cancels the lookup in flight
+        lookups.set()
+        await settle()
+        assert resolved == []
+        assert resolver.get(NAME) is None
+        assert resolver._refreshes == {}
+
+    asyncio.run(run())
@@ -0,0 +1,105 @@
+"""The Prometheus text format rendered by metrics, and the labels the HTTP middleware uses."""
+
+import asyncio
+
+from aiohttp import ClientSession, web
+import pytest
+
+import combined
+import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+def test_counter(registry):
+    counter = metrics.Counter("requests_total", "Requests handled", ("route", "status"), registry=registry)
+    counter.labels("/login", "200").inc()
+    counter.labels("/login", "200").inc(2)
+    counter.labels("/logout", "204").inc()
+    assert registry.render() == (
+        "# HELP requests_total Requests handled\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{route="/login",status="200"} 3\n'
+        'requests_total{route="/logout",status="204"} 1\n'
+    )
+
+
+def test_unlabelled_counter(registry):
+    counter = metrics.Counter("frames_total", "Frames", registry=registry)
+    counter.inc()
+    counter.inc(0.5)
+    assert registry.render().splitlines()[-1] == "frames_total 1.5"
+
+
+def test_wrong_number_of_labels(registry):
+    counter = metrics.Counter("requests_total", "Requests handled", ("route",), registry=registry)
+    with pytest.raises(ValueError):
+        counter.labels("/login", "200")
+
+
+def test_histogram(registry):
+    histogram = metrics.Histogram("latency_seconds", "Latency", ("route",), buckets=(0.5, 0.1), registry=registry)
+    for value in (0.05, 0.1, 0.3, 2):
+        histogram.labels("/login").observe(value)
+    assert registry.render() == (
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{route="/login",le="0.1"} 2\n'
+        'latency_seconds_bucket{route="/login",le="0.5"} 3\n'
+        'latency_seconds_bucket{route="/login",le="+Inf"} 4\n'
+        'latency_seconds_sum{route="/login"} 2.45\n'
+        'latency_seconds_count{route="/login"} 4\n'
+    )
+
+
+def test_label_values_are_escaped(registry):
+    counter = metrics.Counter("odd_total", "Odd labels", ("value",), registry=registry)
+    counter.labels('back\\slash "quoted"\nnext line').inc()
+    assert registry.render().splitlines()[-1] == 'odd_total{value="back\\\\slash \\"quoted\\"\\nnext line"} 1'
+
+
+def test_gauges_are_read_when_rendered(registry):
+    depth = {"a": 1}
+    metrics.Gauge("sessions", "Sessions", lambda: len(depth), registry=registry)
+    metrics.Gauge("depth", "Depth", lambda: {(target,): value for target, value in depth.items()}, ("target",),
+                  registry=registry)
+    assert registry.render().splitlines()[2:] == [
+        "sessions 1", "# HELP depth Depth", "# TYPE depth gauge", 'depth{target="a"} 1']
+    depth["b"] = 2.5
+    assert registry.render().splitlines()[2:] == [
+        "sessions 2", "# HELP depth Depth", "# TYPE depth gauge", 'depth{target="a"} 1', 'depth{target="b"} 2.5']
+    assert not hasattr(registry._metrics["depth"], "labels")
+
+
+def test_names_are_registered_once(registry):
+    metrics.Counter("requests_total", "Requests handled", registry=registry)
+    with pytest.raises(ValueError):
+        metrics.Counter("requests_total", "Requests handled", registry=registry)
+
+
+def test_middleware_folds_unknown_methods_into_other():
+    async def run():
+        async def handler(request):
+            return web.Response(text="ok")
+
+        app = web.Application(middlewares=[combined.metrics_middleware])
+        app.router.add_route("*", "/metrics-test", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            base = f"http://127.0.0.1:{runner.addresses[0][1]}/metrics-test"
+            async with ClientSession() as client:
+                for method in ("GET", "POST", "PUT", "PROPFIND", "MKCALENDAR"):
+                    async with client.request(method, base) as resp:
+                        assert resp.status == 200
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    methods = {values[1] for values in combined.HTTP_REQUESTS._children if values[0] == "/metrics-test"}
+    assert methods == {"GET", "POST", "other"}
@@ -0,0 +1,85 @@
+"""poll_now_playing against a local stand-in DACP target."""
+
+import asyncio
+import os
+import tempfile
+
+from aiohttp import web
+
+import combined
+import tags
+from benchmarks.fake_dacp import FakeDacpTarget
+from play_status import PLAY_STATUS_PLAYING, PLAY_STATUS_STOPPED
+
+RUN_FOR = 2.5  # seconds the app polls the target
+
+
+class CountingTarget(FakeDacpTarget):
+    """Counts playstatusupdate polls, answering them with answer() when given."""
+
+    def __init__(self, answer=None) -> None:
+        super().__init__()
+        self.answer = answer
+        self.polls = 0
+
+    async def _play_status_update(self, request: web.Request) -> web.Response:
+        self.polls += 1
+        if self.answer is None:
+            return await super()._play_status_update(request)
+        return self.answer()
+
+
+def play_status_without_revision() -> web.Response:
+    writer = tags.DmapWriter()
+    with writer.container("cmst"):
+        writer.uint32("mstt", 200)
+        writer.uint8("caps", PLAY_STATUS_PLAYING)
+    return web.Response(body=writer.getvalue(), content_type="application/x-dmap-tagged")
+
+
+async def poll(target: CountingTarget) -> web.Application:
+    """Run the app against the target for RUN_FOR seconds."""
+    await target.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            credentials_file = os.path.join(directory, "uxplay.dacp")
+            target.write_credentials(credentials_file)
+            app = combined.make_app(
+                pairing_store_file=os.path.join(directory, "pairings.jsonl"),
+                uxplay_dacp_files=[credentials_file],
+                address="127.0.0.1",
+                port=0,
+                advertise=False,
+            )
+            app[combined.mdns_entries].add(target.record())
+            runner = web.AppRunner(app)
+            await runner.setup()
+            try:
+                await asyncio.sleep(RUN_FOR)
+            finally:
+                await runner.cleanup()
+            return app
+    finally:
+        await target.stop()
+
+
+def test_mirrors_the_target_state_and_holds_the_poll():
+    target = CountingTarget()
+    app = asyncio.run(poll(target))
+    assert app[combined.play_status].state.caps == PLAY_STATUS_STOPPED
+    # warm-up check, the first poll (answered at once) and the held one
+    assert target.polls <= 3
+
+
+def test_backs_off_when_the_target_answers_204_at_once():
+    target = CountingTarget(lambda: web.Response(status=204))
+    asyncio.run(poll(target))
+    # polls after 0, 1 and 3 seconds, plus the warm-up check
+    assert 2 <= target.polls <= 4
+
+
+def test_backs_off_when_the_target_answers_without_a_revision():
+    target = CountingTarget(play_status_without_revision)
+    app = asyncio.run(poll(target))
+    assert app[combined.play_status].state.caps == PLAY_STATUS_PLAYING
+    assert 2 <= target.polls <= 4
@@ -0,0 +1,96 @@
+"""PairingStore add, load and compaction of the append-only log."""
+
+import asyncio
+import json
+
+import pytest
+
+import pairing_store
+from pairing_store import PairingStore
+
+
+def add(store: PairingStore, guid, name=None) -> pairing_store.Pairing:
+    return asyncio.run(store.add(guid, name, "iPhone", "remote._touch-remote._tcp.local."))
+
+
+def lines(path) -> list[dict]:
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+def test_guid_forms_are_normalized(tmp_path):
+    store = PairingStore(str(tmp_path / "pairings.jsonl"))
+    pairing = add(store, "0x00ab12")
+    assert pairing.guid == "AB12"
+    assert "ab12" in store
+    assert "0xAB12" in store
+    assert 0xAB12 in store
+    assert "not hex" not in store
+    with pytest.raises(ValueError):
+        add(store, "not hex")
+
+
+def test_pairings_survive_a_restart(tmp_path):
+    path = str(tmp_path / "pairings.jsonl")
+    store = PairingStore(path)
+    add(store, "AB12", "first")
+    add(store, "CD34", "second")
+    add(store, "AB12", "renamed")
+
+    reloaded = PairingStore(path)
+    reloaded.load()
+    assert len(reloaded) == 2
+    assert reloaded.get("AB12").name == "renamed"
+    assert reloaded.get("CD34").name == "second"
+
+
+def test_missing_file_loads_empty(tmp_path):
+    store = PairingStore(str(tmp_path / "pairings.jsonl"))
+    store.load()
+    assert len(store) == 0
+
+
+def test_bad_lines_are_skipped(tmp_path):
+    path = tmp_path / "pairings.jsonl"
+    store = PairingStore(str(path))
+    add(store, "AB12")
+    with open(path, "a") as file:
+        file.write("not json\n")
+        file.write(json.dumps({"guid": "CD34"}) + "\n")  # missing fields
+    add(store, "EF56")
+
+    reloaded = PairingStore(str(path))
+    reloaded.load()
+    assert sorted(pairing.guid for pairing in reloaded.pairings()) == ["AB12", "EF56"]
+
+
+def test_load_compacts_a_log_full_of_duplicates(tmp_path):
+    path = str(tmp_path / "pairings.jsonl")
+    store = PairingStore(path)
+    for index in range(40):
+        add(store, "AB12", f"name {index}")
+    add(store, "CD34")
+    assert len(lines(path)) == 41
+
+    reloaded = PairingStore(path)
+    reloaded.load()
+    compacted = lines(path)
+    assert len(compacted) == 2
+    assert {entry["guid"]: entry["name"] for entry in compacted}["AB12"] == "name 39"
+    assert not (tmp_path / "pairings.jsonl.tmp").exists()
+
+
+def test_load_leaves_a_log_with_few_duplicates_alone(tmp_path):
+    path = str(tmp_path / "pairings.jsonl")
+    store = PairingStore(path)
+    for _ in range(3):
+        add(store, "AB12")
+    PairingStore(path).load()
+    assert len(lines(path)) == 3
+
+
+def test_failed_write_does_not_pair(tmp_path):
+    store = PairingStore(str(tmp_path / "missing" / "pairings.jsonl"))
+    with pytest.raises(OSError):
+        add(store, "AB12")
+    assert "AB12" not in store
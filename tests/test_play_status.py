@@ -0,0 +1,68 @@
+"""PlayStatusStore revisions, long poll wake-ups and the shared response."""
+
+import asyncio
+
+import dmap_parser
+import tag_definitions
+from play_status import PLAY_STATUS_PLAYING, PlayStatusStore
+
+
+def test_update_bumps_the_revision_only_on_change():
+    store = PlayStatusStore()
+    assert store.update(caps=PLAY_STATUS_PLAYING, cann="track")
+    assert store.revision == 3
+    assert not store.update(caps=PLAY_STATUS_PLAYING)
+    assert store.revision == 3
+
+
+def test_wait_for_change_answers_a_stale_revision_at_once():
+    async def run():
+        store = PlayStatusStore()
+        store.update(caps=PLAY_STATUS_PLAYING)
+        assert await store.wait_for_change(2, 0)
+        assert await store.wait_for_change(100, 0)  # ahead, e.g. after a restart
+
+    asyncio.run(run())
+
+
+def test_wait_for_change_times_out_without_change():
+    async def run():
+        store = PlayStatusStore()
+        assert not await store.wait_for_change(store.revision, 0.01)
+        store.update(cann="track")
+        waiter = asyncio.create_task(store.wait_for_change(store.revision, 0.05))
+        await asyncio.sleep(0)
+        store.update(cann="track")  # nothing changed, nobody is woken
+        assert not await waiter
+
+    asyncio.run(run())
+
+
+def test_one_update_wakes_every_waiter():
+    async def run():
+        store = PlayStatusStore()
+        waiters = [asyncio.create_task(store.wait_for_change(store.revision, 1)) for _ in range(50)]
+        await asyncio.sleep(0)
+        assert not any(waiter.done() for waiter in waiters)
+        store.update(caps=PLAY_STATUS_PLAYING)
+        assert await asyncio.gather(*waiters) == [True] * 50
+        # waiters for the new revision wait for the next change
+        later = asyncio.create_task(store.wait_for_change(store.revision, 1))
+        await asyncio.sleep(0)
+        assert not later.done()
+        store.update(cann="next")
+        assert await later
+
+    asyncio.run(run())
+
+
+def test_response_is_built_once_per_revision():
+    store = PlayStatusStore()
+    store.update(caps=PLAY_STATUS_PLAYING, cann="track")
+    response = store.response()
+    assert store.response() is response
+    parsed = dmap_parser.parse(response, tag_definitions.lookup_tag)
+    assert dmap_parser.first(parsed, "cmst", "cmsr") == store.revision
+    assert dmap_parser.first(parsed, "cmst", "cann") == "track"
+    store.update(cann="other")
+    assert store.response() is not response
@@ -0,0 +1,107 @@
+"""SessionStore ids, idle expiry, LRU eviction and the trackpad index."""
+
+import asyncio
+
+import pytest
+
+import sessions
+from sessions import SessionStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A time.monotonic() the test moves forward by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(sessions.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_ids_are_random_31_bit_and_unique():
+    store = SessionStore(max_sessions=1000)
+    ids = [store.create().session_id for _ in range(1000)]
+    assert len(set(ids)) == 1000
+    assert all(0 < session_id < 2 ** 31 for session_id in ids)
+    # not handed out in sequence
+    assert sum(b - a == 1 for a, b in zip(ids, ids[1:])) < 10
+
+
+def test_id_collisions_are_retried(monkeypatch):
+    store = SessionStore()
+    draws = iter([5, 0, 5, 5, 6])
+    monkeypatch.setattr(sessions.secrets, "randbits", lambda bits: next(draws))
+    assert store.create().session_id == 5
+    assert store.create().session_id == 6
+
+
+def test_get_accepts_the_query_string_id():
+    store = SessionStore()
+    current = store.create("guid")
+    assert store.get(str(current.session_id)) is current
+    assert store.get("not a number") is None
+    assert store.get(None) is None
+
+
+def test_idle_sessions_expire(clock):
+    removed = []
+    store = SessionStore(idle_timeout=60, on_remove=removed.append)
+    idle = store.create()
+    active = store.create()
+    clock[0] += 40
+    assert store.get(active.session_id) is active  # pushes its expiry back
+    clock[0] += 30
+    assert store.expire() == 1
+    assert removed == [idle]
+    assert idle.closed
+    assert store.get(idle.session_id) is None
+    assert store.get(active.session_id) is active
+    assert len(store) == 1
+
+
+def test_get_drops_an_expired_session_before_expire_runs(clock):
+    store = SessionStore(idle_timeout=60)
+    current = store.create()
+    clock[0] += 61
+    assert store.get(current.session_id) is None
+    assert len(store) == 0
+
+
+def test_least_recently_used_session_is_evicted(clock):
+    removed = []
+    store = SessionStore(max_sessions=3, on_remove=removed.append)
+    first, second, third = (store.create() for _ in range(3))
+    store.touch(first)
+    fourth = store.create()
+    assert removed == [second]
+    assert [store.get(current.session_id) for current in (first, third, fourth)] == [first, third, fourth]
+    assert len(store) == 3
+
+
+def test_expiry_heap_stays_bounded(clock):
+    store = SessionStore(max_sessions=4, idle_timeout=60)
+    for _ in range(100):
+        store.remove(store.create().session_id)
+    assert len(store._expiry) <= 2 * store.max_sessions + 1
+
+
+def test_trackpad_index_follows_the_session():
+    store = SessionStore()
+    current = store.create()
+    store.set_trackpad(current, "1,0", 7, b"\x00\x00\x00\x27")
+    assert store.by_start_bytes(b"\x00\x00\x00\x27") is current
+    store.set_trackpad(current, "2,0", 8, b"\x00\x00\x00\x28")
+    assert store.by_start_bytes(b"\x00\x00\x00\x27") is None
+    assert store.by_start_bytes(b"\x00\x00\x00\x28") is current
+    store.remove(current.session_id)
+    assert store.by_start_bytes(b"\x00\x00\x00\x28") is None
+
+
+def test_run_expires_periodically():
+    async def run():
+        store = SessionStore(idle_timeout=0.01)
+        store.create()
+        runner = asyncio.create_task(store.run(interval=0.02))
+        await asyncio.sleep(0.05)
+        runner.cancel()
+        return len(store)
+
+    assert asyncio.run(run()) == 0
@@ -0,0 +1,108 @@
+"""CredentialWatcher over a uxplay dacp file rewritten and deleted by the test."""
+
+import asyncio
+import os
+
+import pytest
+
+import uxplay_credentials
+from uxplay_credentials import CredentialWatcher
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A time.monotonic() the test moves forward by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(uxplay_credentials.time, "monotonic", lambda: now[0])
+    return now
+
+
+def write(path, content: str, mtime_ns: int) -> None:
+    path.write_text(content)
+    # an explicit mtime, so a rewrite within the filesystem's timestamp granularity is still seen
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def watch(path) -> tuple[CredentialWatcher, list]:
+    changes = []
+    return CredentialWatcher(str(path), on_change=changes.append), changes
+
+
+def refresh(watcher: CredentialWatcher) -> bool:
+    return asyncio.run(watcher.refresh())
+
+
+def test_refresh_follows_the_file(tmp_path, clock):
+    path = tmp_path / "uxplay.dacp"
+    write(path, "0123456789ABCDEF\n1234567890\n", 1_000_000_000)
+    watcher, changes = watch(path)
+    assert watcher.snapshot is None
+
+    assert refresh(watcher)
+    assert (watcher.snapshot.dacp_id, watcher.snapshot.active_remote) == ("0123456789ABCDEF", "1234567890")
+    assert changes == [watcher.snapshot]
+    assert watcher.snapshot.loaded_at == 1000.0
+
+    # unchanged: no read, no new snapshot, no callback
+    first = watcher.snapshot
+    assert not refresh(watcher)
+    assert watcher.snapshot is first
+    assert len(changes) == 1
+
+    write(path, "FEDCBA9876543210\n42\n", 2_000_000_000)
+    assert refresh(watcher)
+    assert (watcher.snapshot.dacp_id, watcher.snapshot.active_remote) == ("FEDCBA9876543210", "42")
+    assert changes == [first, watcher.snapshot]
+    assert not refresh(watcher)
+    assert len(changes) == 2
+
+
+def test_deleted_file_clears_the_snapshot(tmp_path):
+    path = tmp_path / "uxplay.dacp"
+    write(path, "0123456789ABCDEF\n1234567890\n", 1_000_000_000)
+    watcher, changes = watch(path)
+    refresh(watcher)
+
+    path.unlink()
+    assert refresh(watcher)
+    assert watcher.snapshot is None
+    assert changes[-1] is None
+    assert not refresh(watcher)
+    assert len(changes) == 2
+
+    # and coming back is picked up again
+    write(path, "0123456789ABCDEF\n99\n", 3_000_000_000)
+    assert refresh(watcher)
+    assert watcher.snapshot.active_remote == "99"
+    assert len(changes) == 3
+
+
+def test_missing_file_is_not_a_change(tmp_path):
+    watcher, changes = watch(tmp_path / "uxplay.dacp")
+    assert not refresh(watcher)
+    assert watcher.snapshot is None
+    assert changes == []
+
+
+def test_bad_data_publishes_no_credentials(tmp_path):
+    path = tmp_path / "uxplay.dacp"
+    write(path, "0123456789ABCDEF\n", 1_000_000_000)
+    watcher, changes = watch(path)
+    assert refresh(watcher)
+    assert watcher.snapshot is None
+    write(path, "0123456789ABCDEF\n\n", 2_000_000_000)
+    assert refresh(watcher)
+    assert watcher.snapshot is None
+    assert changes == [None, None]
+
+
+def test_staleness_counts_from_the_last_check(tmp_path, clock):
+    path = tmp_path / "uxplay.dacp"
+    write(path, "0123456789ABCDEF\n1234567890\n", 1_000_000_000)
+    watcher, _ = watch(path)
+    assert watcher.staleness() is None
+    refresh(watcher)
+    clock[0] += 5
+    assert watcher.staleness() == 5
+    refresh(watcher)  # unchanged, but confirmed
+    assert watcher.staleness() == 0
@@ -0,0 +1,95 @@
+"""Cached view of the DACP credentials written by UxPlay.
+
+UxPlay (run with -dacp) writes the DACP id and Active-Remote value of the
+mirroring iDevice to a small file. CredentialWatcher polls that file's stat
+data and only reads and parses it again when it changed, publishing an
+immutable UxPlayCredentials snapshot that can be read without any I/O.
+
+file format:
+line 1: dacp_id (hex, uppercase)
+line 2: active remote (integer)
+"""
+
+import asyncio
+from dataclasses import dataclass
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+import aiofiles
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UxPlayCredentials:
+    dacp_id: str
+    active_remote: str
+    loaded_at: float  # time.monotonic() when the file was read
+
+
+class CredentialWatcher:
+    def __init__(self, path: str, poll_interval: float = 1.0,
+                 on_change: Optional[Callable[[Optional[UxPlayCredentials]], None]] = None) -> None:
+        self.path = path
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+        self._snapshot: Optional[UxPlayCredentials] = None
+        self._signature: Optional[tuple] = None
+        self._checked_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def snapshot(self) -> Optional[UxPlayCredentials]:
+        """Latest credentials, or None if the file is missing or invalid."""
+        return self._snapshot
+
+    def staleness(self) -> Optional[float]:
+        """Seconds since the snapshot was last confirmed to match the file."""
+        if self._checked_at is None:
+            return None
+        return time.monotonic() - self._checked_at
+
+    def _stat_signature(self) -> Optional[tuple]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    async def _load(self) -> Optional[UxPlayCredentials]:
+        try:
+            async with aiofiles.open(self.path, "r") as file:
+                lines = [line.strip() for line in await file.readlines()]
+        except OSError as e:
+            _LOGGER.warning("could not read uxplay dacp file %s: %s", self.path, e)
+            return None
+        if len(lines) != 2 or not all(lines):
+            _LOGGER.warning("uxplay dacp file %s had bad data", self.path)
+            return None
+        return UxPlayCredentials(lines[0], lines[1], time.monotonic())
+
+    async def refresh(self) -> bool:
+        """Re-read the file if it changed since the last check.
+
+        Returns True if a new snapshot (possibly None) was published.
+        """
+        async with self._lock:
+            signature = self._stat_signature()
+            self._checked_at = time.monotonic()
+            if signature == self._signature:
+                return False
+            self._signature = signature
+            previous = self._snapshot
+            self._snapshot = None if signature is None else await self._load()
+            _LOGGER.info("uxplay credentials changed: %s -> %s", previous, self._snapshot)
+        if self.on_change is not None:
+            self.on_change(self._snapshot)
+        return True
+
+    async def run(self) -> None:
+        """Poll the file until cancelled."""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.poll_interval)